@@ -1,15 +1,33 @@
 import os
-import json
+import re
 import asyncio
 import time
-from typing import AsyncGenerator, List, Dict
-from sandbox import ModalSandbox, LocalSandbox
+from typing import AsyncGenerator, List, Dict, Optional
+from sandbox import ModalSandbox, LocalSandbox, resolve_modal_runtime
+from sandbox_pool import ModalSandboxPool
+from repo_cache import RepoMirrorCache
 from claude_client import ClaudeCodeAnalyst
+from session import CodingSession
+from clone_strategy import CloneStrategy
+from events import Event, CommandResult
+from deadlines import PHASE_TIMEOUTS, iterate_with_deadline, run_with_deadline
+from context_packer import pack_context
+from analysis_cache import AnalysisCache, AnalysisEntry
+from llm_usage import UsageLedger, summarize_turns
 from dotenv import load_dotenv
 from telemetry import telemetry, enhanced_telemetry
 
 load_dotenv()
 
+# Repository manifest limits: files whose contents are sent up front, their
+# total size, how many entries are listed, and how many paths go in the prompt
+MANIFEST_TOP_N = int(os.getenv("MANIFEST_TOP_N", "5"))
+MANIFEST_BYTE_BUDGET = int(os.getenv("MANIFEST_BYTE_BUDGET", "65536"))
+MANIFEST_MAX_FILES = int(os.getenv("MANIFEST_MAX_FILES", "5000"))
+MANIFEST_PROMPT_FILES = int(os.getenv("MANIFEST_PROMPT_FILES", "20"))
+# Files indexed for the search_code tool (built once per session after the clone)
+CODE_SEARCH_MAX_FILES = int(os.getenv("CODE_SEARCH_MAX_FILES", "50000"))
+
 class CodingAgent:
     def __init__(self, use_local_sandbox: bool = False):
         self.github_token = os.getenv("GITHUB_TOKEN")
@@ -41,72 +59,145 @@ class CodingAgent:
             self.use_local_sandbox = True
             print("💻 Local sandboxing: ENABLED")
         
+        # Resolve the Modal app and agent image once at startup; fail fast if unavailable
+        if not self.use_local_sandbox:
+            resolve_modal_runtime()
+        
+        # Bare-mirror repository cache shared by every local workspace
+        self.repo_cache = RepoMirrorCache() if self.use_local_sandbox else None
+        
+        # Analysis, manifest and search index per (repo, HEAD commit), shared across requests
+        self.analysis_cache = AnalysisCache()
+        
+        # Model token usage, cost and latency rolled up per tenant (see llm_usage.py)
+        self.usage_ledger = UsageLedger()
+        
+        # Warm pool of pre-provisioned Modal sandboxes (started by the app on startup)
+        self.sandbox_pool = None
+        if not self.use_local_sandbox and int(os.getenv("MODAL_POOL_SIZE", "2")) > 0:
+            self.sandbox_pool = ModalSandboxPool()
+        
         # Debug: Print token status
         print(f"GitHub token loaded: {'Yes' if self.github_token else 'No'}")
         if self.github_token:
             print(f"Token length: {len(self.github_token)}")
             
-    async def process_coding_request(self, repo_url: str, prompt: str) -> AsyncGenerator[str, None]:
+    async def process_coding_request(self, repo_url: str, prompt: str, clone_strategy: CloneStrategy = None, session_id: str = None, bypass_llm_cache: bool = False, tenant: str = None) -> AsyncGenerator[Event, None]:
         """Main process that handles the entire coding workflow with Claude AI and telemetry"""
         
+        # Per-request state so concurrent requests never share analysis or sandbox
+        session = CodingSession(repo_url, prompt, clone_strategy or CloneStrategy(), session_id, bypass_llm_cache, tenant)
+        
         # Start telemetry session
-        session_span = enhanced_telemetry.start_coding_session(repo_url, prompt)
+        session.span = enhanced_telemetry.start_coding_session(repo_url, prompt, session.session_id)
         pr_url = None
         
         # Choose sandbox implementation
-        sandbox_class = LocalSandbox if self.use_local_sandbox else ModalSandbox
         sandbox_type = "Local" if self.use_local_sandbox else "Modal Cloud"
         
-        async with sandbox_class() as sandbox:
+        sandbox_instance = LocalSandbox(repo_cache=self.repo_cache) if self.use_local_sandbox else ModalSandbox(pool=self.sandbox_pool)
+        
+        async with sandbox_instance as sandbox:
             try:
                 # Step 1: Create workspace and clone repo
-                yield f"data: {json.dumps({'type': 'status', 'message': 'Initializing Claude-powered coding agent...', 'telemetry': {'phase': 'initialization', 'ai_enabled': bool(self.claude), 'sandbox': sandbox_type}})}\n\n"
+                yield Event('status', message='Initializing Claude-powered coding agent...', telemetry={'phase': 'initialization', 'ai_enabled': bool(self.claude), 'sandbox': sandbox_type})
                 
                 workspace_id = await sandbox.create_workspace(repo_url)
-                # Store workspace_id in sandbox for tool access
-                sandbox.workspace_id = workspace_id
+                # Bind sandbox and workspace to this session for tool access
+                session.attach_sandbox(sandbox, workspace_id)
+                
+                # Pick a concrete clone strategy (auto mode looks at the repo size);
+                # local workspaces are copies of a full mirror, where only sparse paths apply
+                if self.repo_cache:
+                    session.clone_strategy = session.clone_strategy.for_mirror_copy()
+                else:
+                    session.clone_strategy = await session.clone_strategy.resolve(repo_url)
                 
                 # Stream repo cloning with telemetry
-                async for update in sandbox.clone_repo(repo_url, workspace_id):
+                async for event in iterate_with_deadline(sandbox.clone_repo(repo_url, workspace_id, session.clone_strategy), "clone"):
                     # Add telemetry context to each update
-                    if '"type": "sandbox"' in update and 'cloned successfully' in update:
+                    if event.type == 'sandbox' and 'cloned successfully' in event.message:
                         telemetry.trace_git_operations("clone", success=True)
-                    yield update
+                    yield event
                 
                 # Step 2: Enhanced codebase analysis with Claude
-                yield f"data: {json.dumps({'type': 'analysis', 'message': f'Claude AI analyzing codebase in {sandbox_type} environment for: {prompt}', 'telemetry': {'phase': 'analysis', 'ai_powered': True, 'sandbox': sandbox_type}})}\n\n"
+                yield Event('analysis', message=f'Claude AI analyzing codebase in {sandbox_type} environment for: {prompt}', telemetry={'phase': 'analysis', 'ai_powered': True, 'sandbox': sandbox_type})
                 
-                # Get repository structure
-                files_found = []
-                async for update in sandbox.execute_command("find . -type f -name '*.py' -o -name '*.js' -o -name '*.ts' -o -name '*.json' -o -name '*.md' | head -20", workspace_id):
-                    if '"type": "command_output"' in update:
-                        import re
-                        output_match = re.search(r'"output": "([^"]*)"', update)
-                        if output_match:
-                            files_found = [f.strip() for f in output_match.group(1).strip().split('\n') if f.strip()]
-                    yield update
+                # Reuse the manifest, search index and analysis of this exact
+                # commit when an earlier request already produced them
+                lookup_start = time.time()
+                head_sha = await self._head_sha(sandbox, workspace_id)
+                cache_variant = ",".join(session.clone_strategy.sparse_paths)
+                cached = await self.analysis_cache.get(repo_url, head_sha, cache_variant) if head_sha else None
                 
-                # Read file contents for Claude analysis
-                file_contents = {}
-                important_files = [f for f in files_found if any(f.endswith(ext) for ext in ['.py', '.js', '.ts', '.json', '.md']) and len(f) < 100][:5]
+                if cached:
+                    repo_manifest = cached.manifest
+                    search_index = await self._restore_search_index(sandbox, workspace_id, cached)
+                    session.analysis_result = dict(cached.analysis)
+                    session.analysis_cached = bool(cached.analysis)
+                    reused_ms = cached.cost_ms.get('scan', 0) + (cached.cost_ms.get('analysis', 0) if session.analysis_cached and self.claude else 0)
+                    saved_ms = max(0.0, reused_ms - (time.time() - lookup_start) * 1000)
+                    self.analysis_cache.record_saved(saved_ms)
+                    yield Event('analysis_cache', hit=True, head_sha=head_sha, message=f'Reusing analysis of {head_sha[:12]} from an earlier request (saves ~{saved_ms:.0f}ms)', telemetry={'phase': 'analysis_cache', 'hit': True, 'saved_ms': round(saved_ms, 1), 'analysis_reused': session.analysis_cached})
+                else:
+                    # Scan the repository once: file list, metadata and key file contents,
+                    # and build the search_code index alongside it
+                    scan_start = time.time()
+                    repo_manifest, search_index = await run_with_deadline(
+                        asyncio.gather(
+                            sandbox.scan_manifest(workspace_id, top_n=MANIFEST_TOP_N, byte_budget=MANIFEST_BYTE_BUDGET, max_files=MANIFEST_MAX_FILES),
+                            self._build_search_index(sandbox, workspace_id)
+                        ),
+                        "analysis"
+                    )
+                    scan_ms = (time.time() - scan_start) * 1000
+                    if head_sha:
+                        yield Event('analysis_cache', hit=False, head_sha=head_sha, message=f'No cached analysis for {head_sha[:12]}', telemetry={'phase': 'analysis_cache', 'hit': False})
+                session.manifest = repo_manifest
                 
-                for file_path in important_files:
-                    try:
-                        content = await sandbox.read_file(file_path, workspace_id)
-                        if not content.startswith("Error reading file"):
-                            file_contents[file_path] = content
-                    except:
-                        pass
+                languages = {}
+                for entry in repo_manifest['files']:
+                    languages[entry['language']] = languages.get(entry['language'], 0) + 1
+                total_files = repo_manifest['total_files']
+                files_read = list(repo_manifest['contents'])
+                if not cached:
+                    yield Event('manifest', message=f'Scanned {total_files} files ({len(files_read)} read) in {scan_ms:.0f}ms', telemetry={'phase': 'manifest', 'total_files': total_files, 'total_bytes': repo_manifest['total_bytes'], 'truncated': repo_manifest['truncated'], 'languages': languages, 'files_read': files_read})
+                if 'error' in search_index:
+                    yield Event('info', message=f"Code search unavailable: {search_index['error']}", telemetry={'phase': 'search_index', **search_index})
+                elif cached:
+                    yield Event('search_index', message=f"Restored code search index ({search_index.get('files', 0)} files) from cache", telemetry={'phase': 'search_index', **search_index})
+                else:
+                    yield Event('search_index', message=f"Indexed {search_index['files']} files ({search_index['chunks']} chunks) for code search in {search_index['build_ms']:.0f}ms", telemetry={'phase': 'search_index', **search_index})
+                # Snapshot the index for the analysis cache now: the agent's writes re-index files
+                search_index_bytes = cached.search_index if cached else None
+                if head_sha and not search_index_bytes and 'error' not in search_index:
+                    search_index_bytes = await self._export_search_index(sandbox, workspace_id)
+                
+                # Pick the files most relevant to the prompt within the context token budget
+                context = await run_with_deadline(
+                    pack_context(repo_manifest, prompt, lambda paths: sandbox.read_files(paths, workspace_id), list_paths=MANIFEST_PROMPT_FILES),
+                    "analysis"
+                )
+                session.context = context
+                files_found = context.paths[:MANIFEST_PROMPT_FILES]
+                file_contents = context.contents
+                excerpts = sum(1 for item in context.included if item['excerpt'])
+                yield Event('context', message=f'Packed {len(context.included)} files ({excerpts} excerpted) into {context.tokens}/{context.budget} tokens, {len(context.excluded)} left out', telemetry={'phase': 'context', **context.report()})
                 
                 # Step 3: Use Claude's new tools-based approach
                 if self.claude:
-                    yield f"data: {json.dumps({'type': 'ai_analysis', 'message': 'Claude executing complete workflow with tools...', 'telemetry': {'phase': 'tools_execution', 'files_analyzed': len(file_contents), 'tools_enabled': True}})}\n\n"
+                    yield Event('ai_analysis', message='Claude executing complete workflow with tools...', telemetry={'phase': 'tools_execution', 'files_analyzed': len(file_contents), 'tools_enabled': True})
                     
                     # Use the new tools-based method that does everything in one go
                     start_time = time.time()
-                    executed_changes = await self.claude.execute_coding_request(prompt, files_found, file_contents, sandbox)
+                    executed_changes = await run_with_deadline(self.claude.execute_coding_request(session, files_found, file_contents), "llm")
                     duration_ms = (time.time() - start_time) * 1000
                     
+                    # Per-turn token usage, including prompt cache reads and writes
+                    turns = session.llm_turns
+                    usage = summarize_turns(turns)
+                    yield Event('llm_usage', message=f"{usage['turns']} Claude turns ({usage['replayed_turns']} replayed from response cache): {usage['cache_read_input_tokens']} input tokens read from cache, {usage['cache_creation_input_tokens']} written, {usage['input_tokens']} uncached, {usage['output_tokens']} output, ${usage['cost_usd']:.4f}", turns=turns, telemetry={'phase': 'llm_usage', **usage, 'response_cache_bypassed': session.bypass_llm_cache, 'llm_error': session.llm_error})
+                    
                     # Enhanced telemetry for Claude tool execution
                     for change in executed_changes:
                         enhanced_telemetry.trace_claude_tool_execution(
@@ -139,13 +230,18 @@ class CodingAgent:
                     # Stream the results of Claude's tool execution
                     for change in executed_changes:
                         description = change.get('description', 'Unknown action')
-                        yield f"data: {json.dumps({'type': 'ai_tool_result', 'message': f'Claude executed: {description}', 'change': change, 'telemetry': {'tool_executed': True, 'ai_powered': True}})}\n\n"
+                        yield Event('ai_tool_result', message=f'Claude executed: {description}', change=change, telemetry={'tool_executed': True, 'ai_powered': True})
+                    
+                    # Remember this commit's analysis for later requests
+                    if head_sha and (not cached or (session.analysis_result and not cached.analysis)):
+                        analysis_ms = sum(turn['duration_ms'] for turn in turns if 'analyze_codebase' in turn['tools'])
+                        await self._store_analysis(session, head_sha, cache_variant, context, search_index, search_index_bytes, {'scan': cached.cost_ms.get('scan', 0) if cached else scan_ms, 'analysis': analysis_ms})
                     
                     # Use executed_changes as our changes list
                     changes = executed_changes
                     
                     # Get analysis result from Claude
-                    analysis_result = self.claude.analysis_result or self._fallback_analysis(files_found)
+                    analysis_result = session.analysis_result or self._fallback_analysis(files_found)
                     
                 else:
                     # Fallback analysis and changes without Claude
@@ -157,46 +253,47 @@ class CodingAgent:
                 telemetry.trace_planning_phase(changes)
                 
                 # Step 4: Display what was accomplished
-                yield f"data: {json.dumps({'type': 'implementation', 'message': f'Claude completed {len(changes)} changes using tools', 'telemetry': {'phase': 'implementation_complete', 'changes_count': len(changes)}})}\n\n"
+                yield Event('implementation', message=f'Claude completed {len(changes)} changes using tools', telemetry={'phase': 'implementation_complete', 'changes_count': len(changes)})
                 
                 for change in changes:
-                    yield f"data: {json.dumps({'type': 'completed_change', 'change': change, 'telemetry': {'decision': 'change_completed', 'ai_generated': bool(self.claude)}})}\n\n"
+                    yield Event('completed_change', change=change, telemetry={'decision': 'change_completed', 'ai_generated': bool(self.claude)})
                 
                 # Step 5: Create branch and commit with enhanced commit message
-                yield f"data: {json.dumps({'type': 'git', 'message': 'Creating feature branch...', 'telemetry': {'phase': 'git_operations'}})}\n\n"
+                yield Event('git', message='Creating feature branch...', telemetry={'phase': 'git_operations'})
                 
                 # Debug: List files before branching
-                async for update in sandbox.execute_command("ls -la", workspace_id):
-                    print(f"FILES BEFORE BRANCH: {update}")
-                    yield update
+                async for event in sandbox.execute_command("ls -la", workspace_id):
+                    print(f"FILES BEFORE BRANCH: {event}")
+                    yield event
                 
                 branch_name = f"feature/{prompt.lower().replace(' ', '-')[:50]}-{asyncio.get_event_loop().time():.0f}"
-                async for update in sandbox.execute_command(f"git checkout -b {branch_name}", workspace_id):
-                    yield update
+                async for event in sandbox.execute_command(f"git checkout -b {branch_name}", workspace_id):
+                    yield event
                 
                 telemetry.trace_git_operations("create_branch", branch_name, True)
                 
                 # Debug: List files after branching
-                async for update in sandbox.execute_command("ls -la", workspace_id):
-                    print(f"FILES AFTER BRANCH: {update}")
-                    yield update
+                async for event in sandbox.execute_command("ls -la", workspace_id):
+                    print(f"FILES AFTER BRANCH: {event}")
+                    yield event
                 
-                # Force add all files
-                async for update in sandbox.execute_command("git add .", workspace_id):
-                    yield update
+                # Force add all files (including paths outside a sparse checkout)
+                add_command = "git add --sparse ." if session.clone_strategy.is_sparse else "git add ."
+                async for event in sandbox.execute_command(add_command, workspace_id):
+                    yield event
                 
                 # Debug: Check what's being committed
-                async for update in sandbox.execute_command("git status", workspace_id):
-                    print(f"COMMIT STATUS: {update}")
-                    yield update
+                async for event in sandbox.execute_command("git status", workspace_id):
+                    print(f"COMMIT STATUS: {event}")
+                    yield event
                 
                 # Create detailed commit message
                 commit_message = f"feat: {prompt}\\n\\nGenerated by Claude AI with Tools:\\n"
                 for change in changes[:3]:  # Include up to 3 changes in commit message
                     commit_message += f"- {change.get('description', 'Code change')}\\n"
                 
-                async for update in sandbox.execute_command(f'git commit -m "{commit_message}"', workspace_id):
-                    yield update
+                async for event in sandbox.execute_command(f'git commit -m "{commit_message}"', workspace_id):
+                    yield event
                 
                 telemetry.trace_git_operations("commit", branch_name, True)
                 
@@ -204,52 +301,47 @@ class CodingAgent:
                 print(f"DEBUG: GitHub token exists: {bool(self.github_token)}")
                 if self.github_token:
                     print("DEBUG: Entering GitHub push section")
-                    yield f"data: {json.dumps({'type': 'git', 'message': 'Setting up GitHub authentication...', 'telemetry': {'phase': 'github_integration'}})}\n\n"
+                    yield Event('git', message='Setting up GitHub authentication...', telemetry={'phase': 'github_integration'})
                     
                     # Debug: Check current git status
-                    async for update in sandbox.execute_command("git status", workspace_id):
-                        print(f"GIT STATUS: {update}")
-                        yield update
+                    async for event in sandbox.execute_command("git status", workspace_id):
+                        print(f"GIT STATUS: {event}")
+                        yield event
                     
                     # Debug: Check current remote
-                    async for update in sandbox.execute_command("git remote -v", workspace_id):
-                        print(f"GIT REMOTE BEFORE: {update}")
-                        yield update
+                    async for event in sandbox.execute_command("git remote -v", workspace_id):
+                        print(f"GIT REMOTE BEFORE: {event}")
+                        yield event
                     
                     # Set git remote URL with token for authentication
                     repo_name = repo_url.split('/')[-2:]  # ['username', 'repo']
                     auth_url = f"https://{self.github_token}@github.com/{repo_name[0]}/{repo_name[1]}"
                     print(f"DEBUG: Setting remote to: https://[TOKEN]@github.com/{repo_name[0]}/{repo_name[1]}")
                     
-                    async for update in sandbox.execute_command(f"git remote set-url origin {auth_url}", workspace_id):
-                        print(f"SET REMOTE: {update}")
-                        yield update
+                    async for event in sandbox.execute_command(f"git remote set-url origin {auth_url}", workspace_id):
+                        print(f"SET REMOTE: {event}")
+                        yield event
                     
                     # Debug: Verify remote was set
-                    async for update in sandbox.execute_command("git remote -v", workspace_id):
-                        print(f"GIT REMOTE AFTER: {update}")
-                        yield update
+                    async for event in sandbox.execute_command("git remote -v", workspace_id):
+                        print(f"GIT REMOTE AFTER: {event}")
+                        yield event
                     
-                    yield f"data: {json.dumps({'type': 'git', 'message': 'Pushing Claude-generated changes...', 'telemetry': {'phase': 'github_push'}})}\n\n"
+                    yield Event('git', message='Pushing Claude-generated changes...', telemetry={'phase': 'github_push'})
                     
                     # Push branch with detailed output
                     push_success = True
                     push_command = f"git push -u origin {branch_name}"
                     print(f"DEBUG: Executing push command: {push_command}")
                     
-                    async for update in sandbox.execute_command(push_command, workspace_id):
-                        print(f"PUSH OUTPUT: {update}")
-                        # More accurate success detection
-                        if '"type": "command_error"' in update:
-                            # Check if it's actually an error or just git's verbose output
-                            if '"exit_code": 0' in update:
-                                # Exit code 0 means success, even if in stderr
-                                pass
-                            elif any(error in update.lower() for error in ['rejected', 'failed', 'error:', 'fatal:']):
-                                push_success = False
-                        elif '"type": "error"' in update:
+                    async for event in sandbox.execute_command(push_command, workspace_id, timeout=PHASE_TIMEOUTS["push"]):
+                        print(f"PUSH OUTPUT: {event}")
+                        # Success is decided by the exit code; git writes progress to stderr
+                        if isinstance(event, CommandResult):
+                            push_success = event.ok
+                        elif event.type == 'error':
                             push_success = False
-                        yield update
+                        yield event
                     
                     print(f"DEBUG: Push success = {push_success}")
                     telemetry.trace_git_operations("push", branch_name, push_success)
@@ -287,51 +379,116 @@ class CodingAgent:
 """
                         
                         # Create PR using GitHub CLI
-                        yield f"data: {json.dumps({'type': 'git', 'message': 'Creating pull request...', 'telemetry': {'phase': 'create_pr'}})}\n\n"
+                        yield Event('git', message='Creating pull request...', telemetry={'phase': 'create_pr'})
                         
                         pr_command = f'gh pr create --title "{pr_title}" --body "{pr_body}" --head {branch_name}'
                         print(f"DEBUG: Executing PR command: {pr_command[:100]}...")
                         
-                        async for update in sandbox.execute_command_with_env(
+                        async for event in sandbox.execute_command_with_env(
                             pr_command,
                             workspace_id,
-                            {"GITHUB_TOKEN": self.github_token}
+                            {"GITHUB_TOKEN": self.github_token},
+                            timeout=PHASE_TIMEOUTS["push"]
                         ):
-                            print(f"PR OUTPUT: {update}")
+                            print(f"PR OUTPUT: {event}")
                             # Extract PR URL from output for telemetry
-                            if '"type": "command_output"' in update and 'github.com' in update:
-                                import re
-                                url_match = re.search(r'https://github\.com/[^\s"]+', update)
+                            if isinstance(event, CommandResult):
+                                url_match = re.search(r'https://github\.com/\S+', event.stdout)
                                 if url_match:
                                     pr_url = url_match.group(0)
-                            yield update
+                            yield event
                         
                         telemetry.trace_git_operations("create_pr", branch_name, bool(pr_url))
                     else:
                         print("DEBUG: Push failed, skipping PR creation")
-                        yield f"data: {json.dumps({'type': 'error', 'message': 'Push failed, cannot create PR', 'telemetry': {'phase': 'push_failed'}})}\n\n"
+                        yield Event('error', message='Push failed, cannot create PR', telemetry={'phase': 'push_failed'})
                 else:
                     print("DEBUG: No GitHub token found, skipping push")
-                    yield f"data: {json.dumps({'type': 'info', 'message': 'No GitHub token configured, skipping PR creation', 'telemetry': {'phase': 'skipped_github'}})}\n\n"
+                    yield Event('info', message='No GitHub token configured, skipping PR creation', telemetry={'phase': 'skipped_github'})
                 
                 # Final success message with Claude attribution
                 final_message = f"Claude AI tools-based coding process completed successfully in {sandbox_type}!" if self.claude else f"Coding process completed successfully in {sandbox_type}!"
-                yield f"data: {json.dumps({'type': 'completion', 'message': final_message, 'telemetry': {'phase': 'completion', 'pr_url': pr_url, 'ai_powered': bool(self.claude), 'changes_implemented': len(changes), 'sandbox': sandbox_type, 'tools_used': bool(self.claude)}})}\n\n"
+                yield Event('completion', message=final_message, telemetry={'phase': 'completion', 'pr_url': pr_url, 'ai_powered': bool(self.claude), 'changes_implemented': len(changes), 'sandbox': sandbox_type, 'tools_used': bool(self.claude), 'llm_usage': summarize_turns(session.llm_turns)})
                 
                 # Mark session as successful
-                enhanced_telemetry.finish_coding_session(True, pr_url)
+                self._record_llm_usage(session)
+                enhanced_telemetry.finish_coding_session(session.span, True, pr_url)
                 
+            except (asyncio.CancelledError, GeneratorExit):
+                # Cancelled (server shutdown): stop paying for LLM turns and commands;
+                # the sandbox is released by the context manager on the way out
+                print(f"Session {session.session_id} cancelled")
+                telemetry.trace_error("coding_session_cancelled", "session cancelled", {"repo_url": repo_url, "sandbox": sandbox_type})
+                self._record_llm_usage(session)
+                telemetry.finish_coding_session(session.span, False)
+                raise
+            
             except Exception as e:
                 # Trace the error
                 telemetry.trace_error("coding_session_error", str(e), {"repo_url": repo_url, "prompt": prompt, "sandbox": sandbox_type})
-                yield f"data: {json.dumps({'type': 'error', 'message': f'Process failed: {str(e)}', 'telemetry': {'phase': 'error', 'error_type': type(e).__name__, 'sandbox': sandbox_type}})}\n\n"
-                telemetry.finish_coding_session(False)
+                yield Event('error', message=f'Process failed: {str(e)}', telemetry={'phase': 'error', 'error_type': type(e).__name__, 'sandbox': sandbox_type})
+                self._record_llm_usage(session)
+                telemetry.finish_coding_session(session.span, False)
             
             finally:
                 # Clean up workspace - commented out for testing
                 # await sandbox.cleanup_workspace(workspace_id)
                 pass
     
+    async def _head_sha(self, sandbox, workspace_id: str) -> Optional[str]:
+        """HEAD commit of the cloned workspace, or None if it cannot be read"""
+        async for event in sandbox.execute_command("git rev-parse HEAD", workspace_id):
+            if isinstance(event, CommandResult) and event.ok:
+                return event.stdout.strip() or None
+        return None
+    
+    async def _restore_search_index(self, sandbox, workspace_id: str, cached: AnalysisEntry) -> Dict:
+        """Load the cached search index into the workspace, or build it if it was not cached"""
+        if cached.search_index:
+            try:
+                await sandbox.import_search_index(workspace_id, cached.search_index)
+                return {**cached.search_index_stats, 'restored': True}
+            except Exception as e:
+                print(f"Restoring cached search index failed: {e}")
+        return await self._build_search_index(sandbox, workspace_id)
+    
+    def _record_llm_usage(self, session: CodingSession):
+        """Add the session's model turns to the per-tenant ledger and its telemetry span"""
+        if not session.llm_turns:
+            return
+        self.usage_ledger.record(session.tenant, session.session_id, session.llm_turns)
+        for number, turn in enumerate(session.llm_turns, 1):
+            enhanced_telemetry.trace_multi_turn_conversation(session.span, number, turn)
+        enhanced_telemetry.trace_llm_usage(session.span, summarize_turns(session.llm_turns))
+    
+    async def _store_analysis(self, session: CodingSession, head_sha: str, variant: str, context, search_index: Dict, index_bytes: Optional[bytes], cost_ms: Dict[str, float]):
+        """Cache what this run learned about the commit; failures only cost the cache entry"""
+        try:
+            manifest = {**session.manifest, 'contents': context.read}
+            index_stats = {key: value for key, value in search_index.items() if key not in ('restored', 'error')}
+            entry = AnalysisEntry(session.repo_url, head_sha, manifest, session.analysis_result, index_bytes, index_stats, cost_ms)
+            await self.analysis_cache.put(session.repo_url, head_sha, entry, variant)
+        except Exception as e:
+            print(f"Storing analysis cache entry failed: {e}")
+    
+    async def _export_search_index(self, sandbox, workspace_id: str) -> Optional[bytes]:
+        """Serialized search index of the checkout, before any file is written; None if it cannot be exported"""
+        try:
+            return await sandbox.export_search_index(workspace_id)
+        except Exception as e:
+            print(f"Exporting search index failed: {e}")
+            return None
+    
+    async def _build_search_index(self, sandbox, workspace_id: str) -> Dict:
+        """Build the search_code index; a failure only disables the tool, it does not fail the run"""
+        start_time = time.time()
+        try:
+            stats = await sandbox.build_search_index(workspace_id, max_files=CODE_SEARCH_MAX_FILES)
+        except Exception as e:
+            print(f"Code search index build failed: {e}")
+            return {'error': str(e)}
+        return {**stats, 'build_ms': round((time.time() - start_time) * 1000, 1)}
+    
     def _fallback_analysis(self, files: List[str]) -> Dict[str, str]:
         """Fallback analysis when Claude is not available"""
         language_counts = {}
@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+# Where cached analyses live: sqlite (memory in front of a local file),
+# memory (lost on restart) or off
+ANALYSIS_CACHE = os.getenv("ANALYSIS_CACHE", "sqlite").lower()
+ANALYSIS_CACHE_DB_PATH = os.getenv("ANALYSIS_CACHE_DB_PATH", "/tmp/tiny-backspace-analysis.db")
+# Entries and compressed bytes kept in memory, and compressed bytes kept on disk
+ANALYSIS_CACHE_MEMORY_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MEMORY_ENTRIES", "32"))
+ANALYSIS_CACHE_MEMORY_BYTES = int(os.getenv("ANALYSIS_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def cache_key(repo_url: str, head_sha: str, variant: str = "") -> str:
+    """Key for one repository state; variant separates e.g. sparse checkouts of it"""
+    repo = repo_url.rstrip('/').removesuffix('.git').lower()
+    return hashlib.sha256(f"{repo}\0{head_sha}\0{variant}".encode()).hexdigest()
+
+
+class AnalysisEntry:
+    """
+    Everything derived from one repository state without the prompt: the
+    analyze_codebase result, the manifest (with the file contents read for
+    context packing), the serialized search index, and how long each took
+    to produce the first time.
+    """
+
+    def __init__(
+        self,
+        repo_url: str,
+        head_sha: str,
+        manifest: Dict[str, Any],
+        analysis: Dict[str, Any] = None,
+        search_index: Optional[bytes] = None,
+        search_index_stats: Dict[str, Any] = None,
+        cost_ms: Dict[str, float] = None,
+        created_at: float = None
+    ):
+        self.repo_url = repo_url
+        self.head_sha = head_sha
+        self.manifest = manifest
+        self.analysis = analysis or {}
+        self.search_index = search_index
+        self.search_index_stats = search_index_stats or {}
+        self.cost_ms = cost_ms or {}
+        self.created_at = created_at or time.time()
+
+    def encode(self) -> Tuple[bytes, Optional[bytes]]:
+        """Compressed JSON record and compressed search index"""
+        record = {
+            "repo_url": self.repo_url,
+            "head_sha": self.head_sha,
+            "manifest": self.manifest,
+            "analysis": self.analysis,
+            "search_index_stats": self.search_index_stats,
+            "cost_ms": self.cost_ms,
+            "created_at": self.created_at,
+        }
+        index = zlib.compress(self.search_index, 1) if self.search_index else None
+        return zlib.compress(json.dumps(record).encode(), 1), index
+
+    @classmethod
+    def decode(cls, record: bytes, index: Optional[bytes]) -> "AnalysisEntry":
+        fields = json.loads(zlib.decompress(record))
+        return cls(search_index=zlib.decompress(index) if index else None, **fields)
+
+
+class AnalysisCache:
+    """
+    Cross-request cache of repository analysis keyed by (repo URL, HEAD SHA).
+
+    A bounded LRU in memory sits in front of an optional SQLite file; disk
+    entries are evicted least recently used first once their compressed
+    size exceeds ANALYSIS_CACHE_MAX_BYTES. On a hit the agent skips the
+    manifest scan, the search index build and Claude's analysis turn, and
+    the time those took originally is counted as saved.
+    """
+
+    def __init__(self, mode: str = None, path: str = None, memory_entries: int = None, memory_bytes: int = None, max_bytes: int = None):
+        self.mode = mode or ANALYSIS_CACHE
+        self.memory_entries = memory_entries if memory_entries is not None else ANALYSIS_CACHE_MEMORY_ENTRIES
+        self.memory_bytes = memory_bytes if memory_bytes is not None else ANALYSIS_CACHE_MEMORY_BYTES
+        self.max_bytes = max_bytes if max_bytes is not None else ANALYSIS_CACHE_MAX_BYTES
+
+        self._memory: "OrderedDict[str, Tuple[AnalysisEntry, int]]" = OrderedDict()
+        self._memory_size = 0
+        self._db = None
+        if self.mode == "sqlite":
+            self.path = path or ANALYSIS_CACHE_DB_PATH
+            # One thread, so writes land in the order they were issued
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis-cache")
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, repo_url TEXT NOT NULL, head_sha TEXT NOT NULL, "
+                "record BLOB NOT NULL, search_index BLOB, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.commit()
+
+        self.metrics = {"hits": 0, "memory_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "saved_ms": 0.0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("sqlite", "memory")
+
+    async def get(self, repo_url: str, head_sha: str, variant: str = "") -> Optional[AnalysisEntry]:
+        """The cached entry for a repository state, counting the hit or miss"""
+        if not self.enabled:
+            return None
+        key = cache_key(repo_url, head_sha, variant)
+
+        cached = self._memory.get(key)
+        if cached:
+            self._memory.move_to_end(key)
+            self.metrics["memory_hits"] += 1
+            entry = cached[0]
+            if self._db:
+                await self._run(self._touch, key)
+        elif self._db:
+            row = await self._run(self._load, key)
+            entry = AnalysisEntry.decode(*row) if row else None
+            if entry:
+                self._remember(key, entry, len(row[0]) + len(row[1] or b""))
+        else:
+            entry = None
+
+        if entry is None:
+            self.metrics["misses"] += 1
+            return None
+        self.metrics["hits"] += 1
+        return entry
+
+    async def put(self, repo_url: str, head_sha: str, entry: AnalysisEntry, variant: str = ""):
+        """Store (or replace) the entry for a repository state"""
+        if not self.enabled:
+            return
+        key = cache_key(repo_url, head_sha, variant)
+        record, index = await asyncio.to_thread(entry.encode)
+        size = len(record) + len(index or b"")
+        self._remember(key, entry, size)
+        if self._db:
+            evicted = await self._run(self._store, key, repo_url, head_sha, record, index, size)
+            self.metrics["evictions"] += evicted
+        self.metrics["stores"] += 1
+
+    def record_saved(self, saved_ms: float):
+        """Count time a hit saved (what the reused work took when it was cached)"""
+        self.metrics["saved_ms"] += saved_ms
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            "mode": self.mode,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_size,
+            "hit_rate": self.metrics["hits"] / lookups if lookups else 0.0,
+            **self.metrics,
+            "saved_ms": round(self.metrics["saved_ms"], 1),
+        }
+
+    def _remember(self, key: str, entry: AnalysisEntry, size: int):
+        if key in self._memory:
+            self._memory_size -= self._memory.pop(key)[1]
+        if size > self.memory_bytes:
+            return
+        self._memory[key] = (entry, size)
+        self._memory_size += size
+        while len(self._memory) > self.memory_entries or self._memory_size > self.memory_bytes:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self._memory_size -= evicted_size
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _load(self, key: str) -> Optional[Tuple[bytes, Optional[bytes]]]:
+        row = self._db.execute("SELECT record, search_index FROM analyses WHERE key = ?", (key,)).fetchone()
+        if row:
+            self._touch(key)
+        return row
+
+    def _touch(self, key: str):
+        self._db.execute("UPDATE analyses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self._db.commit()
+
+    def _store(self, key: str, repo_url: str, head_sha: str, record: bytes, index: Optional[bytes], size: int) -> int:
+        self._db.execute(
+            "INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, repo_url, head_sha, record, index, size, time.time())
+        )
+        evicted = 0
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+        for old_key, old_size in self._db.execute("SELECT key, size FROM analyses WHERE key != ? ORDER BY last_used", (key,)).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM analyses WHERE key = ?", (old_key,))
+            total -= old_size
+            evicted += 1
+        self._db.commit()
+        return evicted
@@ -1,11 +1,175 @@
 import os
 import json
-from typing import List, Dict, Any, Optional
-from anthropic import Anthropic
+import time
+import asyncio
+import posixpath
+from types import SimpleNamespace
+from typing import List, Dict, Any, Optional, Tuple
+import httpx
+from anthropic import AsyncAnthropic
 from dotenv import load_dotenv
+from session import CodingSession
+from llm_cache import ResponseCache, request_key, message_from_dict
+from llm_usage import TOKEN_FIELDS, turn_cost
+from resilience import ResilientCaller, SideEffectsStartedError
+from context_packer import estimate_tokens
 
 load_dotenv()
 
+# Mark the stable prompt prefix (tools, system prompt, codebase context) as cacheable
+PROMPT_CACHE_ENABLED = os.getenv("ANTHROPIC_PROMPT_CACHE", "true").lower() in ("1", "true", "yes")
+
+# Upper bound on model round trips per request; the loop normally ends when
+# Claude answers without calling a tool
+MAX_TOOL_ROUNDS = int(os.getenv("CLAUDE_MAX_TOOL_ROUNDS", "8"))
+# read_file results longer than this are truncated before going back to Claude
+MAX_TOOL_RESULT_CHARS = 20000
+
+# One pooled async client per process, shared by every session
+_shared_client: Optional[AsyncAnthropic] = None
+
+
+def get_shared_client(api_key: str) -> AsyncAnthropic:
+    """Return the process-wide AsyncAnthropic client, creating it on first use"""
+    global _shared_client
+    if _shared_client is None:
+        max_connections = int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", "20"))
+        _shared_client = AsyncAnthropic(
+            api_key=api_key,
+            # Retries are done by the resilience layer (see resilience.py)
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                ),
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            ),
+        )
+    return _shared_client
+
+
+async def close_shared_client():
+    """Close the shared client's connection pool (called on app shutdown)"""
+    global _shared_client
+    if _shared_client is not None:
+        await _shared_client.close()
+        _shared_client = None
+
+
+# Tools that write a file; ToolBatch sends a message's writes to the sandbox together
+WRITE_TOOLS = ("create_file", "modify_file")
+
+
+class ToolBatch:
+    """
+    The tool calls of one assistant message, started as their blocks finish
+    streaming.
+    
+    Calls on different files (and calls without a file_path) run
+    concurrently. Calls on the same file_path run one after another in the
+    order the model issued them, so a read after a write sees the write and
+    the last of two writes wins, the same way on every run.
+    
+    When write is given, file writes (WRITE_TOOLS) are not run one by one:
+    they are held until results() and handed to write together once every
+    other call has finished or is waiting on a held write, so a message that
+    writes N files costs one sandbox round trip. Only a write ordered after
+    a read of a file written earlier in the message needs a second one.
+    """
+    
+    def __init__(self, run, write=None):
+        self._run = run
+        self._write = write
+        self._calls: List[Tuple[Any, asyncio.Task]] = []
+        self._tails: Dict[str, asyncio.Task] = {}
+        # Writes whose earlier calls on the same file are done, waiting to be flushed
+        self._ready_writes: List[Tuple[Any, asyncio.Future]] = []
+        self._write_ready = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+        # Each call's predecessor on its file, and the write calls being held
+        self._previous: Dict[asyncio.Task, Optional[asyncio.Task]] = {}
+        self._held: Dict[asyncio.Task, asyncio.Future] = {}
+    
+    def submit(self, tool_call):
+        """Start a tool call, after any earlier call on the same file"""
+        file_path = tool_call.input.get("file_path") if isinstance(tool_call.input, dict) else None
+        key = posixpath.normpath(file_path) if isinstance(file_path, str) else None
+        previous = self._tails.get(key) if key else None
+        task = asyncio.create_task(self._after(previous, tool_call))
+        self._previous[task] = previous
+        if key:
+            self._tails[key] = task
+        self._calls.append((tool_call, task))
+    
+    async def results(self) -> List[Tuple[Any, Tuple[str, bool, Optional[Dict[str, Any]]]]]:
+        """Wait for every call; returns (tool_call, result) pairs in submission order"""
+        if self._write is not None and self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_writes())
+        outcomes = await asyncio.gather(*(task for _, task in self._calls))
+        return [(tool_call, outcome) for (tool_call, _), outcome in zip(self._calls, outcomes)]
+    
+    @property
+    def submitted(self) -> int:
+        return len(self._calls)
+    
+    def cancel(self):
+        for _, task in self._calls:
+            task.cancel()
+        if self._flusher:
+            self._flusher.cancel()
+    
+    async def _after(self, previous: Optional[asyncio.Task], tool_call):
+        if previous is not None:
+            await asyncio.wait([previous])
+        if self._write is None or tool_call.name not in WRITE_TOOLS:
+            return await self._run(tool_call)
+        future = asyncio.get_running_loop().create_future()
+        self._held[asyncio.current_task()] = future
+        self._ready_writes.append((tool_call, future))
+        self._write_ready.set()
+        return await future
+    
+    def _stalled(self, task: asyncio.Task) -> bool:
+        """Whether a call is a held write or waiting (through its file's chain) on one"""
+        while task is not None and not task.done():
+            if task in self._held:
+                return not self._held[task].done()
+            task = self._previous.get(task)
+        return False
+    
+    async def _flush_writes(self):
+        """
+        Write the held writes in one call once every other call has finished
+        or is waiting on one of them; repeat until all calls are done.
+        """
+        while True:
+            pending = [task for _, task in self._calls if not task.done()]
+            if not pending:
+                return
+            running = [task for task in pending if not self._stalled(task)]
+            if running:
+                ready = asyncio.create_task(self._write_ready.wait())
+                try:
+                    await asyncio.wait([*running, ready], return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    ready.cancel()
+                self._write_ready.clear()
+                continue
+            
+            writes, self._ready_writes = self._ready_writes, []
+            try:
+                outcomes = await self._write([tool_call for tool_call, _ in writes])
+            except BaseException as e:
+                for _, future in writes:
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            for (_, future), outcome in zip(writes, outcomes):
+                if not future.done():
+                    future.set_result(outcome)
+
+
 class ClaudeCodeAnalyst:
     """
     True tools implementation - Claude can directly execute actions
@@ -18,17 +182,18 @@ class ClaudeCodeAnalyst:
         if not self.api_key:
             raise ValueError("ANTHROPIC_API_KEY not found in environment variables")
         
-        self.client = Anthropic(api_key=self.api_key)
+        self.client = get_shared_client(self.api_key)
+        
+        # Opt-in replay cache for identical model requests (see llm_cache.py)
+        self.response_cache = ResponseCache()
+        
+        # Retries, org rate limits, hedging and circuit breaking for every model call
+        self.resilience = ResilientCaller()
         
         # Model configuration
         self.model = "claude-3-5-sonnet-20241022"
         self.max_tokens = 4000
         
-        # Store file changes for execution
-        self.planned_files = []
-        self.analysis_result = {}
-        self.current_sandbox = None  # Store current sandbox reference
-        
         # Define tools that Claude can actually execute
         self.tools = [
             {
@@ -72,6 +237,19 @@ class ClaudeCodeAnalyst:
                     "required": ["file_path", "content", "description"]
                 }
             },
+            {
+                "name": "search_code",
+                "description": "Search the repository for code matching a query (identifiers, keywords). Returns ranked snippets with file paths and line ranges; use read_file for whole files.",
+                "input_schema": {
+                    "type": "object",
+                    "properties": {
+                        "query": {"type": "string"},
+                        "max_results": {"type": "integer"},
+                        "path_prefix": {"type": "string"}
+                    },
+                    "required": ["query"]
+                }
+            },
             {
                 "name": "read_file",
                 "description": "Read the contents of a file",
@@ -87,13 +265,14 @@ class ClaudeCodeAnalyst:
         
         print(f"Claude AI initialized with executable tools: {self.model}")
     
-    async def execute_coding_request(self, prompt: str, files_found: List[str], file_contents: Dict[str, str], sandbox) -> List[Dict[str, Any]]:
-        """
-        True tools approach - Claude analyzes, plans, and executes all in one workflow
+    async def execute_coding_request(self, session: CodingSession, files_found: List[str], file_contents: Dict[str, str]) -> List[Dict[str, Any]]:
         """
+        True tools approach - Claude analyzes, plans, and executes all in one workflow.
         
-        # Store sandbox reference for tool execution
-        self.current_sandbox = sandbox
+        All per-run state (sandbox, workspace, analysis) lives on the session,
+        so one analyst can serve many concurrent requests.
+        """
+        prompt = session.prompt
         
         codebase_summary = self._prepare_codebase_summary(files_found, file_contents)
         
@@ -115,181 +294,75 @@ For a Python calculator project, you should create:
 - utils.py (helper functions)
 - README.md (documentation)
 
-Always use multiple create_file tool calls - one for each file you need to create."""
+Always use multiple create_file tool calls - one for each file you need to create.
+Use search_code to find existing code instead of guessing file paths, then read_file only what you need.
+Tool calls in one response run concurrently, so issue all the files you already know you need at once.
+Make sure README.md documents the project (modify_file if it already exists).
+When the implementation is complete, reply with a short summary and no tool calls."""
 
+        system = [self._cacheable({"type": "text", "text": system_prompt})]
+        
+        # Every turn starts with tools, system prompt and this context block, in
+        # that order, so later turns read the whole prefix from the prompt cache
+        codebase_text = f"""Current codebase:
+FILES: {json.dumps(files_found, indent=2)}
+CONTENTS: {codebase_summary}"""
+        
+        # A cached analysis of this commit replaces the analyze_codebase turn
+        tools = self.tools
+        first_step = "First use analyze_codebase tool"
+        closing = "Start by analyzing the codebase, then create the files."
+        if session.analysis_cached:
+            codebase_text += f"\nANALYSIS (already done for this commit): {json.dumps(session.analysis_result)}"
+            tools = [tool for tool in self.tools if tool["name"] != "analyze_codebase"]
+            first_step = "The codebase is already analyzed (see ANALYSIS); do not analyze it again"
+            closing = "Start creating the files right away."
+        codebase_context = self._cacheable({"type": "text", "text": codebase_text})
+        
         user_prompt = f"""
         I need you to implement: "{prompt}"
 
-        Current codebase:
-        FILES: {json.dumps(files_found, indent=2)}
-        CONTENTS: {codebase_summary}
-
         REQUIREMENTS:
-        1. First use analyze_codebase tool
+        1. {first_step}
         2. Then use create_file tool MULTIPLE TIMES to create separate files
         3. Create at least 3-4 different files with proper separation of concerns
         4. Each file should have a specific purpose
         5. Include proper documentation and comments
 
-        Start by analyzing the codebase, then create multiple files one by one.
+        {closing}
         """
         
+        executed_changes = []
         try:
-            print(f"Sending request to Claude with {len(self.tools)} tools available")
-            
-            # First turn - let Claude analyze
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=self.max_tokens,
-                system=system_prompt,
-                tools=self.tools,
-                messages=[{"role": "user", "content": user_prompt}]
-            )
-            
-            print(f"Claude response received with {len(response.content)} content blocks")
-            
-            # Execute the tools Claude called in the first turn
-            executed_changes = []
-            messages = [{"role": "user", "content": user_prompt}]
-            
-            # Add assistant's response to conversation
-            assistant_content = []
-            for content_block in response.content:
-                if content_block.type == "text":
-                    assistant_content.append({"type": "text", "text": content_block.text})
-                elif content_block.type == "tool_use":
-                    assistant_content.append({
-                        "type": "tool_use",
-                        "id": content_block.id,
-                        "name": content_block.name,
-                        "input": content_block.input
-                    })
-                    
-                    # Execute the tool
-                    tool_result = await self._execute_tool(content_block, sandbox)
-                    if tool_result:
-                        executed_changes.append(tool_result)
+            print(f"Sending request to Claude with {len(tools)} tools available")
             
-            messages.append({"role": "assistant", "content": assistant_content})
+            messages = [{"role": "user", "content": [codebase_context, {"type": "text", "text": user_prompt}]}]
             
-            # Add tool results to conversation
-            tool_results = []
-            for content_block in response.content:
-                if content_block.type == "tool_use":
-                    if content_block.name == "analyze_codebase":
-                        tool_results.append({
-                            "type": "tool_result",
-                            "tool_use_id": content_block.id,
-                            "content": "Analysis complete. Now create the calculator files."
-                        })
-            
-            if tool_results:
-                messages.append({"role": "user", "content": tool_results})
-                
-                # Second turn - ask Claude to create the files
-                follow_up_response = self.client.messages.create(
-                    model=self.model,
-                    max_tokens=self.max_tokens,
-                    system=system_prompt,
-                    tools=self.tools,
-                    messages=messages + [{
-                        "role": "user", 
-                        "content": f"""Now create the actual implementation files for: "{prompt}"
-
-IMPORTANT: Create files with names that are RELEVANT to the request "{prompt}".
-
-For example:
-- If it's about FastAPI → create main.py, auth.py, models.py, routes.py
-- If it's about data science → create analysis.py, visualization.py, data_utils.py
-- If it's about React → create App.jsx, components.jsx, utils.js
-
-DO NOT create generic names like "calculator.py" unless specifically asked for a calculator.
-
-Create 3-4 files with appropriate names using the create_file tool multiple times."""
-                    }]
+            # Agentic loop: run the tools Claude asked for, send back their
+            # results, and stop as soon as it answers without calling a tool
+            for round_number in range(1, MAX_TOOL_ROUNDS + 1):
+                response, tool_results, round_changes = await self._stream_turn(
+                    session,
+                    f"round_{round_number}",
+                    system=system,
+                    tools=tools,
+                    messages=messages
                 )
+                executed_changes.extend(round_changes)
+                print(f"Round {round_number}: {len(response.content)} content blocks, {len(tool_results)} tool calls, stop reason {response.stop_reason}")
                 
-                print(f"Follow-up response received with {len(follow_up_response.content)} content blocks")
-                
-                # Execute tools from second turn
-                for content_block in follow_up_response.content:
-                    if content_block.type == "tool_use":
-                        print(f"Follow-up tool call: {content_block.name}")
-                        tool_result = await self._execute_tool(content_block, sandbox)
-                        if tool_result:
-                            executed_changes.append(tool_result)
-                
-                # Third turn if we still don't have enough Python files
-                python_files = [change for change in executed_changes if change.get('file_path', '').endswith('.py')]
-                created_files = [change.get('file_path', '') for change in executed_changes]
+                if response.stop_reason != "tool_use" or not tool_results:
+                    break
                 
-                print(f"Created files so far: {created_files}")
+                messages.append({"role": "assistant", "content": [self._content_param(block) for block in response.content]})
                 
-                if len(python_files) < 3:
-                    print(f"Only {len(python_files)} Python files created, requesting more relevant files...")
-                    
-                    # Ask Claude to create more files based on the original prompt
-                    additional_response = self.client.messages.create(
-                        model=self.model,
-                        max_tokens=self.max_tokens,
-                        tools=self.tools,
-                        messages=[{
-                            "role": "user", 
-                            "content": f"""You created {len(python_files)} files so far: {created_files}
-
-For the request: "{prompt}"
-
-Please create 2-3 MORE files that are specifically relevant to this request:
-1. Additional Python files with specific functionality
-2. A comprehensive README.md that explains the project, setup instructions, and usage
-
-Use create_file tool for each additional file with appropriate filenames and content.
-Don't repeat the files you already created."""
-                        }]
-                    )
-                    
-                    for content_block in additional_response.content:
-                        if content_block.type == "tool_use" and content_block.name == "create_file":
-                            print(f"Additional file tool call: {content_block.name}")
-                            tool_result = await self._execute_tool(content_block, sandbox)
-                            if tool_result:
-                                executed_changes.append(tool_result)
-                                print(f"Successfully created additional file: {tool_result['file_path']}")
-                
-                # Always ensure README is created/updated
-                readme_exists = any('README' in change.get('file_path', '').upper() for change in executed_changes)
-                if not readme_exists:
-                    print("No README found, creating comprehensive project documentation...")
-                    
-                    readme_response = self.client.messages.create(
-                        model=self.model,
-                        max_tokens=self.max_tokens,
-                        tools=self.tools,
-                        messages=[{
-                            "role": "user", 
-                            "content": f"""Update the existing README.md file for the project: "{prompt}"
-
-The README should completely replace the existing content with:
-- Project title and description  
-- Features implemented
-- Installation/setup instructions
-- Usage examples
-- File structure explanation
-- Requirements/dependencies
-
-Files created: {[change.get('file_path') for change in executed_changes]}
-
-Use the modify_file tool with file_path="README.md" to replace the entire README content."""
-                        }]
-                    )
-                    
-                    for content_block in readme_response.content:
-                        if content_block.type == "tool_use" and content_block.name in ["create_file", "modify_file"]:
-                            print(f"README update tool call: {content_block.name}")
-                            tool_result = await self._execute_tool(content_block, sandbox)
-                            if tool_result:
-                                executed_changes.append(tool_result)
-                                print(f"Successfully updated README: {tool_result['file_path']}")
+                # Move the rolling cache breakpoint to the newest tool result,
+                # so the next round reads the whole conversation so far from cache
+                if len(messages) > 2:
+                    messages[-2]["content"][-1].pop("cache_control", None)
+                messages.append({"role": "user", "content": tool_results[:-1] + [self._cacheable(tool_results[-1])]})
+            else:
+                print(f"Stopped after {MAX_TOOL_ROUNDS} tool rounds")
             
             print(f"Total executed changes: {len(executed_changes)}")
             
@@ -301,132 +374,379 @@ Use the modify_file tool with file_path="README.md" to replace the entire README
             return executed_changes
             
         except Exception as e:
+            # Only reached once the resilience layer has given up (or the
+            # circuit is open); keep whatever earlier rounds already wrote
+            session.llm_error = f"{type(e).__name__}: {e}"
             print(f"Claude tools execution error: {e}")
+            if isinstance(e, SideEffectsStartedError) and e.partial:
+                # Files the failed turn's tools wrote are in the workspace too
+                executed_changes.extend(e.partial)
+            if executed_changes:
+                print(f"Keeping {len(executed_changes)} changes from completed rounds")
+                return executed_changes
             return self._fallback_changes(prompt, {})
     
-    async def _execute_tool(self, tool_call, sandbox) -> Optional[Dict[str, Any]]:
-        """Execute a tool call that Claude made"""
+    async def _stream_turn(self, session: CodingSession, turn: str, **request) -> Tuple[Any, List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """
+        Run one model turn over the streaming API.
+        
+        Each tool_use block starts executing as soon as it finishes streaming
+        rather than after the whole response arrives; see ToolBatch for how
+        calls run concurrently. When the response cache is on and the request
+        was seen before, the cached response is replayed instead; otherwise
+        the call goes through the resilience layer (retries, org rate limits,
+        hedging and the circuit breaker, see resilience.py). Usage, cost and
+        timings are recorded on the session under the turn name, failed turns
+        included (see _record_turn). Returns the final message, the tool_result blocks
+        (in the order the model issued the calls) and the changes produced by
+        the executed tools.
+        """
+        if PROMPT_CACHE_ENABLED and request.get("tools"):
+            # A breakpoint on the last tool caches the tool schema on its own
+            request["tools"] = request["tools"][:-1] + [self._cacheable(dict(request["tools"][-1]))]
+        
+        started = time.perf_counter()
+        # Usage of every attempt the API started (retries and hedges included), see _close_stream
+        attempts = SimpleNamespace(usages=[], turn=None)
+        
+        # Identical requests (same model, prompt, tools and conversation) can be
+        # replayed from the response cache; their tool calls still run here
+        cache_key = None
+        cached = None
+        if self.response_cache.enabled:
+            if session.bypass_llm_cache:
+                self.response_cache.record_bypass()
+            else:
+                cache_key = request_key({"model": self.model, "max_tokens": self.max_tokens, **request})
+                cached = await self.response_cache.get(cache_key)
+        
+        batch = None
+        try:
+            if cached:
+                batch = ToolBatch(lambda tool_call: self._execute_tool(tool_call, session), lambda tool_calls: self._execute_writes(tool_calls, session))
+                response = message_from_dict(cached["message"])
+                first_token_ms = None
+                for content_block in response.content:
+                    if content_block.type == "tool_use":
+                        print(f"Replayed tool call: {content_block.name}")
+                        batch.submit(content_block)
+            else:
+                # Retried, rate limited and hedged as a whole; each attempt
+                # streams into its own batch, and an attempt that fails after
+                # its first tool call started is not retried (see _consume_stream)
+                response, first_token_ms, batch = await self.resilience.call(
+                    open=lambda: self._open_stream(request, attempts),
+                    consume=lambda opened: self._consume_stream(opened, session),
+                    discard=self._close_stream,
+                    estimated_tokens=estimate_tokens(json.dumps(request, default=str)) + self.max_tokens,
+                    usage=lambda result: self._billed_tokens(result[0].usage),
+                )
+                model_ms = (time.perf_counter() - started) * 1000
+            results = await batch.results()
+        except BaseException as e:
+            if batch:
+                batch.cancel()
+            if isinstance(e, Exception) or attempts.usages:
+                # The resilience layer gave up (or the turn was cancelled); the
+                # turn still counts, with whatever its attempts were billed
+                self._record_turn(session, turn, started, attempts=attempts, error=f"{type(e).__name__}: {e}")
+            raise
+        
+        if cache_key and not cached:
+            await self.response_cache.put(cache_key, response, model_ms)
+        
+        tool_results = []
+        executed_changes = []
+        for tool_call, (content, is_error, change) in results:
+            tool_result = {"type": "tool_result", "tool_use_id": tool_call.id, "content": content}
+            if is_error:
+                tool_result["is_error"] = True
+            tool_results.append(tool_result)
+            if change:
+                executed_changes.append(change)
         
+        self._record_turn(
+            session,
+            turn,
+            started,
+            cached=bool(cached),
+            response=response,
+            attempts=attempts,
+            first_token_ms=first_token_ms,
+            model_ms=0.0 if cached else model_ms,
+            tools=[tool_call.name for tool_call, _ in results]
+        )
+        
+        return response, tool_results, executed_changes
+    
+    def _record_turn(
+        self,
+        session: CodingSession,
+        turn: str,
+        started: float,
+        cached: bool = False,
+        response=None,
+        attempts: Optional[SimpleNamespace] = None,
+        first_token_ms: Optional[float] = None,
+        model_ms: Optional[float] = None,
+        tools: List[str] = None,
+        error: Optional[str] = None
+    ):
+        """
+        Append one turn's usage to session.llm_turns: tokens by kind summed
+        over every attempt the API billed (retries, hedges and attempts that
+        failed mid-stream included; a replayed turn is not billed), cost,
+        stop reason, time to first token, model time and wall time including
+        the turn's tools, with the wall-clock start so the turn can be placed
+        on a trace.
+        """
+        duration_ms = (time.perf_counter() - started) * 1000
+        started_at = time.time() - duration_ms / 1000
+        turn_usage = {
+            "turn": turn,
+            "model": self.model,
+            "cached": cached,
+            **{field: 0 for field in TOKEN_FIELDS},
+            "attempts": 0,
+            "stop_reason": response.stop_reason if response is not None else None,
+            "ttft_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+            "model_ms": round(model_ms if model_ms is not None else duration_ms, 1),
+            "started_at": started_at,
+            "duration_ms": round(duration_ms, 1),
+            "tools": tools or [],
+        }
+        turn_usage["cost_usd"] = 0.0
+        if attempts is not None and not cached:
+            for usage in attempts.usages:
+                self._add_usage(turn_usage, usage)
+            # An attempt closed after this (a late hedge) is added in place
+            attempts.turn = turn_usage
+        if error:
+            turn_usage["error"] = error
+        session.llm_turns.append(turn_usage)
+        print(f"Turn {turn}{' (replayed from response cache)' if cached else ''}{' failed' if error else ''}: {turn_usage['input_tokens']} input, {turn_usage['cache_read_input_tokens']} cache read, {turn_usage['cache_creation_input_tokens']} cache write, {turn_usage['output_tokens']} output tokens over {turn_usage['attempts']} attempt(s), ${turn_usage['cost_usd']:.4f}, TTFT {turn_usage['ttft_ms']}ms, model {turn_usage['model_ms']}ms")
+    
+    def _add_usage(self, turn_usage: Dict[str, Any], usage):
+        """Add one attempt's billed tokens to a turn record"""
+        for field in TOKEN_FIELDS:
+            turn_usage[field] += getattr(usage, field, None) or 0
+        turn_usage["attempts"] += 1
+        turn_usage["cost_usd"] = round(turn_cost(turn_usage), 6)
+    
+    async def _open_stream(self, request: Dict[str, Any], attempts: SimpleNamespace) -> SimpleNamespace:
+        """
+        Start streaming a response and read up to its first content delta.
+        
+        Nothing has side effects yet (tool calls are only submitted when their
+        block finishes), so the resilience layer can race a hedged request
+        against this one. The events read so far are kept for _consume_stream.
+        """
+        started = time.perf_counter()
+        manager = self.client.messages.stream(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            **request
+        )
+        opened = SimpleNamespace(manager=manager, stream=None, events=None, buffered=[], first_token_ms=None, attempts=attempts, closed=False)
+        try:
+            opened.stream = await manager.__aenter__()
+            opened.events = opened.stream.__aiter__()
+            async for event in opened.events:
+                opened.buffered.append(event)
+                if event.type == "content_block_delta":
+                    opened.first_token_ms = (time.perf_counter() - started) * 1000
+                    break
+        except BaseException:
+            await self._close_stream(opened)
+            raise
+        return opened
+    
+    async def _consume_stream(self, opened: SimpleNamespace, session: CodingSession) -> Tuple[Any, Optional[float], ToolBatch]:
+        """Read the rest of an opened stream, submitting each tool_use block to a new batch as it completes"""
+        batch = ToolBatch(lambda tool_call: self._execute_tool(tool_call, session), lambda tool_calls: self._execute_writes(tool_calls, session))
+        stream = opened.stream
+        
+        def handle(event):
+            if event.type != "content_block_stop":
+                return
+            content_block = stream.current_message_snapshot.content[event.index]
+            if content_block.type == "tool_use":
+                print(f"Streamed tool call: {content_block.name}")
+                batch.submit(content_block)
+        
+        try:
+            for event in opened.buffered:
+                handle(event)
+            async for event in opened.events:
+                handle(event)
+            response = await stream.get_final_message()
+        except Exception as e:
+            if not batch.submitted:
+                batch.cancel()
+                raise
+            # Tools already ran against the workspace: let the started ones
+            # finish and report their changes instead of retrying the turn,
+            # which could write different files next to these
+            results = await batch.results()
+            raise SideEffectsStartedError(e, [change for _, (_, _, change) in results if change]) from e
+        except BaseException:
+            batch.cancel()
+            raise
+        finally:
+            await self._close_stream(opened)
+        return response, opened.first_token_ms, batch
+    
+    async def _close_stream(self, opened: SimpleNamespace):
+        """Close a stream and count what it was billed, however far it got, toward its turn"""
+        if opened.closed:
+            return
+        opened.closed = True
+        try:
+            usage = opened.stream.current_message_snapshot.usage if opened.stream else None
+        except AssertionError:
+            # Ended before message_start: nothing was billed
+            usage = None
+        if usage is not None:
+            opened.attempts.usages.append(usage)
+            if opened.attempts.turn is not None:
+                self._add_usage(opened.attempts.turn, usage)
+        await opened.manager.__aexit__(None, None, None)
+    
+    def _billed_tokens(self, usage) -> int:
+        """Tokens a response counts against the org's tokens-per-minute limit (cache reads are exempt)"""
+        return usage.input_tokens + (getattr(usage, "cache_creation_input_tokens", None) or 0) + usage.output_tokens
+    
+    def _content_param(self, content_block) -> Dict[str, Any]:
+        """Convert a response content block back into a request content block"""
+        if content_block.type == "tool_use":
+            return {"type": "tool_use", "id": content_block.id, "name": content_block.name, "input": content_block.input}
+        return {"type": "text", "text": content_block.text}
+    
+    def _cacheable(self, block: Dict[str, Any]) -> Dict[str, Any]:
+        """Add a prompt cache breakpoint to a content block or tool definition"""
+        if PROMPT_CACHE_ENABLED:
+            block["cache_control"] = {"type": "ephemeral"}
+        return block
+    
+    def _file_change(self, tool_call) -> Dict[str, Any]:
+        """Build the change record for a create_file/modify_file tool call"""
         tool_name = tool_call.name
-        tool_input = tool_call.input
+        file_path = tool_call.input["file_path"]
+        content = tool_call.input["content"]
+        verb = "created" if tool_name == "create_file" else "modified"
         
-        print(f"Executing tool: {tool_name} with input: {list(tool_input.keys())}")
+        print(f"Claude {'creating' if tool_name == 'create_file' else 'modifying'} file: {file_path} ({len(content)} chars)")
         
-        if tool_name == "analyze_codebase":
-            # Store analysis for later use
-            self.analysis_result = tool_input
-            print(f"Claude analyzed project: {tool_input.get('project_type')} in {tool_input.get('primary_language')}")
-            return None
-            
-        elif tool_name == "create_file":
-            file_path = tool_input["file_path"]
-            content = tool_input["content"]
-            description = tool_input["description"]
-            
-            print(f"Claude creating file: {file_path} ({len(content)} chars)")
-            
-            # Actually create the file using sandbox
-            workspace_id = getattr(sandbox, 'workspace_id', 'default')
-            try:
-                async for update in sandbox.write_file(file_path, content, workspace_id):
-                    print(f"Sandbox write update: {update[:100]}...")
-                print(f"Successfully created file: {file_path}")
-            except Exception as e:
-                print(f"Error creating file {file_path}: {e}")
-                return None
-            
-            return {
-                "type": "create_file",
-                "file_path": file_path,
-                "description": description,
-                "reasoning": f"Claude created {file_path} using tools",
-                "content": content,
-                "priority": "high"
-            }
-            
-        elif tool_name == "modify_file":
-            file_path = tool_input["file_path"] 
-            content = tool_input["content"]
-            description = tool_input["description"]
-            
-            print(f"Claude modifying file: {file_path} ({len(content)} chars)")
-            
-            # Actually modify the file using sandbox
-            workspace_id = getattr(sandbox, 'workspace_id', 'default')
+        return {
+            "type": tool_name,
+            "file_path": file_path,
+            "description": tool_call.input["description"],
+            "reasoning": f"Claude {verb} {file_path} using tools",
+            "content": content,
+            "priority": "high"
+        }
+    
+    async def _write_changes(self, session: CodingSession, changes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Write a batch of file changes in one sandbox call; returns the ones that succeeded"""
+        # Later writes to the same path win
+        files = {change["file_path"]: change["content"] for change in changes}
+        if not files:
+            return []
+        failed = set()
+        
+        try:
+            async for event in session.sandbox.write_files(files, session.workspace_id):
+                print(f"Sandbox write update: {event}")
+                if event.type == "error":
+                    failed.add(event.get("file"))
+        except Exception as e:
+            print(f"Error writing files {list(files)}: {e}")
+            return []
+        
+        written = [change for change in changes if change["file_path"] not in failed]
+        print(f"Successfully wrote {len(files) - len(failed)} of {len(files)} files")
+        return written
+    
+    async def _execute_writes(self, tool_calls: List[Any], session: CodingSession) -> List[Tuple[str, bool, Optional[Dict[str, Any]]]]:
+        """
+        Execute a batch of create_file/modify_file tool calls with one
+        sandbox write; returns a tool result per call, as _execute_tool does.
+        """
+        changes = []
+        for tool_call in tool_calls:
             try:
-                async for update in sandbox.write_file(file_path, content, workspace_id):
-                    print(f"Sandbox modify update: {update[:100]}...")
-                print(f"Successfully modified file: {file_path}")
+                changes.append(self._file_change(tool_call))
             except Exception as e:
-                print(f"Error modifying file {file_path}: {e}")
-                return None
+                print(f"Error executing tool {tool_call.name}: {e}")
+                changes.append(e)
+        
+        written = await self._write_changes(session, [change for change in changes if isinstance(change, dict)])
+        written_ids = {id(change) for change in written}
+        
+        outcomes = []
+        for tool_call, change in zip(tool_calls, changes):
+            if isinstance(change, Exception):
+                outcomes.append((f"{tool_call.name} failed: {change}", True, None))
+            elif id(change) not in written_ids:
+                outcomes.append((f"Failed to write {change['file_path']}", True, None))
+            else:
+                outcomes.append((f"Wrote {change['file_path']} ({len(change['content'])} chars)", False, change))
+        return outcomes
+    
+    async def _execute_tool(self, tool_call, session: CodingSession) -> Tuple[str, bool, Optional[Dict[str, Any]]]:
+        """
+        Execute a tool call that Claude made against the session's sandbox
+        (file writes go through _execute_writes instead).
+        
+        Returns the tool_result content for Claude, whether it is an error,
+        and the change record when a file was written (always None here).
+        """
+        tool_name = tool_call.name
+        tool_input = tool_call.input
+        sandbox = session.sandbox
+        workspace_id = session.workspace_id
+        
+        print(f"Executing tool: {tool_name} with input: {list(tool_input.keys())}")
+        
+        try:
+            if tool_name == "analyze_codebase":
+                # Store analysis for later use
+                session.analysis_result = tool_input
+                print(f"Claude analyzed project: {tool_input.get('project_type')} in {tool_input.get('primary_language')}")
+                return "Analysis recorded.", False, None
                 
-            return {
-                "type": "modify_file",
-                "file_path": file_path,
-                "description": description,
-                "reasoning": f"Claude modified {file_path} using tools",
-                "content": content,
-                "priority": "high"
-            }
-            
-        elif tool_name == "read_file":
-            file_path = tool_input["file_path"]
-            
-            # Read file using sandbox
-            workspace_id = getattr(sandbox, 'workspace_id', 'default')
-            try:
+            elif tool_name == "search_code":
+                results = await sandbox.search_code(tool_input["query"], workspace_id, min(int(tool_input.get("max_results") or 8), 20), tool_input.get("path_prefix"))
+                print(f"Claude searched code: {tool_input['query']!r} ({len(results)} results)")
+                if not results:
+                    return f"No matches for {tool_input['query']!r}", False, None
+                return "\n\n".join(f"{result['path']}:{result['start_line']}-{result['end_line']} (score {result['score']})\n{result['snippet']}" for result in results), False, None
+                
+            elif tool_name == "read_file":
+                file_path = tool_input["file_path"]
                 content = await sandbox.read_file(file_path, workspace_id)
                 print(f"Claude read file: {file_path} ({len(content)} chars)")
-            except Exception as e:
-                print(f"Error reading file {file_path}: {e}")
-            
-            return None  # Reading doesn't create a change
-            
-        return None
-    
-    # Backward compatibility methods for agent.py
-    async def analyze_codebase_with_tools(self, files_found: List[str], file_contents: Dict[str, str]) -> Dict[str, Any]:
-        """Backward compatibility - use the new tools approach"""
-        # This will be called by the new execute_coding_request method
-        return self.analysis_result or self._fallback_analysis(files_found)
-    
-    async def plan_code_changes_with_tools(self, prompt: str, analysis: Dict[str, Any], file_contents: Dict[str, str]) -> List[Dict[str, Any]]:
-        """Backward compatibility - files are already created by tools"""
-        return self.planned_files or self._fallback_changes(prompt, analysis)
+                if len(content) > MAX_TOOL_RESULT_CHARS:
+                    content = content[:MAX_TOOL_RESULT_CHARS] + f"\n... (truncated, {len(content)} chars total) ..."
+                return content, False, None
+        except Exception as e:
+            print(f"Error executing tool {tool_name}: {e}")
+            return f"{tool_name} failed: {e}", True, None
+        
+        return f"Unknown tool: {tool_name}", True, None
     
     def _prepare_codebase_summary(self, files: List[str], contents: Dict[str, str]) -> str:
-        """Prepare a concise summary of the codebase for Claude"""
+        """
+        Render the codebase contents for Claude. The contents are already
+        ranked and fitted to the token budget by context_packer.pack_context.
+        """
         summary = []
         
-        for file_path in files[:10]:
-            if file_path in contents:
-                content = contents[file_path]
-                if len(content) > 1000:
-                    content = content[:500] + "\n... (truncated) ..."
-                summary.append(f"=== {file_path} ===\n{content}\n")
+        for file_path in contents:
+            summary.append(f"=== {file_path} ===\n{contents[file_path]}\n")
         
         return "\n".join(summary)
     
-    def _fallback_analysis(self, files: List[str]) -> Dict[str, Any]:
-        """Fallback analysis when Claude tools fail"""
-        languages = set()
-        for file in files:
-            if file.endswith('.py'):
-                languages.add('python')
-            elif file.endswith('.js'):
-                languages.add('javascript')
-            elif file.endswith('.ts'):
-                languages.add('typescript')
-        
-        return {
-            "project_type": "script",
-            "primary_language": list(languages)[0] if languages else "unknown",
-            "frameworks": [],
-            "complexity_level": "simple",
-            "insights": "Simple project structure detected"
-        }
-    
     def _fallback_changes(self, prompt: str, analysis: Dict[str, Any]) -> List[Dict[str, Any]]:
         """Smart fallback changes that create files based on the actual prompt"""
         
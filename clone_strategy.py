@@ -0,0 +1,137 @@
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+import httpx
+
+CLONE_MODES = ("full", "shallow", "blobless", "treeless", "sparse", "auto")
+
+# Repo size thresholds (KB, as reported by the GitHub API) for auto selection
+AUTO_FULL_MAX_KB = int(os.getenv("CLONE_AUTO_FULL_MAX_KB", "50000"))
+AUTO_BLOBLESS_MAX_KB = int(os.getenv("CLONE_AUTO_BLOBLESS_MAX_KB", "1000000"))
+# Seconds a looked-up repo size is reused (failed lookups are retried sooner),
+# so auto selection does not call the GitHub API on every request
+CLONE_SIZE_CACHE_TTL = float(os.getenv("CLONE_SIZE_CACHE_TTL", "3600"))
+CLONE_SIZE_FAILURE_TTL = 300.0
+
+# repo key -> (size in KB or None, expiry time)
+_size_cache: Dict[str, Tuple[Optional[int], float]] = {}
+
+
+class CloneStrategy:
+    """
+    How a repository is cloned into a sandbox.
+
+    - full: complete history and blobs (previous behaviour)
+    - shallow: only the last `depth` commits of the default branch
+    - blobless: all commits and trees, blobs fetched lazily (--filter=blob:none)
+    - treeless: all commits, trees and blobs fetched lazily (--filter=tree:0)
+    - sparse: blobless clone with a checkout limited to `sparse_paths`
+    - auto: pick one of the above from the repository size
+    """
+
+    def __init__(self, mode: str = None, depth: int = None, sparse_paths: Optional[List[str]] = None):
+        self.mode = (mode or os.getenv("CLONE_STRATEGY", "auto")).lower()
+        if self.mode not in CLONE_MODES:
+            raise ValueError(f"Unknown clone strategy '{self.mode}', expected one of {', '.join(CLONE_MODES)}")
+        if depth is not None and (not isinstance(depth, int) or depth < 1):
+            raise ValueError(f"Clone depth must be a positive integer, got {depth!r}")
+        self.depth = depth or int(os.getenv("CLONE_DEPTH", "1"))
+        self.sparse_paths = [p.strip('/') for p in (sparse_paths or []) if p.strip('/')]
+        if self.mode == "sparse" and not self.sparse_paths:
+            raise ValueError("Sparse clone strategy requires at least one path")
+        if self.sparse_paths and self.mode not in ("sparse", "auto"):
+            raise ValueError(f"Sparse paths only apply to the sparse or auto clone strategy, not '{self.mode}'")
+
+    @property
+    def is_sparse(self) -> bool:
+        return self.mode == "sparse"
+
+    def clone_args(self) -> List[str]:
+        """Extra `git clone` flags for this strategy"""
+        if self.mode == "shallow":
+            return ["--depth", str(self.depth), "--single-branch", "--no-tags"]
+        if self.mode == "blobless":
+            return ["--filter=blob:none"]
+        if self.mode == "treeless":
+            return ["--filter=tree:0"]
+        if self.mode == "sparse":
+            return ["--filter=blob:none", "--sparse"]
+        return []
+
+    def sparse_checkout_args(self) -> List[str]:
+        """`git` arguments that restrict the checkout to sparse_paths (empty if not sparse)"""
+        if not self.is_sparse:
+            return []
+        return ["sparse-checkout", "set", *self.sparse_paths]
+
+    def describe(self) -> str:
+        if self.mode == "shallow":
+            return f"shallow (depth {self.depth})"
+        if self.mode == "sparse":
+            return f"sparse ({', '.join(self.sparse_paths)})"
+        return self.mode
+
+    def for_mirror_copy(self) -> "CloneStrategy":
+        """
+        The strategy a copy of a full local mirror actually gets: history and
+        blobs are always complete, so only sparse paths still apply.
+        """
+        if self.sparse_paths:
+            return CloneStrategy("sparse", self.depth, self.sparse_paths)
+        return CloneStrategy("full", self.depth)
+
+    async def resolve(self, repo_url: str) -> "CloneStrategy":
+        """Return a concrete strategy, choosing one from the repo size when mode is auto"""
+        if self.mode != "auto":
+            return self
+        if self.sparse_paths:
+            # Only a sparse clone honours the paths, whatever the repo size
+            return CloneStrategy("sparse", self.depth, self.sparse_paths)
+
+        size_kb = await repo_size_kb(repo_url)
+        if size_kb is None:
+            # Unknown size: partial clone is cheap and still has full history
+            mode = "blobless"
+        elif size_kb <= AUTO_FULL_MAX_KB:
+            mode = "full"
+        elif size_kb <= AUTO_BLOBLESS_MAX_KB:
+            mode = "blobless"
+        else:
+            mode = "treeless"
+
+        print(f"Auto clone strategy for {repo_url}: {mode} (size: {size_kb if size_kb is not None else 'unknown'} KB)")
+        return CloneStrategy(mode, self.depth)
+
+
+async def repo_size_kb(repo_url: str) -> Optional[int]:
+    """fetch_github_repo_size_kb, remembered per repository for CLONE_SIZE_CACHE_TTL"""
+    key = repo_url.rstrip('/').removesuffix('.git').lower()
+    cached = _size_cache.get(key)
+    if cached and cached[1] > time.time():
+        return cached[0]
+
+    size_kb = await fetch_github_repo_size_kb(repo_url)
+    ttl = CLONE_SIZE_CACHE_TTL if size_kb is not None else CLONE_SIZE_FAILURE_TTL
+    _size_cache[key] = (size_kb, time.time() + ttl)
+    return size_kb
+
+
+async def fetch_github_repo_size_kb(repo_url: str) -> Optional[int]:
+    """Look up a GitHub repository's size in KB, or None if it cannot be determined"""
+    parts = repo_url.rstrip('/').replace('.git', '').split('/')
+    if len(parts) < 2 or "github.com" not in repo_url:
+        return None
+
+    headers = {"Accept": "application/vnd.github+json"}
+    token = os.getenv("GITHUB_TOKEN")
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    try:
+        async with httpx.AsyncClient(timeout=3.0) as client:
+            response = await client.get(f"https://api.github.com/repos/{parts[-2]}/{parts[-1]}", headers=headers)
+        if response.status_code != 200:
+            return None
+        return int(response.json().get("size", 0))
+    except Exception:
+        return None
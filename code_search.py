@@ -0,0 +1,219 @@
+"""
+BM25 code search over a checkout.
+
+Like manifest.py this module is stdlib-only and self-contained: LocalSandbox
+keeps a CodeIndex in memory per workspace, and ModalSandbox ships this
+file's source into the sandbox, builds the index there once after the clone
+and saves it to disk so every search is a single exec round trip. The
+serialized index (to_bytes) does not depend on either module, so it can be
+cached across requests and restored into another checkout of the same
+commit.
+
+Files come from `git ls-files` (tracked plus untracked-but-not-ignored, so
+.gitignore is respected); binary and very large files are skipped. Each
+file is split into overlapping line windows, and a query is ranked over
+those windows with BM25 on identifier tokens (snake_case and camelCase
+names are also indexed by their parts). Files written after the build are
+re-indexed with refresh(), so hits keep matching the live text.
+"""
+import os
+import re
+import math
+import pickle
+import subprocess
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+CHUNK_LINES = 40
+CHUNK_OVERLAP = 10
+SNIPPET_LINES = 20
+MAX_FILE_BYTES = 1024 * 1024
+BINARY_SNIFF_BYTES = 8000
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[0-9]+")
+_CAMEL_PART = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase identifier tokens, plus the parts of snake_case and camelCase names"""
+    tokens = []
+    for identifier in _IDENTIFIER.findall(text):
+        lower = identifier.lower()
+        tokens.append(lower)
+        parts = [part.lower() for piece in identifier.split("_") for part in _CAMEL_PART.findall(piece)]
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if len(part) > 1 and part != lower)
+    return tokens
+
+
+def list_files(root: str) -> List[str]:
+    """Tracked and untracked-but-not-ignored files, or a filesystem walk outside git"""
+    try:
+        output = subprocess.run(
+            ["git", "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+            cwd=root, capture_output=True, check=True
+        ).stdout.decode("utf-8", errors="replace")
+        return sorted(set(path for path in output.split("\0") if path))
+    except (OSError, subprocess.CalledProcessError):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d != ".git"]
+            for filename in filenames:
+                paths.append(os.path.relpath(os.path.join(dirpath, filename), root))
+        return sorted(paths)
+
+
+class CodeIndex:
+    """Inverted index from tokens to line-window chunks, ranked with BM25"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files = 0
+        self.skipped = 0
+        # (path, first line, last line) per chunk, 1-based and inclusive
+        self.chunks: List[Tuple[str, int, int]] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        # Chunks of files that were re-indexed since (see refresh)
+        self.retired: Set[int] = set()
+
+    @classmethod
+    def build(cls, root: str = ".", max_files: int = 50000) -> "CodeIndex":
+        index = cls(root)
+        for path in list_files(root)[:max_files]:
+            text = index._read(path)
+            if text is None:
+                index.skipped += 1
+                continue
+            index.files += 1
+            index._add_file(path, text)
+        return index
+
+    def refresh(self, paths: List[str]):
+        """
+        Re-index files that changed since the build: their old chunks are
+        retired and the current text is indexed again, so search results
+        (line ranges and snippets) match what is on disk now.
+        """
+        paths = set(paths)
+        for chunk_id, (path, _, _) in enumerate(self.chunks):
+            if path in paths:
+                self.retired.add(chunk_id)
+        for path in sorted(paths):
+            text = self._read(path)
+            if text is not None:
+                self._add_file(path, text)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"files": self.files, "skipped": self.skipped, "chunks": len(self.chunks), "terms": len(self.postings)}
+
+    def search(self, query: str, limit: int = 10, path_prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Best-matching snippets for a query: path, line range, score and the
+        snippet text (with line numbers). Overlapping windows of one file are
+        merged into the higher-ranked result.
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.chunks:
+            return []
+
+        scores: Dict[int, float] = {}
+        average_length = sum(self.lengths) / len(self.lengths)
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.chunks) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, frequency in postings:
+                if chunk_id in self.retired:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk_id] / average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+        results = []
+        taken: Dict[str, List[Tuple[int, int]]] = {}
+        for chunk_id in sorted(scores, key=lambda chunk_id: (-scores[chunk_id], chunk_id)):
+            path, start, end = self.chunks[chunk_id]
+            if path_prefix and not path.startswith(path_prefix):
+                continue
+            if any(start <= taken_end and taken_start <= end for taken_start, taken_end in taken.get(path, [])):
+                continue
+            snippet = self._snippet(path, start, end, terms)
+            if snippet is None:
+                continue
+            taken.setdefault(path, []).append((start, end))
+            results.append({"path": path, "start_line": snippet[0], "end_line": snippet[1], "score": round(scores[chunk_id], 3), "snippet": snippet[2]})
+            if len(results) >= limit:
+                break
+        return results
+
+    def to_bytes(self) -> bytes:
+        """Serialize the index without its root, so it can be restored into another checkout"""
+        state = {"files": self.files, "skipped": self.skipped, "chunks": self.chunks, "lengths": self.lengths, "postings": self.postings, "retired": self.retired}
+        return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, root: str = ".") -> "CodeIndex":
+        index = cls(root)
+        for name, value in pickle.loads(data).items():
+            setattr(index, name, value)
+        return index
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path: str, root: str = ".") -> "CodeIndex":
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read(), root)
+
+    def _read(self, path: str) -> Optional[str]:
+        full_path = os.path.join(self.root, path)
+        try:
+            if not os.path.isfile(full_path) or os.path.getsize(full_path) > MAX_FILE_BYTES:
+                return None
+            with open(full_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if b"\0" in data[:BINARY_SNIFF_BYTES]:
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def _add_file(self, path: str, text: str):
+        lines = text.splitlines()
+        # The path itself is searchable, through the first chunk of the file
+        path_tokens = tokenize(path)
+        step = CHUNK_LINES - CHUNK_OVERLAP
+        for offset in range(0, max(1, len(lines)), step):
+            window = lines[offset:offset + CHUNK_LINES]
+            counts = Counter(tokenize("\n".join(window)))
+            if offset == 0:
+                counts.update(path_tokens)
+            if not counts:
+                continue
+            chunk_id = len(self.chunks)
+            self.chunks.append((path, offset + 1, offset + max(1, len(window))))
+            self.lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, []).append((chunk_id, frequency))
+            if offset + CHUNK_LINES >= len(lines):
+                break
+
+    def _snippet(self, path: str, start: int, end: int, terms: set) -> Optional[Tuple[int, int, str]]:
+        """The SNIPPET_LINES of a chunk around its best-matching line"""
+        text = self._read(path)
+        if text is None:
+            return None
+        lines = text.splitlines()[start - 1:end]
+        if not lines:
+            return start, start, ""
+        hits = [len(terms.intersection(tokenize(line))) for line in lines]
+        best = max(range(len(lines)), key=lambda i: (hits[i], -i))
+        first = max(0, min(best - SNIPPET_LINES // 4, len(lines) - SNIPPET_LINES))
+        window = lines[first:first + SNIPPET_LINES]
+        numbered = "\n".join(f"{start + first + i:>5}| {line}" for i, line in enumerate(window))
+        return start + first, start + first + len(window) - 1, numbered
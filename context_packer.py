@@ -0,0 +1,204 @@
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, List
+from manifest import KEY_FILE_NAMES, LANGUAGES
+
+# Token budget for the codebase context sent with every Claude turn
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "12000"))
+# Highest-ranked files whose contents are read and considered for packing
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "30"))
+# Files larger than this are listed but never read
+CONTEXT_MAX_FILE_BYTES = 200 * 1024
+# A file that does not fit whole is cut to an excerpt if this many tokens are left
+MIN_EXCERPT_TOKENS = 200
+# Excluded files listed individually in the report (the rest are only counted)
+REPORT_EXCLUDED = 50
+
+CONFIG_FILE_NAMES = (
+    "pyproject.toml", "requirements.txt", "setup.cfg", "tsconfig.json", "dockerfile",
+    "docker-compose.yml", "makefile", "go.mod", "cargo.toml", ".env.example",
+)
+LOCK_FILE_NAMES = ("package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "cargo.lock", "go.sum")
+LOW_VALUE_DIRS = ("test", "tests", "spec", "__tests__", "fixtures", "vendor", "node_modules", "dist", "build", "migrations")
+STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "into", "add", "make", "use", "using",
+    "should", "would", "could", "please", "implement", "create", "update", "new", "all", "some",
+    "can", "are", "was", "will", "have", "has", "not", "but", "its", "our", "your", "when", "then",
+}
+
+
+def prompt_keywords(prompt: str) -> List[str]:
+    """Distinct lowercase words from the prompt worth matching against paths and contents"""
+    keywords = []
+    for word in re.findall(r"[a-z0-9]+", _split_camel(prompt).lower()):
+        if len(word) >= 3 and word not in STOPWORDS and word not in keywords:
+            keywords.append(word)
+    return keywords
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)"""
+    return len(text) // 4 + 1
+
+
+def score_path(path: str, keywords: List[str]) -> float:
+    """Relevance of a file from its path alone; higher is more relevant"""
+    lower = path.lower()
+    name = os.path.basename(lower)
+    parts = re.findall(r"[a-z0-9]+", _split_camel(path).lower())
+    score = 0.0
+
+    for keyword in keywords:
+        if any(_matches(part, keyword) for part in parts):
+            score += 10
+        elif keyword in lower:
+            score += 4
+
+    if name in KEY_FILE_NAMES:
+        score += 8
+    elif name in CONFIG_FILE_NAMES:
+        score += 5
+    if name in LOCK_FILE_NAMES or name.endswith((".min.js", ".map")):
+        score -= 50
+    if "test" not in keywords and any(part in LOW_VALUE_DIRS for part in lower.split("/")[:-1]):
+        score -= 15
+    if os.path.splitext(lower)[1] not in LANGUAGES and name not in CONFIG_FILE_NAMES:
+        score -= 20
+
+    return score - 2 * path.count("/")
+
+
+def score_content(content: str, keywords: List[str]) -> float:
+    """Extra relevance for prompt keywords that appear in a file's contents"""
+    lower = content.lower()
+    return sum(3 for keyword in keywords if keyword in lower)
+
+
+class ContextPack:
+    """
+    The codebase context chosen for a prompt, and the report of what was
+    left out.
+
+    paths lists files most relevant first; contents maps the included ones
+    to their (possibly excerpted) text. included/excluded record every
+    decision with its score, token cost and reason, so the budget can be
+    tuned against latency.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.tokens = 0
+        self.paths: List[str] = []
+        self.contents: Dict[str, str] = {}
+        # Full text of every file considered, reusable for the same commit
+        self.read: Dict[str, str] = {}
+        self.included: List[Dict[str, Any]] = []
+        self.excluded: List[Dict[str, Any]] = []
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "budget_tokens": self.budget,
+            "used_tokens": self.tokens,
+            "included": self.included,
+            "excluded": self.excluded[:REPORT_EXCLUDED],
+            "excluded_count": len(self.excluded),
+        }
+
+
+async def pack_context(
+    manifest: Dict[str, Any],
+    prompt: str,
+    read_files: Callable[[List[str]], Awaitable[Dict[str, str]]],
+    budget: int = None,
+    candidates: int = None,
+    list_paths: int = 20
+) -> ContextPack:
+    """
+    Rank the manifest's files by relevance to the prompt and fill a token budget.
+
+    Paths are scored by prompt keyword matches and entrypoint/config
+    heuristics; the top candidates not already in the manifest are read in
+    one read_files call and re-scored by their contents. Files are then
+    added most relevant first while they fit: a file that does not fit is
+    excerpted when enough budget is left, otherwise excluded. The first
+    list_paths ranked paths are listed (and charged to the budget) up front.
+    """
+    budget = budget if budget is not None else CONTEXT_TOKEN_BUDGET
+    candidates = candidates if candidates is not None else CONTEXT_CANDIDATES
+    keywords = prompt_keywords(prompt)
+    pack = ContextPack(budget)
+
+    ranked = []
+    for entry in manifest["files"]:
+        if entry["binary"]:
+            pack.excluded.append({"path": entry["path"], "reason": "binary"})
+            continue
+        ranked.append((score_path(entry["path"], keywords), entry))
+    ranked.sort(key=lambda item: (-item[0], item[1]["path"]))
+
+    pack.paths = [entry["path"] for _, entry in ranked]
+    pack.tokens = estimate_tokens("\n".join(pack.paths[:list_paths]))
+
+    contents = dict(manifest.get("contents", {}))
+    to_read = []
+    for score, entry in ranked[:candidates]:
+        if entry["path"] in contents:
+            continue
+        if entry["size"] is not None and entry["size"] > CONTEXT_MAX_FILE_BYTES:
+            continue
+        to_read.append(entry["path"])
+    if to_read:
+        contents.update(await read_files(to_read))
+    pack.read = contents
+
+    scored = []
+    for score, entry in ranked:
+        path = entry["path"]
+        if path not in contents:
+            reason = "too_large" if entry["size"] and entry["size"] > CONTEXT_MAX_FILE_BYTES else "not_read"
+            pack.excluded.append({"path": path, "score": score, "reason": reason})
+            continue
+        scored.append((score + score_content(contents[path], keywords), path))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+
+    for score, path in scored:
+        content = contents[path]
+        tokens = estimate_tokens(f"=== {path} ===\n{content}\n")
+        remaining = budget - pack.tokens
+        if tokens <= remaining:
+            pack.contents[path] = content
+            pack.included.append({"path": path, "score": score, "tokens": tokens, "excerpt": False})
+        elif remaining >= MIN_EXCERPT_TOKENS:
+            excerpt = _excerpt(content, (remaining - estimate_tokens(f"=== {path} ===\n")) * 4)
+            tokens = estimate_tokens(f"=== {path} ===\n{excerpt}\n")
+            pack.contents[path] = excerpt
+            pack.included.append({"path": path, "score": score, "tokens": tokens, "excerpt": True, "original_tokens": estimate_tokens(content)})
+        else:
+            pack.excluded.append({"path": path, "score": score, "tokens": tokens, "reason": "budget"})
+            continue
+        pack.tokens += tokens
+
+    # Listed paths follow the packed files, then the rest by path score
+    included = [item["path"] for item in pack.included]
+    pack.paths = included + [path for path in pack.paths if path not in pack.contents]
+    return pack
+
+
+def _excerpt(content: str, max_chars: int) -> str:
+    """The head of a file, cut at a line boundary, with a truncation marker"""
+    marker = "\n... (truncated) ..."
+    head = content[:max(0, max_chars - len(marker))]
+    if "\n" in head:
+        head = head[:head.rindex("\n")]
+    return head + marker
+
+
+def _split_camel(text: str) -> str:
+    return re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+
+
+def _matches(part: str, keyword: str) -> bool:
+    if part == keyword:
+        return True
+    # auth ~ authentication, route ~ routes
+    return len(part) >= 3 and len(keyword) >= 3 and (keyword.startswith(part) or part.startswith(keyword))
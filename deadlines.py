@@ -0,0 +1,62 @@
+import os
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Wall-clock budget per pipeline phase, in seconds
+PHASE_TIMEOUTS = {
+    "clone": float(os.getenv("PHASE_TIMEOUT_CLONE", "300")),
+    "analysis": float(os.getenv("PHASE_TIMEOUT_ANALYSIS", "60")),
+    "llm": float(os.getenv("PHASE_TIMEOUT_LLM", "600")),
+    "push": float(os.getenv("PHASE_TIMEOUT_PUSH", "180")),
+}
+
+# Default limit for a single sandbox command
+COMMAND_TIMEOUT = float(os.getenv("COMMAND_TIMEOUT", "120"))
+
+
+class PhaseTimeoutError(Exception):
+    """Raised when a pipeline phase runs past its deadline"""
+
+    def __init__(self, phase: str, timeout: float):
+        super().__init__(f"Phase '{phase}' exceeded its {timeout:g}s deadline")
+        self.phase = phase
+        self.timeout = timeout
+
+
+def remaining(deadline: Optional[float]) -> Optional[float]:
+    """Seconds left until a loop-time deadline (None means no deadline)"""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - asyncio.get_running_loop().time())
+
+
+async def iterate_with_deadline(source: AsyncIterator[T], phase: str, timeout: float = None) -> AsyncGenerator[T, None]:
+    """
+    Re-yield items from an async generator, raising PhaseTimeoutError once the
+    phase deadline passes. The source is cancelled at its current await point,
+    so its own cleanup (killing processes, closing streams) runs immediately.
+    """
+    timeout = timeout if timeout is not None else PHASE_TIMEOUTS[phase]
+    deadline = asyncio.get_running_loop().time() + timeout
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(source.__anext__(), remaining(deadline))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise PhaseTimeoutError(phase, timeout)
+            yield item
+    finally:
+        await source.aclose()
+
+
+async def run_with_deadline(awaitable, phase: str, timeout: float = None):
+    """Await a coroutine under the phase deadline, cancelling it on expiry"""
+    timeout = timeout if timeout is not None else PHASE_TIMEOUTS[phase]
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise PhaseTimeoutError(phase, timeout)
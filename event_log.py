@@ -0,0 +1,202 @@
+import os
+import asyncio
+from typing import AsyncIterator, List, Optional, Tuple
+from events import Event
+from sse import SSE_COALESCE_MS, SSEEncoder, encode_frame
+
+# In-memory replay buffer per session, in bytes of encoded frames
+STREAM_BUFFER_BYTES = int(os.getenv("STREAM_BUFFER_BYTES", str(4 * 1024 * 1024)))
+# Directory for frames evicted from the buffer (empty disables spilling)
+STREAM_SPILL_DIR = os.getenv("STREAM_SPILL_DIR", "")
+# How long a finished session stays available for reconnects
+STREAM_RETENTION_SECONDS = float(os.getenv("STREAM_RETENTION_SECONDS", "600"))
+
+
+class SessionEventLog:
+    """
+    Replayable event history for one session.
+
+    Every event is encoded once, with a per-session monotonic id, and kept in
+    a bounded in-memory buffer. Frames pushed out of the buffer are appended
+    to a spill file when a spill directory is configured, so a reconnecting
+    client can still be replayed from the start; otherwise it is told how
+    many events it missed.
+    """
+
+    def __init__(self, session_id: str, max_bytes: int = None, spill_dir: str = None):
+        self.session_id = session_id
+        self.max_bytes = max_bytes if max_bytes is not None else STREAM_BUFFER_BYTES
+        self.encoder = SSEEncoder()
+        self.done = False
+
+        # Buffered frames are ids _first_id.. in order; _head skips evicted entries
+        self._frames: List[bytes] = []
+        self._head = 0
+        self._first_id = 1
+        self._buffer_bytes = 0
+        self._updated = asyncio.Event()
+
+        spill_dir = spill_dir if spill_dir is not None else STREAM_SPILL_DIR
+        self.spill_path: Optional[str] = None
+        self._spill_file = None
+        self._spill_offsets: List[int] = []  # byte offset of spilled event id i + 1
+        self._spill_size = 0  # bytes spilled, written or not
+        # Spilled frames not yet on disk (they start at byte _spill_written);
+        # a background task writes them so append() never blocks the loop
+        self._spill_pending: List[bytes] = []
+        self._spill_written = 0
+        self._spill_flush: Optional[asyncio.Task] = None
+        self._discarded = False
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_path = os.path.join(spill_dir, f"{session_id}.sse")
+        self._dropped = 0  # evicted without a spill file
+
+    @property
+    def last_id(self) -> int:
+        return self.encoder.last_id
+
+    def append(self, event: Event):
+        """Encode and store an event, waking every subscriber"""
+        frame = self.encoder.encode(event)
+        self._frames.append(frame)
+        self._buffer_bytes += len(frame)
+
+        # Always keep the newest frame, however large
+        while self._buffer_bytes > self.max_bytes and len(self._frames) - self._head > 1:
+            evicted = self._frames[self._head]
+            self._frames[self._head] = b""
+            self._head += 1
+            self._first_id += 1
+            self._buffer_bytes -= len(evicted)
+            self._spill(evicted)
+
+        if self._head > 1024 and self._head * 2 > len(self._frames):
+            del self._frames[:self._head]
+            self._head = 0
+
+        self._notify()
+
+    def close(self):
+        """Mark the session finished; subscribers drain and end"""
+        self.done = True
+        self._notify()
+
+    def discard(self):
+        """Drop the spill file once the session is no longer retained"""
+        self._discarded = True
+        self._spill_pending = []
+        if self._spill_flush is None:
+            self._remove_spill()
+
+    async def subscribe(self, after_id: int = 0, coalesce_ms: float = None) -> AsyncIterator[bytes]:
+        """
+        Yield encoded frames with ids greater than after_id, then follow the
+        log live until the session finishes.
+
+        Frames that are ready together are yielded as one chunk; with a
+        coalescing window the subscriber waits that long after each wakeup
+        so bursts of small events share a socket write.
+        """
+        window = (coalesce_ms if coalesce_ms is not None else SSE_COALESCE_MS) / 1000
+        cursor = min(max(0, after_id), self.last_id)
+
+        while True:
+            updated = self._updated
+            if cursor < self.last_id:
+                chunk, cursor = await self._frames_after(cursor)
+                if chunk:
+                    yield chunk
+                continue
+            if self.done:
+                return
+            await updated.wait()
+            if window and not self.done:
+                await asyncio.sleep(window)
+
+    async def _frames_after(self, cursor: int) -> Tuple[bytes, int]:
+        """Encoded frames after cursor (from spill file and buffer) and the new cursor"""
+        chunk = bytearray()
+
+        # Frames can be evicted while the spill file is read, so keep going
+        # until the cursor reaches the buffer; nothing below awaits
+        while cursor + 1 < self._first_id:
+            spilled = len(self._spill_offsets)
+            if self.spill_path and cursor < spilled:
+                chunk += await self._read_spill(cursor, spilled)
+                cursor = spilled
+            elif cursor < self._dropped:
+                missed = self._dropped - cursor
+                chunk += encode_frame(Event('stream_gap', message=f'{missed} earlier events are no longer available', missed=missed).to_dict())
+                cursor = self._dropped
+            else:
+                break
+
+        start = self._head + max(0, cursor + 1 - self._first_id)
+        chunk += b"".join(self._frames[start:])
+        return bytes(chunk), self.last_id
+
+    def _spill(self, frame: bytes):
+        if not self.spill_path:
+            self._dropped += 1
+            return
+        self._spill_offsets.append(self._spill_size)
+        self._spill_size += len(frame)
+        self._spill_pending.append(frame)
+        if self._spill_flush is None:
+            self._spill_flush = asyncio.get_running_loop().create_task(self._flush_spill())
+
+    async def _flush_spill(self):
+        """Write pending spilled frames to the spill file, in order, off the event loop"""
+        try:
+            while self._spill_pending and not self._discarded:
+                count = len(self._spill_pending)
+                data = b"".join(self._spill_pending[:count])
+                await asyncio.to_thread(self._write_spill_file, data)
+                del self._spill_pending[:count]
+                self._spill_written += len(data)
+        except Exception as e:
+            # The frames stay in memory and are still replayed from there
+            print(f"Error writing spill file {self.spill_path}: {e}")
+        finally:
+            self._spill_flush = None
+            if self._discarded:
+                self._remove_spill()
+
+    async def _read_spill(self, cursor: int, spilled: int) -> bytes:
+        """Spilled frames cursor + 1..spilled, from the file and the not yet written tail"""
+        start = self._spill_offsets[cursor]
+        end = self._spill_offsets[spilled] if spilled < len(self._spill_offsets) else self._spill_size
+        # Snapshot before awaiting: the flush task removes frames once written
+        written = self._spill_written
+        pending = b"".join(self._spill_pending)
+
+        data = b""
+        if start < written:
+            data = await asyncio.to_thread(self._read_spill_file, start, min(end, written))
+        if end > written:
+            data += pending[max(start, written) - written:end - written]
+        return data
+
+    def _write_spill_file(self, data: bytes):
+        if self._spill_file is None:
+            self._spill_file = open(self.spill_path, "ab")
+        self._spill_file.write(data)
+        self._spill_file.flush()
+
+    def _read_spill_file(self, offset: int, end: int) -> bytes:
+        with open(self.spill_path, "rb") as f:
+            f.seek(offset)
+            return f.read(end - offset)
+
+    def _remove_spill(self):
+        if self._spill_file:
+            self._spill_file.close()
+            self._spill_file = None
+        if self.spill_path and os.path.exists(self.spill_path):
+            os.remove(self.spill_path)
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
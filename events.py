@@ -0,0 +1,78 @@
+from typing import Any, Dict, Optional
+
+# Output kept per stream on a CommandResult; lines past this are still streamed
+MAX_CAPTURED_OUTPUT = 1024 * 1024
+
+
+class Event:
+    """
+    A progress event produced by the sandbox or the agent.
+
+    Events stay as objects all the way through the pipeline so callers can
+    inspect them directly; they are encoded to the Server-Sent Events wire
+    format once, at the HTTP edge (see sse.SSEEncoder).
+    """
+
+    def __init__(self, type: str, **fields):
+        self.type = type
+        self.fields = fields
+
+    @property
+    def message(self) -> str:
+        return self.fields.get("message", "")
+
+    def get(self, key: str, default=None):
+        return self.fields.get(key, default)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"type": self.type, **self.fields}
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.to_dict()})"
+
+
+class CommandOutputLine(Event):
+    """One line a running command wrote to stdout or stderr"""
+
+    def __init__(self, stream: str, seq: int, line: str):
+        super().__init__("command_output_line", stream=stream, seq=seq, line=line)
+        self.stream = stream
+        self.seq = seq
+        self.line = line
+
+
+class CommandResult(Event):
+    """
+    Final event of a command: exit code, duration and the collected output.
+
+    exit_code is None when the command timed out. stdout/stderr are kept on
+    the object for callers but not sent over the wire, since every line was
+    already streamed as a CommandOutputLine.
+    """
+
+    def __init__(
+        self,
+        command: Optional[str],
+        exit_code: Optional[int],
+        stdout: str,
+        stderr: str,
+        duration_ms: float,
+        seq: int,
+        line_counts: Dict[str, int],
+        timed_out: bool = False
+    ):
+        fields = {"exit_code": exit_code, "seq": seq, "line_counts": line_counts, "duration_ms": round(duration_ms, 1)}
+        if timed_out:
+            fields["timed_out"] = True
+        super().__init__("command_exit", **fields)
+        self.command = command
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration_ms = duration_ms
+        self.timed_out = timed_out
+
+    @property
+    def ok(self) -> bool:
+        return self.exit_code == 0
+
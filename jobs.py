@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+from clone_strategy import CloneStrategy
+from event_log import SessionEventLog, STREAM_RETENTION_SECONDS
+from events import Event
+from scheduler import FairScheduler
+from session import new_session_id
+
+# Number of pipelines that run at the same time (the global concurrency limit)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# Where job records live: memory (lost on restart) or sqlite
+JOB_STORE = os.getenv("JOB_STORE", "memory").lower()
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "/tmp/tiny-backspace-jobs.db")
+# Finished job records kept by the memory store
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "1000"))
+
+JOB_STATUSES = ("queued", "running", "succeeded", "failed", "cancelled")
+FINISHED_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class Job:
+    """One queued /code run: its request, lifecycle status and event log"""
+
+    def __init__(
+        self,
+        job_id: str,
+        repo_url: str,
+        prompt: str,
+        clone_strategy: CloneStrategy,
+        tenant: str,
+        status: str = "queued",
+        created_at: float = None,
+        bypass_llm_cache: bool = False
+    ):
+        self.job_id = job_id
+        self.tenant = tenant
+        self.repo_url = repo_url
+        self.prompt = prompt
+        self.clone_strategy = clone_strategy
+        self.bypass_llm_cache = bypass_llm_cache
+        self.status = status
+        self.created_at = created_at or time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.pr_url: Optional[str] = None
+        self.error: Optional[str] = None
+        # Encoded progress events, replayable by reconnecting clients
+        self.log = SessionEventLog(job_id)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.job_id,
+            "tenant": self.tenant,
+            "repo_url": self.repo_url,
+            "prompt": self.prompt,
+            "clone_strategy": {
+                "mode": self.clone_strategy.mode,
+                "depth": self.clone_strategy.depth,
+                "sparse_paths": self.clone_strategy.sparse_paths,
+            },
+            "bypass_llm_cache": self.bypass_llm_cache,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "pr_url": self.pr_url,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, record: Dict[str, Any]) -> "Job":
+        strategy = record["clone_strategy"]
+        job = cls(
+            record["job_id"],
+            record["repo_url"],
+            record["prompt"],
+            CloneStrategy(strategy["mode"], strategy["depth"], strategy["sparse_paths"]),
+            record["tenant"],
+            record["status"],
+            record["created_at"],
+            record.get("bypass_llm_cache", False)
+        )
+        job.started_at = record.get("started_at")
+        job.finished_at = record.get("finished_at")
+        job.pr_url = record.get("pr_url")
+        job.error = record.get("error")
+        return job
+
+
+class MemoryJobStore:
+    """Job records in process memory; finished jobs beyond JOB_HISTORY are dropped"""
+
+    def __init__(self, history: int = None):
+        self.history = history if history is not None else JOB_HISTORY
+        self._records: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    async def save(self, job: Job):
+        self._records[job.job_id] = job.to_dict()
+        self._records.move_to_end(job.job_id)
+        finished = [job_id for job_id, record in self._records.items() if record["status"] in FINISHED_STATUSES]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._records[job_id]
+
+    async def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._records.get(job_id)
+
+    async def unfinished(self) -> List[Dict[str, Any]]:
+        return []
+
+
+class SQLiteJobStore:
+    """
+    Job records in a local SQLite file, so status survives restarts and
+    jobs that were still queued are picked up again on startup.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or JOB_DB_PATH
+        # One thread, so writes land in the order they were issued
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, status TEXT NOT NULL, record TEXT NOT NULL)")
+        self._db.commit()
+
+    async def save(self, job: Job):
+        await self._run(self._execute, "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", (job.job_id, job.status, json.dumps(job.to_dict())))
+
+    async def load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = await self._run(self._execute, "SELECT record FROM jobs WHERE job_id = ?", (job_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def unfinished(self) -> List[Dict[str, Any]]:
+        rows = await self._run(self._execute, "SELECT record FROM jobs WHERE status IN ('queued', 'running')", ())
+        return sorted((json.loads(row[0]) for row in rows), key=lambda record: record["created_at"])
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _execute(self, sql: str, params: tuple) -> List[tuple]:
+        rows = self._db.execute(sql, params).fetchall()
+        self._db.commit()
+        return rows
+
+
+class JobQueue:
+    """
+    Runs coding pipelines on a fixed pool of workers, independent of any
+    HTTP connection.
+
+    submit() admits the job through the FairScheduler (raising
+    AdmissionError when queues are full) and returns immediately; JOB_WORKERS
+    workers take jobs in weighted fair order across tenants, feed every
+    pipeline event into the job's event log (which clients stream and resume
+    from) and record the final status and PR URL in the job store. cancel()
+    withdraws a queued job or cancels a running pipeline.
+    """
+
+    def __init__(self, agent, workers: int = None, store=None, scheduler: FairScheduler = None, retention: float = None):
+        self.agent = agent
+        self.workers = workers if workers is not None else JOB_WORKERS
+        self.store = store or (SQLiteJobStore() if JOB_STORE == "sqlite" else MemoryJobStore())
+        self.scheduler = scheduler or FairScheduler()
+        self.scheduler.set_workers(self.workers)
+        self.retention = retention if retention is not None else STREAM_RETENTION_SECONDS
+
+        self._jobs: Dict[str, Job] = {}
+        self._worker_tasks: List[asyncio.Task] = []
+        self._job_tasks: Dict[str, asyncio.Task] = {}
+        self._running = 0
+        self.metrics = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0, "store_errors": 0}
+
+    async def start(self):
+        """Recover unfinished jobs from the store and start the workers"""
+        for record in await self.store.unfinished():
+            job = Job.from_dict(record)
+            if job.status == "running":
+                # Its pipeline died with the previous process
+                job.status = "failed"
+                job.error = "Interrupted by server restart"
+                job.finished_at = time.time()
+                await self.store.save(job)
+                continue
+            # Already admitted before the restart, so not subject to the queue limits
+            self._enqueue(job, force=True)
+
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"✅ Job queue started ({self.workers} workers, {type(self.store).__name__})")
+
+    async def stop(self):
+        """Cancel the workers (and the pipelines they are running)"""
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for job in self._jobs.values():
+            job.log.discard()
+
+    async def submit(self, repo_url: str, prompt: str, clone_strategy: CloneStrategy, tenant: str, bypass_llm_cache: bool = False) -> Job:
+        """
+        Admit and record a new job; returns without waiting for a worker.
+        Raises AdmissionError when the tenant's or the global queue is full.
+        """
+        job = Job(new_session_id(), repo_url, prompt, clone_strategy, tenant, bypass_llm_cache=bypass_llm_cache)
+        self._enqueue(job)
+        # The job is queued either way, so the caller must get its id
+        await self._save(job)
+        self.metrics["submitted"] += 1
+        return job
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Cancel a queued or running job (a finished one is left as is).
+        Returns None when the job is not retained.
+        """
+        job = self._jobs.get(job_id)
+        if not job or job.status in FINISHED_STATUSES:
+            return job
+        if job.status == "queued" and self.scheduler.remove(job.tenant, job):
+            job.status = "cancelled"
+            await self._finish(job)
+            return job
+        task = self._job_tasks.get(job_id)
+        if task:
+            task.cancel()
+            # The pipeline's cleanup (sandbox teardown) runs before we report back
+            await asyncio.wait([task])
+            if job.status not in FINISHED_STATUSES:
+                # Cancelled before its pipeline started
+                job.status = "cancelled"
+                await self._finish(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """A job whose event log is still retained"""
+        return self._jobs.get(job_id)
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job:
+            return job.to_dict()
+        return await self.store.load(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "retained": len(self._jobs),
+            **self.metrics,
+            "scheduler": self.scheduler.stats(),
+        }
+
+    def _enqueue(self, job: Job, force: bool = False):
+        ahead = self.scheduler.queued
+        self.scheduler.admit(job.tenant, job, force)
+        self._jobs[job.job_id] = job
+        job.log.append(Event('job', job_id=job.job_id, status='queued', queue_position=ahead, message=f'Job {job.job_id} queued ({ahead} ahead)'))
+
+    async def _worker(self):
+        while True:
+            tenant, job = await self.scheduler.next()
+            self._running += 1
+            started = time.perf_counter()
+            # Its own task, so cancel() can stop the pipeline without the worker
+            task = asyncio.create_task(self._run(job))
+            self._job_tasks[job.job_id] = task
+            try:
+                await asyncio.wait([task])
+                if task.cancelled():
+                    if job.status not in FINISHED_STATUSES:
+                        # Cancelled before its pipeline started
+                        job.status = "cancelled"
+                        await self._finish(job)
+                elif task.exception():
+                    # Never let one job take a worker down with it
+                    print(f"Job worker error on {job.job_id}: {task.exception()}")
+            except asyncio.CancelledError:
+                # Shutting down: stop the pipeline and let its cleanup finish
+                task.cancel()
+                await asyncio.wait([task])
+                raise
+            finally:
+                self._job_tasks.pop(job.job_id, None)
+                self._running -= 1
+                self.scheduler.done(tenant, time.perf_counter() - started)
+
+    async def _run(self, job: Job):
+        job.status = "running"
+        job.started_at = time.time()
+        await self._save(job)
+        job.log.append(Event('job', job_id=job.job_id, status='running', message=f'Job {job.job_id} started'))
+
+        completed = False
+        try:
+            async for event in self.agent.process_coding_request(job.repo_url, job.prompt, job.clone_strategy, job.job_id, job.bypass_llm_cache, job.tenant):
+                job.log.append(event)
+                if event.type == 'completion':
+                    completed = True
+                    job.pr_url = event.get('telemetry', {}).get('pr_url')
+                elif event.type == 'error':
+                    job.error = event.message
+            job.status = "succeeded" if completed else "failed"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            job.log.append(Event('error', message=f'Job failed: {str(e)}'))
+        finally:
+            await asyncio.shield(self._finish(job))
+
+    async def _finish(self, job: Job):
+        """Record a job's final status: metrics, closing event, retention and store"""
+        job.finished_at = time.time()
+        self.metrics[job.status] += 1
+        job.log.append(Event('job', job_id=job.job_id, status=job.status, pr_url=job.pr_url, message=f'Job {job.job_id} {job.status}'))
+        job.log.close()
+        asyncio.get_running_loop().call_later(self.retention, self._expire, job.job_id)
+        await self._save(job)
+
+    async def _save(self, job: Job):
+        """Persist a job record; a store failure is logged, never fatal to the job or worker"""
+        try:
+            await self.store.save(job)
+        except Exception as e:
+            self.metrics["store_errors"] += 1
+            print(f"Error saving job {job.job_id} ({job.status}): {e}")
+
+    def _expire(self, job_id: str):
+        job = self._jobs.pop(job_id, None)
+        if job:
+            job.log.discard()
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+# Opt-in: off, memory, or disk (memory in front of one file per response)
+LLM_CACHE = os.getenv("LLM_CACHE", "off").lower()
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "/tmp/tiny-backspace-llm-cache")
+# Seconds a cached response stays valid
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+# Responses kept in memory, and bytes kept on disk
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Which entry goes first when a tier is full: lru (least recently used) or fifo (oldest)
+LLM_CACHE_EVICTION = os.getenv("LLM_CACHE_EVICTION", "lru").lower()
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """
+    Content address of a model request: a hash of model, max_tokens,
+    system prompt, tools and messages. cache_control markers are left out,
+    since they only affect Anthropic's prompt cache, not the response.
+    """
+    canonical = json.dumps(_strip_cache_control(request), sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def message_to_dict(message) -> Dict[str, Any]:
+    """The parts of a final message a replay needs: content blocks, stop reason and usage"""
+    content = []
+    for block in message.content:
+        if block.type == "tool_use":
+            content.append({"type": "tool_use", "id": block.id, "name": block.name, "input": block.input})
+        elif block.type == "text":
+            content.append({"type": "text", "text": block.text})
+    usage = message.usage
+    return {
+        "content": content,
+        "stop_reason": message.stop_reason,
+        "usage": {
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+        },
+    }
+
+
+def message_from_dict(record: Dict[str, Any]):
+    """A message-like object (attribute access, like the SDK's) for a cached response"""
+    return SimpleNamespace(
+        content=[SimpleNamespace(**block) for block in record["content"]],
+        stop_reason=record["stop_reason"],
+        usage=SimpleNamespace(**record["usage"]),
+    )
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of Claude responses, for replaying identical runs.
+
+    Entries are keyed by request_key() and expire after LLM_CACHE_TTL. A
+    bounded in-memory tier sits in front of an optional disk tier (one JSON
+    file per key); each tier evicts by LLM_CACHE_EVICTION when full. The
+    cache is off unless LLM_CACHE is set, and a request can bypass it.
+    """
+
+    def __init__(self, mode: str = None, directory: str = None, ttl: float = None, memory_entries: int = None, max_bytes: int = None, eviction: str = None):
+        self.mode = mode or LLM_CACHE
+        self.directory = directory or LLM_CACHE_DIR
+        self.ttl = ttl if ttl is not None else LLM_CACHE_TTL
+        self.memory_entries = memory_entries if memory_entries is not None else LLM_CACHE_MEMORY_ENTRIES
+        self.max_bytes = max_bytes if max_bytes is not None else LLM_CACHE_MAX_BYTES
+        self.eviction = eviction or LLM_CACHE_EVICTION
+        if self.eviction not in ("lru", "fifo"):
+            raise ValueError(f"Unknown LLM_CACHE_EVICTION: {self.eviction}")
+
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Disk entries: key -> (size, last used or written, for eviction order)
+        self._disk: Dict[str, list] = {}
+        if self.mode == "disk":
+            os.makedirs(self.directory, exist_ok=True)
+            self._scan()
+
+        self.metrics = {"hits": 0, "memory_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "expired": 0, "evictions": 0, "errors": 0, "saved_ms": 0.0, "saved_output_tokens": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("memory", "disk")
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The cached record for a request key, or None (counting a miss)"""
+        try:
+            record = await self._get(key)
+        except Exception as e:
+            # A broken cache must never fail a turn; treat it as a miss
+            print(f"⚠️  LLM cache read failed: {e}")
+            self.metrics["errors"] += 1
+            record = None
+
+        if record is None:
+            self.metrics["misses"] += 1
+            return None
+        self.metrics["hits"] += 1
+        self.metrics["saved_ms"] += record.get("duration_ms", 0)
+        self.metrics["saved_output_tokens"] += record["message"]["usage"]["output_tokens"]
+        return record
+
+    async def put(self, key: str, message, duration_ms: float):
+        """Store a final message under its request key (errors are logged, never raised)"""
+        try:
+            record = {"created_at": time.time(), "duration_ms": round(duration_ms, 1), "message": message_to_dict(message)}
+            self._remember(key, record)
+            if self.mode == "disk":
+                size = await asyncio.to_thread(self._write, key, record)
+                self._disk[key] = [size, time.time()]
+                await self._evict(keep=key)
+            self.metrics["stores"] += 1
+        except Exception as e:
+            print(f"⚠️  LLM cache write failed: {e}")
+            self.metrics["errors"] += 1
+
+    def record_bypass(self):
+        self.metrics["bypassed"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            "mode": self.mode,
+            "eviction": self.eviction,
+            "ttl_seconds": self.ttl,
+            "memory_entries": len(self._memory),
+            "disk_entries": len(self._disk),
+            "disk_bytes": sum(size for size, _ in self._disk.values()),
+            "hit_rate": self.metrics["hits"] / lookups if lookups else 0.0,
+            **self.metrics,
+            "saved_ms": round(self.metrics["saved_ms"], 1),
+        }
+
+    def _expired(self, record: Dict[str, Any]) -> bool:
+        return time.time() - record["created_at"] > self.ttl
+
+    async def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        record = self._memory.get(key)
+        if record is not None:
+            if self._expired(record):
+                self._memory.pop(key)
+                record = None
+            else:
+                if self.eviction == "lru":
+                    self._memory.move_to_end(key)
+                self.metrics["memory_hits"] += 1
+                return record
+
+        if key not in self._disk:
+            return None
+        record = await asyncio.to_thread(self._read, key)
+        if record is None:
+            self._disk.pop(key, None)
+            return None
+        if self._expired(record):
+            await self._remove(key)
+            self.metrics["expired"] += 1
+            return None
+        if self.eviction == "lru" and key in self._disk:
+            self._disk[key][1] = time.time()
+        self._remember(key, record)
+        return record
+
+    def _remember(self, key: str, record: Dict[str, Any]):
+        self._memory[key] = record
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self.metrics["evictions"] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _scan(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    self._disk[filename[:-5]] = [stat.st_size, stat.st_mtime]
+
+    # Disk bookkeeping (self._disk) only changes on the event loop; the
+    # worker threads below just read, write and delete files
+
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key: str, record: Dict[str, Any]) -> int:
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        data = json.dumps(record).encode()
+        # Write a unique temp file then rename, so concurrent writers of the
+        # same key never share a temp file and readers never see a partial one
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f"{key}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        return len(data)
+
+    async def _evict(self, keep: str):
+        """Drop disk entries by eviction order until the tier fits in max_bytes"""
+        total = sum(size for size, _ in self._disk.values())
+        victims = []
+        for old_key in sorted(self._disk, key=lambda k: self._disk[k][1]):
+            if total <= self.max_bytes:
+                break
+            if old_key == keep:
+                continue
+            total -= self._disk.pop(old_key)[0]
+            victims.append(old_key)
+        if victims:
+            await asyncio.to_thread(self._delete_files, victims)
+            self.metrics["evictions"] += len(victims)
+
+    async def _remove(self, key: str):
+        self._disk.pop(key, None)
+        await asyncio.to_thread(self._delete_files, [key])
+
+    def _delete_files(self, keys: List[str]):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+def _strip_cache_control(value):
+    if isinstance(value, dict):
+        return {key: _strip_cache_control(item) for key, item in value.items() if key != "cache_control"}
+    if isinstance(value, list):
+        return [_strip_cache_control(item) for item in value]
+    return value
@@ -0,0 +1,94 @@
+import os
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+# USD per million tokens (defaults: Claude 3.5 Sonnet list prices)
+LLM_PRICE_INPUT = float(os.getenv("LLM_PRICE_INPUT", "3.00"))
+LLM_PRICE_OUTPUT = float(os.getenv("LLM_PRICE_OUTPUT", "15.00"))
+LLM_PRICE_CACHE_WRITE = float(os.getenv("LLM_PRICE_CACHE_WRITE", "3.75"))
+LLM_PRICE_CACHE_READ = float(os.getenv("LLM_PRICE_CACHE_READ", "0.30"))
+# Recent turns kept for the slowest/costliest rankings, and how many are listed
+LLM_USAGE_RECENT_TURNS = int(os.getenv("LLM_USAGE_RECENT_TURNS", "1000"))
+LLM_USAGE_TOP_TURNS = 10
+
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cache_read_input_tokens", "cache_creation_input_tokens")
+
+
+def turn_cost(turn: Dict[str, Any]) -> float:
+    """USD cost of one turn from its token usage (replayed turns are free)"""
+    return (
+        turn["input_tokens"] * LLM_PRICE_INPUT
+        + turn["output_tokens"] * LLM_PRICE_OUTPUT
+        + turn["cache_creation_input_tokens"] * LLM_PRICE_CACHE_WRITE
+        + turn["cache_read_input_tokens"] * LLM_PRICE_CACHE_READ
+    ) / 1_000_000
+
+
+def summarize_turns(turns: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Totals for a session's turns: tokens by kind, cost, model and wall time,
+    mean and worst time to first token, and the turns that dominate each.
+    """
+    summary = {field: sum(turn[field] for turn in turns) for field in TOKEN_FIELDS}
+    ttfts = [turn["ttft_ms"] for turn in turns if turn["ttft_ms"] is not None]
+    slowest = max(turns, key=lambda turn: turn["model_ms"], default=None)
+    costliest = max(turns, key=lambda turn: turn["cost_usd"], default=None)
+    summary.update({
+        "turns": len(turns),
+        "attempts": sum(turn.get("attempts", 0) for turn in turns),
+        "replayed_turns": sum(1 for turn in turns if turn["cached"]),
+        "failed_turns": sum(1 for turn in turns if turn.get("error")),
+        "cost_usd": round(sum(turn["cost_usd"] for turn in turns), 6),
+        "model_ms": round(sum(turn["model_ms"] for turn in turns), 1),
+        "duration_ms": round(sum(turn["duration_ms"] for turn in turns), 1),
+        "ttft_ms_mean": round(sum(ttfts) / len(ttfts), 1) if ttfts else None,
+        "ttft_ms_max": max(ttfts) if ttfts else None,
+        "slowest_turn": slowest["turn"] if slowest else None,
+        "costliest_turn": costliest["turn"] if costliest else None,
+    })
+    return summary
+
+
+class UsageLedger:
+    """
+    Process-wide rollup of model usage: totals overall and per tenant, plus
+    the most recent turns (tagged with session and tenant) so the ones that
+    dominate latency and cost can be ranked.
+    """
+
+    def __init__(self, recent_turns: int = None):
+        self.totals = self._empty()
+        self.tenants: Dict[str, Dict[str, Any]] = {}
+        self.recent = deque(maxlen=recent_turns if recent_turns is not None else LLM_USAGE_RECENT_TURNS)
+
+    def record(self, tenant: str, session_id: str, turns: List[Dict[str, Any]]):
+        """Add a finished session's turns"""
+        tenant = tenant or "default"
+        summary = summarize_turns(turns)
+        for totals in (self.totals, self.tenants.setdefault(tenant, self._empty())):
+            totals["sessions"] += 1
+            totals["last_session_at"] = time.time()
+            for field in TOKEN_FIELDS + ("turns", "attempts", "replayed_turns", "failed_turns", "cost_usd", "model_ms"):
+                totals[field] += summary[field]
+        for turn in turns:
+            self.recent.append({"tenant": tenant, "session_id": session_id, **turn})
+
+    def stats(self) -> Dict[str, Any]:
+        def top(field):
+            ranked = sorted(self.recent, key=lambda turn: turn[field], reverse=True)
+            return ranked[:LLM_USAGE_TOP_TURNS]
+
+        return {
+            "prices_usd_per_mtok": {"input": LLM_PRICE_INPUT, "output": LLM_PRICE_OUTPUT, "cache_write": LLM_PRICE_CACHE_WRITE, "cache_read": LLM_PRICE_CACHE_READ},
+            "totals": self._rounded(self.totals),
+            "tenants": {tenant: self._rounded(totals) for tenant, totals in self.tenants.items()},
+            "slowest_turns": top("model_ms"),
+            "costliest_turns": top("cost_usd"),
+        }
+
+    def _empty(self) -> Dict[str, Any]:
+        return {"sessions": 0, "turns": 0, "attempts": 0, "replayed_turns": 0, "failed_turns": 0, **{field: 0 for field in TOKEN_FIELDS}, "cost_usd": 0.0, "model_ms": 0.0, "last_session_at": None}
+
+    def _rounded(self, totals: Dict[str, Any]) -> Dict[str, Any]:
+        return {**totals, "cost_usd": round(totals["cost_usd"], 6), "model_ms": round(totals["model_ms"], 1)}
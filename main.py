@@ -1,8 +1,14 @@
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List, Optional
 from agent import CodingAgent
+from claude_client import close_shared_client
+from clone_strategy import CloneStrategy
+from sse import sse_response
+from jobs import JobQueue
+from scheduler import AdmissionError, tenant_id
+from telemetry import loop_monitor
 import os
 from dotenv import load_dotenv
 
@@ -17,27 +23,170 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id", "Retry-After"],
 )
 
 class CodeRequest(BaseModel):
     repoUrl: str
     prompt: str
+    # Clone strategy: full, shallow, blobless, treeless, sparse or auto (default from CLONE_STRATEGY)
+    cloneStrategy: Optional[str] = None
+    cloneDepth: Optional[int] = Field(None, ge=1)
+    sparsePaths: Optional[List[str]] = None
+    # Always call the model, even when LLM_CACHE has a response for this exact request
+    bypassLlmCache: bool = False
 
 # Initialize the coding agent
 coding_agent = CodingAgent(use_local_sandbox=False)
 
-@app.post("/code")
-async def code_endpoint(request: CodeRequest):
-    """Main endpoint that streams the coding process"""
-    return StreamingResponse(
-        coding_agent.process_coding_request(request.repoUrl, request.prompt),
-        media_type="text/event-stream",
+# Pipelines run on a worker pool, independent of any HTTP connection
+job_queue = JobQueue(coding_agent)
+
+def build_clone_strategy(request: CodeRequest) -> CloneStrategy:
+    try:
+        return CloneStrategy(request.cloneStrategy, request.cloneDepth, request.sparsePaths)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+async def submit_job(request: CodeRequest, http_request: Request):
+    """Admit a job for the caller's tenant, or fail fast with 429 and Retry-After"""
+    clone_strategy = build_clone_strategy(request)
+    tenant = tenant_id(http_request.headers.get("x-api-key"), request.repoUrl)
+    try:
+        return await job_queue.submit(request.repoUrl, request.prompt, clone_strategy, tenant, request.bypassLlmCache)
+    except AdmissionError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
+
+def stream_job_events(job_id: str, http_request: Request, last_event_id: Optional[str] = None):
+    """SSE response for a job's events, replaying everything after last_event_id"""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Unknown job or its events have expired: {job_id}")
+    
+    # EventSource sends Last-Event-ID; plain fetch clients can use ?lastEventId=
+    last_event_id = last_event_id or http_request.query_params.get("lastEventId") or "0"
+    try:
+        after_id = int(last_event_id)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid Last-Event-ID: {last_event_id}")
+    
+    return sse_response(
+        job.log.subscribe(after_id),
+        http_request.headers.get("accept-encoding", ""),
+        {"X-Session-Id": job_id},
     )
 
+@app.post("/code")
+async def code_endpoint(request: CodeRequest, http_request: Request):
+    """Main endpoint that streams the coding process (a job plus its event stream)"""
+    job = await submit_job(request, http_request)
+    return stream_job_events(job.job_id, http_request)
+
+@app.get("/code/{session_id}/events")
+async def resume_code_stream(session_id: str, http_request: Request, last_event_id: Optional[str] = Header(None)):
+    """Reconnect to a running or recently finished /code session, replaying missed events"""
+    return stream_job_events(session_id, http_request, last_event_id)
+
+@app.post("/jobs", status_code=202)
+async def create_job(request: CodeRequest, http_request: Request):
+    """Queue a coding job and return its id immediately"""
+    job = await submit_job(request, http_request)
+    return {"job_id": job.job_id, "status": job.status, "events_url": f"/jobs/{job.job_id}/events"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Job status, timings, PR URL and last error"""
+    status = await job_queue.status(job_id)
+    if not status:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return status
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; its event stream ends with status cancelled"""
+    job = await job_queue.cancel(job_id)
+    if job:
+        return job.to_dict()
+    status = await job_queue.status(job_id)
+    if not status:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    # Already finished and no longer retained
+    return status
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, http_request: Request, last_event_id: Optional[str] = Header(None)):
+    """Stream a job's progress; reconnect with Last-Event-ID to resume"""
+    return stream_job_events(job_id, http_request, last_event_id)
+
+@app.on_event("startup")
+async def startup():
+    loop_monitor.start()
+    await job_queue.start()
+    # Start pre-provisioning warm Modal sandboxes
+    if coding_agent.sandbox_pool:
+        await coding_agent.sandbox_pool.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await loop_monitor.stop()
+    await job_queue.stop()
+    if coding_agent.sandbox_pool:
+        await coding_agent.sandbox_pool.stop()
+    # Release the pooled Anthropic HTTP connections
+    await close_shared_client()
+
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
 
+@app.get("/metrics/event-loop")
+async def event_loop_metrics():
+    """Event loop lag; sustained lag means something is blocking every stream"""
+    return loop_monitor.stats()
+
+@app.get("/metrics/sandbox-pool")
+async def sandbox_pool_metrics():
+    """Warm sandbox pool size, idle TTL, hit/miss counts and lease wait times"""
+    if not coding_agent.sandbox_pool:
+        return {"enabled": False}
+    return {"enabled": True, **coding_agent.sandbox_pool.stats()}
+
+@app.get("/metrics/repo-cache")
+async def repo_cache_metrics():
+    """Local mirror cache hits, fetches, evictions, and copy-on-write vs full workspace copies"""
+    if not coding_agent.repo_cache:
+        return {"enabled": False}
+    return {"enabled": True, **coding_agent.repo_cache.stats()}
+
+@app.get("/metrics/analysis-cache")
+async def analysis_cache_metrics():
+    """Analysis cache hit rate, time saved by hits, and memory/disk usage"""
+    return coding_agent.analysis_cache.stats()
+
+@app.get("/metrics/llm-cache")
+async def llm_cache_metrics():
+    """LLM response cache mode, hit rate, time and output tokens saved, and tier sizes"""
+    if not coding_agent.claude:
+        return {"enabled": False}
+    return {"enabled": coding_agent.claude.response_cache.enabled, **coding_agent.claude.response_cache.stats()}
+
+@app.get("/metrics/anthropic")
+async def anthropic_metrics():
+    """Model call retries, errors, circuit breaker state, rate limiter waits and hedges"""
+    if not coding_agent.claude:
+        return {"enabled": False}
+    return {"enabled": True, **coding_agent.claude.resilience.stats()}
+
+@app.get("/metrics/llm-usage")
+async def llm_usage_metrics():
+    """Model tokens, cost and time overall and per tenant, and the slowest and costliest recent turns"""
+    return coding_agent.usage_ledger.stats()
+
+@app.get("/metrics/jobs")
+async def job_metrics():
+    """Workers, outcome counters, and queue depth and wait times overall and per tenant"""
+    return job_queue.stats()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8002)
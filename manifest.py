@@ -0,0 +1,131 @@
+"""
+Single-pass repository manifest.
+
+This module is deliberately stdlib-only and self-contained: LocalSandbox calls
+build_manifest() directly, and ModalSandbox ships this file's source into the
+sandbox and runs it there, so both backends produce the same manifest in one
+round trip.
+"""
+import os
+import subprocess
+from typing import Any, Dict, List, Optional, Tuple
+
+LANGUAGES = {
+    ".py": "python", ".js": "javascript", ".jsx": "javascript", ".mjs": "javascript",
+    ".ts": "typescript", ".tsx": "typescript", ".go": "go", ".rs": "rust",
+    ".java": "java", ".kt": "kotlin", ".rb": "ruby", ".php": "php", ".c": "c",
+    ".h": "c", ".cc": "cpp", ".cpp": "cpp", ".hpp": "cpp", ".cs": "csharp",
+    ".swift": "swift", ".scala": "scala", ".sh": "shell", ".sql": "sql",
+    ".html": "html", ".css": "css", ".scss": "css", ".vue": "vue",
+    ".json": "json", ".yaml": "yaml", ".yml": "yaml", ".toml": "toml",
+    ".md": "markdown", ".rst": "rst", ".txt": "text",
+}
+
+# Files whose contents are worth sending to the model up front
+CONTENT_EXTENSIONS = (".py", ".js", ".ts", ".json", ".md")
+KEY_FILE_NAMES = ("readme.md", "main.py", "app.py", "index.js", "index.ts", "package.json", "setup.py")
+
+BINARY_SNIFF_BYTES = 8000
+
+
+def detect_language(path: str) -> str:
+    return LANGUAGES.get(os.path.splitext(path)[1].lower(), "other")
+
+
+def importance(path: str) -> int:
+    """Lower sorts first: key entrypoints/configs, then shallow source and docs"""
+    name = os.path.basename(path).lower()
+    score = path.count("/") * 10
+    if name in KEY_FILE_NAMES:
+        score -= 100
+    if not path.lower().endswith(CONTENT_EXTENSIONS):
+        score += 1000
+    return score
+
+
+def _tracked_files(root: str) -> List[Tuple[str, Optional[str]]]:
+    """(path, blob sha) for every tracked file, or a filesystem walk outside git"""
+    try:
+        output = subprocess.run(
+            ["git", "ls-files", "-s", "-z"], cwd=root, capture_output=True, check=True
+        ).stdout.decode("utf-8", errors="replace")
+        entries = []
+        for record in output.split("\0"):
+            if not record:
+                continue
+            meta, path = record.split("\t", 1)
+            mode, sha, _ = meta.split(" ")
+            if mode != "160000":  # skip submodules
+                entries.append((path, sha))
+        return entries
+    except (OSError, subprocess.CalledProcessError):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d != ".git"]
+            for filename in filenames:
+                entries.append((os.path.relpath(os.path.join(dirpath, filename), root), None))
+        return entries
+
+
+def build_manifest(root: str = ".", top_n: int = 5, byte_budget: int = 65536, max_files: int = 5000) -> Dict[str, Any]:
+    """
+    Scan a checkout once and describe it.
+
+    Returns a dict with `files` (path, size, language, binary flag and content
+    hash for up to max_files tracked files), `contents` (text of the top_n most
+    important files that fit in byte_budget) and totals. On repositories with
+    more than max_files files, the most important ones (see importance) are
+    kept rather than the first in path order, so the context packer still
+    sees source files deep in the alphabet.
+    """
+    files = []
+    total_bytes = 0
+    entries = _tracked_files(root)
+    if len(entries) > max_files:
+        kept = sorted(entries, key=lambda entry: (importance(entry[0]), entry[0]))[:max_files]
+        listed = sorted(kept)
+    else:
+        listed = entries
+
+    for path, sha in listed:
+        full_path = os.path.join(root, path)
+        try:
+            size = os.path.getsize(full_path)
+            with open(full_path, "rb") as f:
+                binary = b"\0" in f.read(BINARY_SNIFF_BYTES)
+        except OSError:
+            # Not checked out (sparse checkout); still listed from the index
+            size, binary = None, False
+        total_bytes += size or 0
+        files.append({
+            "path": path,
+            "size": size,
+            "language": detect_language(path),
+            "binary": binary,
+            "sha": sha,
+        })
+
+    contents = {}
+    budget = byte_budget
+    for entry in sorted(files, key=lambda e: (importance(e["path"]), e["path"])):
+        if len(contents) >= top_n or budget <= 0:
+            break
+        if entry["binary"] or entry["size"] is None or entry["size"] > budget:
+            continue
+        if not entry["path"].lower().endswith(CONTENT_EXTENSIONS):
+            continue
+        try:
+            with open(os.path.join(root, entry["path"]), encoding="utf-8") as f:
+                contents[entry["path"]] = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        budget -= entry["size"]
+
+    return {
+        "files": files,
+        "contents": contents,
+        "total_files": len(entries),
+        "total_bytes": total_bytes,
+        "truncated": len(entries) > max_files,
+    }
+
@@ -0,0 +1,257 @@
+import os
+import asyncio
+import hashlib
+import shutil
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class RepoMirrorCache:
+    """
+    On-disk cache of bare git mirrors keyed by repository URL.
+
+    The first request for a repo pays a full `git clone --mirror`; later
+    requests only run an incremental fetch (skipped entirely while the mirror
+    is fresher than REPO_CACHE_FETCH_TTL). Each mirror keeps a pristine
+    checkout per HEAD commit, made with `git clone --shared` so objects are
+    borrowed through alternates, and every workspace is a copy-on-write copy
+    of that checkout where the filesystem supports it (a full copy of the
+    working tree otherwise; see cow_supported and the copy counters). Mirrors are evicted least recently used first once the
+    cache exceeds REPO_CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, root: str = None, max_bytes: int = None, fetch_ttl: float = None):
+        self.root = root or os.getenv("REPO_CACHE_DIR", "/tmp/tiny-backspace-mirrors")
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("REPO_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+        self.fetch_ttl = fetch_ttl if fetch_ttl is not None else float(os.getenv("REPO_CACHE_FETCH_TTL", "30"))
+        os.makedirs(self.root, exist_ok=True)
+
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._in_use: Dict[str, int] = {}
+        self._copying: Dict[str, int] = {}
+        # Whether workspace copies can be copy-on-write here (None until the first copy)
+        self.cow_supported: Optional[bool] = None
+        self.metrics = {"hits": 0, "misses": 0, "fetches": 0, "evictions": 0, "cow_copies": 0, "full_copies": 0}
+
+    def mirror_path(self, repo_url: str) -> str:
+        key = hashlib.sha256(repo_url.rstrip('/').removesuffix('.git').encode()).hexdigest()[:16]
+        repo_name = repo_url.rstrip('/').split('/')[-1].replace('.git', '')
+        return os.path.join(self.root, f"{repo_name}-{key}.git")
+
+    async def checkout(self, repo_url: str, dest: str, sparse_args: List[str] = None) -> Dict[str, object]:
+        """
+        Materialize a working copy of repo_url at dest from the local mirror.
+
+        sparse_args (`git sparse-checkout set ...` arguments) limit the files
+        written to the working tree. The mirror stays pinned until release()
+        is called for the same URL. Returns timing and cache-hit information for progress reporting.
+        """
+        start = time.perf_counter()
+        mirror, hit = await self._ensure_mirror(repo_url)
+        self._in_use[mirror] = self._in_use.get(mirror, 0) + 1
+
+        try:
+            async with self._lock_for(mirror):
+                pristine = await self._ensure_pristine(repo_url, mirror, sparse_args or [])
+                self._copying[pristine] = self._copying.get(pristine, 0) + 1
+            try:
+                method = await copy_tree_cow(pristine, dest, self.cow_supported)
+                self._record_copy(method)
+            finally:
+                self._copying[pristine] -= 1
+                if not self._copying[pristine]:
+                    del self._copying[pristine]
+        except Exception:
+            self.release(repo_url)
+            raise
+
+        await self.evict()
+        return {"cache_hit": hit, "mirror": mirror, "copy_method": method, "duration_ms": (time.perf_counter() - start) * 1000}
+
+    def release(self, repo_url: str):
+        """Unpin the mirror for repo_url once its workspace is no longer needed"""
+        mirror = self.mirror_path(repo_url)
+        remaining = self._in_use.get(mirror, 0) - 1
+        if remaining > 0:
+            self._in_use[mirror] = remaining
+        else:
+            self._in_use.pop(mirror, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"root": self.root, "max_bytes": self.max_bytes, "cow_supported": self.cow_supported, **self.metrics}
+
+    def _record_copy(self, method: str):
+        if method == "cow":
+            self.metrics["cow_copies"] += 1
+            self.cow_supported = True
+            return
+        self.metrics["full_copies"] += 1
+        if self.cow_supported is None:
+            print(f"⚠️  {self.root} does not support copy-on-write copies; every workspace is a full copy of its checkout")
+        self.cow_supported = False
+
+    async def evict(self):
+        """Remove least recently used mirrors until the cache fits max_bytes"""
+        mirrors = await asyncio.to_thread(self._scan)
+        total = sum(size for _, size, _ in mirrors)
+
+        for path, size, _ in sorted(mirrors, key=lambda m: m[2]):
+            if total <= self.max_bytes:
+                break
+            if self._in_use.get(path) or self._lock_for(path).locked():
+                continue
+            await asyncio.to_thread(shutil.rmtree, path, True)
+            total -= size
+            self.metrics["evictions"] += 1
+            print(f"Evicted repo mirror: {path} ({size / 1024 ** 2:.1f} MB)")
+
+    async def _ensure_mirror(self, repo_url: str) -> Tuple[str, bool]:
+        mirror = self.mirror_path(repo_url)
+
+        async with self._lock_for(mirror):
+            stamp = os.path.join(mirror, "tiny-backspace-last-fetch")
+
+            if os.path.isdir(mirror):
+                self.metrics["hits"] += 1
+                if time.time() - _mtime(stamp) > self.fetch_ttl:
+                    code, _, err = await _git("fetch", "--prune", "--quiet", "origin", cwd=mirror)
+                    self.metrics["fetches"] += 1
+                    if code != 0:
+                        print(f"Mirror fetch failed for {repo_url}, using cached copy: {err}")
+                    else:
+                        _touch(stamp)
+                _touch(os.path.join(mirror, "tiny-backspace-last-used"))
+                return mirror, True
+
+            self.metrics["misses"] += 1
+            tmp_path = f"{mirror}.tmp-{os.getpid()}"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            code, _, err = await _git("clone", "--mirror", "--quiet", repo_url, tmp_path)
+            if code != 0:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise RuntimeError(f"git clone --mirror failed: {err}")
+            # Workspaces borrow objects through alternates, so never let gc prune them
+            await _git("config", "gc.auto", "0", cwd=tmp_path)
+            os.replace(tmp_path, mirror)
+            _touch(stamp)
+            _touch(os.path.join(mirror, "tiny-backspace-last-used"))
+            return mirror, False
+
+    async def _ensure_pristine(self, repo_url: str, mirror: str, sparse_args: List[str]) -> str:
+        """
+        Return the pristine checkout of the mirror's current HEAD, creating it
+        if needed. Must be called with the mirror lock held.
+        """
+        code, head, err = await _git("rev-parse", "HEAD", cwd=mirror)
+        if code != 0:
+            raise RuntimeError(f"git rev-parse in mirror failed: {err}")
+        head = head.strip()[:12]
+        sparse_key = hashlib.sha256(" ".join(sparse_args).encode()).hexdigest()[:8]
+        pristine_root = os.path.join(mirror, "tiny-backspace-pristine")
+        pristine = os.path.join(pristine_root, f"{head}-{sparse_key}")
+
+        if not os.path.isdir(pristine):
+            tmp_path = f"{pristine}.tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            code, _, err = await _git("clone", "--shared", "--quiet", "--no-checkout", mirror, tmp_path)
+            if code != 0:
+                raise RuntimeError(f"git clone from mirror failed: {err}")
+            if sparse_args:
+                code, _, err = await _git(*sparse_args, cwd=tmp_path)
+                if code != 0:
+                    raise RuntimeError(f"git sparse-checkout failed: {err}")
+            code, _, err = await _git("checkout", "--quiet", "HEAD", cwd=tmp_path)
+            if code != 0:
+                raise RuntimeError(f"git checkout failed: {err}")
+            # Point the checkout at the real remote so push/PR work as before
+            await _git("remote", "set-url", "origin", repo_url, cwd=tmp_path)
+            os.replace(tmp_path, pristine)
+
+        # Drop checkouts of older commits that nobody is copying from
+        for entry in os.scandir(pristine_root):
+            if not entry.name.startswith(head) and not self._copying.get(entry.path):
+                await asyncio.to_thread(shutil.rmtree, entry.path, True)
+
+        return pristine
+
+    def _lock_for(self, mirror: str) -> asyncio.Lock:
+        if mirror not in self._locks:
+            self._locks[mirror] = asyncio.Lock()
+        return self._locks[mirror]
+
+    def _scan(self):
+        """Return (path, size_bytes, last_used) for every cached mirror"""
+        mirrors = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or not entry.name.endswith(".git"):
+                continue
+            size = 0
+            for dirpath, _, filenames in os.walk(entry.path):
+                for name in filenames:
+                    try:
+                        size += os.path.getsize(os.path.join(dirpath, name))
+                    except OSError:
+                        pass
+            mirrors.append((entry.path, size, _mtime(os.path.join(entry.path, "tiny-backspace-last-used"))))
+        return mirrors
+
+
+async def copy_tree_cow(src: str, dest: str, cow_supported: Optional[bool] = None) -> str:
+    """
+    Copy a directory tree using copy-on-write clones where the filesystem
+    supports them (reflinks on btrfs/XFS, clonefile on APFS), falling back to
+    a regular copy elsewhere.
+
+    Returns the method used, "cow" or "copy". cow_supported skips the clone
+    attempt when it is already known to fail on this filesystem.
+    """
+    if cow_supported is not False:
+        if sys.platform == "darwin":
+            command = ["cp", "-c", "-R", src, dest]
+        else:
+            # always, not auto: auto silently does a full copy without reflinks
+            command = ["cp", "-a", "--reflink=always", src, dest]
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        await process.communicate()
+        if process.returncode == 0:
+            return "cow"
+        await asyncio.to_thread(shutil.rmtree, dest, True)
+
+    process = await asyncio.create_subprocess_exec(
+        "cp", "-R" if sys.platform == "darwin" else "-a", src, dest,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    await process.communicate()
+    if process.returncode != 0:
+        await asyncio.to_thread(shutil.rmtree, dest, True)
+        await asyncio.to_thread(shutil.copytree, src, dest, symlinks=True)
+    return "copy"
+
+
+async def _git(*args, cwd: str = None) -> Tuple[int, str, str]:
+    process = await asyncio.create_subprocess_exec(
+        "git", *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    return process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
+def _touch(path: str):
+    with open(path, "a"):
+        os.utime(path, None)
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
@@ -0,0 +1,367 @@
+import os
+import time
+import random
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import anthropic
+
+T = TypeVar("T")
+O = TypeVar("O")
+
+# Attempts after the first one for a retryable failure, and the backoff range in seconds
+ANTHROPIC_MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "4"))
+ANTHROPIC_BACKOFF_BASE = float(os.getenv("ANTHROPIC_BACKOFF_BASE", "1.0"))
+ANTHROPIC_BACKOFF_MAX = float(os.getenv("ANTHROPIC_BACKOFF_MAX", "60"))
+# Organization limits for the whole process (0 disables each bucket)
+ANTHROPIC_RPM = int(os.getenv("ANTHROPIC_RPM", "0"))
+ANTHROPIC_TPM = int(os.getenv("ANTHROPIC_TPM", "0"))
+# Start a second identical request when the first has not started streaming
+# after this many milliseconds (0 disables hedging)
+ANTHROPIC_HEDGE_AFTER_MS = float(os.getenv("ANTHROPIC_HEDGE_AFTER_MS", "0"))
+# Consecutive failed calls that open the circuit, and how long it stays open
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504, 529)
+RETRYABLE_ERROR_TYPES = ("overloaded_error", "rate_limit_error", "api_error", "timeout_error")
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the API while the circuit breaker is open"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Anthropic circuit open; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class SideEffectsStartedError(Exception):
+    """
+    Raised by a call's consume() when it fails after starting work that a
+    retry would repeat (tool calls), so the call is not retried. partial
+    carries whatever that work produced.
+    """
+
+    def __init__(self, error: BaseException, partial: Any = None):
+        super().__init__(f"{type(error).__name__}: {error}")
+        self.error = error
+        self.partial = partial
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Rate limits, overload, server errors, timeouts and dropped connections"""
+    if isinstance(error, anthropic.APIConnectionError):  # includes APITimeoutError
+        return True
+    # An error event in the middle of a stream is raised with the stream's own
+    # HTTP status (200), so its type is only in the body
+    body = getattr(error, "body", None)
+    if isinstance(body, dict) and isinstance(body.get("error"), dict):
+        if body["error"].get("type") in RETRYABLE_ERROR_TYPES:
+            return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """The server's retry-after hint from an API error, if it sent one"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class TokenBucket:
+    """Capacity refilled continuously at capacity per minute; capacity 0 means unlimited"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount is available (amounts over capacity wait for a full bucket)"""
+        if self.unlimited:
+            return 0.0
+        self.refill()
+        needed = min(amount, self.capacity) - self.available
+        return max(0.0, needed * 60 / self.capacity)
+
+    def take(self, amount: float):
+        if not self.unlimited:
+            self.available -= amount
+
+
+class RateLimiter:
+    """
+    Process-wide requests-per-minute and tokens-per-minute buckets.
+
+    Callers are served in arrival order. Token use is estimated up front and
+    corrected once the response reports real usage; a 429's retry-after
+    pauses every caller, not just the one that got it.
+    """
+
+    def __init__(self, rpm: int = None, tpm: int = None):
+        self.requests = TokenBucket(rpm if rpm is not None else ANTHROPIC_RPM)
+        self.tokens = TokenBucket(tpm if tpm is not None else ANTHROPIC_TPM)
+        self._lock = asyncio.Lock()
+        self._paused_until = 0.0
+        self.metrics = {"acquired": 0, "waited": 0, "wait_ms_total": 0.0, "pauses": 0}
+
+    async def acquire(self, tokens: int):
+        """Wait for one request and the estimated tokens"""
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                delay = max(self._paused_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+        waited_ms = (time.monotonic() - started) * 1000
+        self.metrics["acquired"] += 1
+        if waited_ms >= 1:
+            self.metrics["waited"] += 1
+            self.metrics["wait_ms_total"] += waited_ms
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Take a request and tokens only if they are available right now (used for hedges)"""
+        if self._lock.locked() or self._paused_until > time.monotonic():
+            return False
+        if self.requests.wait_time(1) > 0 or self.tokens.wait_time(tokens) > 0:
+            return False
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.metrics["acquired"] += 1
+        return True
+
+    def settle(self, estimated: int, actual: int):
+        """Correct the token bucket once the real usage is known"""
+        self.tokens.take(actual - estimated)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.metrics["pauses"] += 1
+
+
+class CircuitBreaker:
+    """
+    Stops calling the API after CIRCUIT_FAILURE_THRESHOLD consecutive failed
+    calls. After CIRCUIT_RESET_SECONDS one trial call is let through (half
+    open): success closes the circuit, failure opens it again, and an
+    error that is the request's own fault (see record_neutral) lets the next
+    call be the trial.
+    """
+
+    def __init__(self, threshold: int = None, reset_seconds: float = None):
+        self.threshold = threshold if threshold is not None else CIRCUIT_FAILURE_THRESHOLD
+        self.reset_seconds = reset_seconds if reset_seconds is not None else CIRCUIT_RESET_SECONDS
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self.metrics = {"opened": 0, "rejected": 0}
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        if self.state == "open":
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0:
+                self.metrics["rejected"] += 1
+                raise CircuitOpenError(remaining)
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._trial_running:
+                self.metrics["rejected"] += 1
+                raise CircuitOpenError(self.reset_seconds)
+            self._trial_running = True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._trial_running = False
+
+    def record_neutral(self):
+        """
+        A call failed for reasons of its own (a bad request), which says
+        nothing about the API: free a half-open trial slot for the next call
+        without closing the circuit or touching the failure count.
+        """
+        self._trial_running = False
+
+    def record_cancelled(self):
+        """A call was cancelled before it finished; a half-open trial counts as failed"""
+        if self.state == "half_open":
+            self.record_failure()
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_running = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.metrics["opened"] += 1
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+
+class ResilientCaller:
+    """
+    Retries, rate limiting, hedging and circuit breaking around model calls.
+
+    A call is split in two: open() starts the request and returns once it
+    is streaming, without side effects, and consume() reads the rest. Only
+    open() is hedged, so a slow start can be raced by a second request
+    without doubling side effects. Retryable failures are retried with
+    exponential backoff and jitter, honoring the server's retry-after,
+    unless consume() raised SideEffectsStartedError: work it already did
+    would be repeated (or contradicted) by a retry. The caller only sees an
+    exception once retries are exhausted, the error is not retryable or
+    came after side effects, or the circuit is open.
+    """
+
+    def __init__(self, limiter: RateLimiter = None, breaker: CircuitBreaker = None, max_retries: int = None, hedge_after_ms: float = None):
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries if max_retries is not None else ANTHROPIC_MAX_RETRIES
+        self.hedge_after = (hedge_after_ms if hedge_after_ms is not None else ANTHROPIC_HEDGE_AFTER_MS) / 1000
+        self.metrics = {"calls": 0, "succeeded": 0, "failed": 0, "retries": 0, "retry_wait_ms_total": 0.0, "hedges": 0, "hedge_wins": 0, "not_retried_after_side_effects": 0}
+        self.errors: Dict[str, int] = {}
+
+    async def call(
+        self,
+        open: Callable[[], Awaitable[O]],
+        consume: Callable[[O], Awaitable[T]],
+        discard: Callable[[O], Awaitable[Any]],
+        estimated_tokens: int,
+        usage: Callable[[T], int] = None
+    ) -> T:
+        """
+        Run open() then consume() on its result, with the protections above.
+        discard() closes an opened request that is not used (a lost hedge);
+        usage() reports the tokens a result actually used, for the TPM bucket.
+        """
+        self.metrics["calls"] += 1
+        attempt = 0
+        while True:
+            self.breaker.check()
+            try:
+                await self.limiter.acquire(estimated_tokens)
+                opened = await self._open_hedged(open, discard, estimated_tokens)
+                result = await consume(opened)
+            except SideEffectsStartedError as e:
+                self.errors[type(e.error).__name__] = self.errors.get(type(e.error).__name__, 0) + 1
+                if is_retryable(e.error):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_neutral()
+                self.metrics["failed"] += 1
+                self.metrics["not_retried_after_side_effects"] += 1
+                raise
+            except Exception as e:
+                self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+                if not is_retryable(e):
+                    # The request itself is bad; that says nothing about the API's health
+                    self.breaker.record_neutral()
+                    self.metrics["failed"] += 1
+                    raise
+                self.breaker.record_failure()
+                if attempt >= self.max_retries or self.breaker.state == "open":
+                    self.metrics["failed"] += 1
+                    raise
+
+                hint = retry_after_seconds(e)
+                if hint is not None and getattr(e, "status_code", None) == 429:
+                    self.limiter.pause(hint)
+                delay = hint if hint is not None else min(ANTHROPIC_BACKOFF_MAX, ANTHROPIC_BACKOFF_BASE * 2 ** attempt)
+                delay *= random.uniform(1.0, 1.25)
+                attempt += 1
+                self.metrics["retries"] += 1
+                self.metrics["retry_wait_ms_total"] += delay * 1000
+                print(f"⚠️  Anthropic call failed ({type(e).__name__}: {str(e)[:100]}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled (client gone, deadline hit): never leave a half-open
+                # trial marked as running, or the circuit would stay shut
+                self.breaker.record_cancelled()
+                raise
+
+            self.breaker.record_success()
+            self.metrics["succeeded"] += 1
+            if usage:
+                self.limiter.settle(estimated_tokens, usage(result))
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.metrics,
+            "retry_wait_ms_total": round(self.metrics["retry_wait_ms_total"], 1),
+            "errors": dict(self.errors),
+            "circuit": {"state": self.breaker.state, "consecutive_failures": self.breaker.failures, **self.breaker.metrics},
+            "rate_limiter": {
+                "rpm": int(self.limiter.requests.capacity),
+                "tpm": int(self.limiter.tokens.capacity),
+                **self.limiter.metrics,
+                "wait_ms_total": round(self.limiter.metrics["wait_ms_total"], 1),
+            },
+            "hedge_after_ms": self.hedge_after * 1000,
+        }
+
+    async def _open_hedged(self, open: Callable[[], Awaitable[O]], discard: Callable[[O], Awaitable[Any]], estimated_tokens: int) -> O:
+        primary = asyncio.create_task(open())
+        if not self.hedge_after:
+            return await primary
+
+        done, _ = await asyncio.wait([primary], timeout=self.hedge_after)
+        if done or not self.limiter.try_acquire(estimated_tokens):
+            return await primary
+
+        self.metrics["hedges"] += 1
+        hedge = asyncio.create_task(open())
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                opened = [task for task in done if task.exception() is None]
+                if not opened:
+                    error = next(iter(done)).exception()
+                    continue
+                # Both can finish in the same tick; keep one and close the other
+                winner = primary if primary in opened else hedge
+                pending |= set(opened) - {winner}
+                if winner is hedge:
+                    self.metrics["hedge_wins"] += 1
+                return winner.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                asyncio.create_task(self._discard_later(task, discard))
+
+    async def _discard_later(self, task: asyncio.Task, discard: Callable[[O], Awaitable[Any]]):
+        """Close a losing request once its open() has settled"""
+        try:
+            opened = await task
+        except BaseException:
+            return
+        await discard(opened)
@@ -1,13 +1,192 @@
 import os
+import codecs
 import asyncio
+import base64
 import json
 import shutil
-from typing import AsyncGenerator
+import hashlib
+import uuid
+import signal
+import inspect
+import time
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Optional
 import modal
 from dotenv import load_dotenv
+from repo_cache import RepoMirrorCache
+from clone_strategy import CloneStrategy
+from deadlines import COMMAND_TIMEOUT, remaining
+from events import Event, CommandOutputLine, CommandResult, MAX_CAPTURED_OUTPUT
+import manifest
+import code_search
 
 load_dotenv()
 
+MODAL_APP_NAME = "tiny-backspace-agent"
+
+# Pinned tool versions baked into the agent image
+AGENT_IMAGE_PYTHON = "3.11"
+AGENT_IMAGE_APT_PACKAGES = ("git", "curl", "ca-certificates")
+AGENT_IMAGE_GH_VERSION = "2.62.0"
+AGENT_IMAGE_PIP_PACKAGES = ("requests==2.32.3", "python-dotenv==1.0.1")
+
+# Process-level cache of the resolved Modal app and image
+_modal_runtime = None
+
+
+def agent_image_spec_hash() -> str:
+    """Content hash of the pinned agent image definition"""
+    spec = json.dumps({
+        "python": AGENT_IMAGE_PYTHON,
+        "apt": AGENT_IMAGE_APT_PACKAGES,
+        "gh": AGENT_IMAGE_GH_VERSION,
+        "pip": AGENT_IMAGE_PIP_PACKAGES,
+    }, sort_keys=True)
+    return hashlib.sha256(spec.encode()).hexdigest()[:12]
+
+
+def build_agent_image() -> modal.Image:
+    """Declare the agent image with git, GitHub CLI and git identity baked in"""
+    gh_deb = f"gh_{AGENT_IMAGE_GH_VERSION}_linux_amd64.deb"
+    return (
+        modal.Image.debian_slim(python_version=AGENT_IMAGE_PYTHON)
+        .apt_install(*AGENT_IMAGE_APT_PACKAGES)
+        .run_commands(
+            f"curl -fsSL -o /tmp/{gh_deb} https://github.com/cli/cli/releases/download/v{AGENT_IMAGE_GH_VERSION}/{gh_deb}"
+            f" && dpkg -i /tmp/{gh_deb} && rm /tmp/{gh_deb}",
+            "git config --system user.email 'agent@tinybackspace.com'"
+            " && git config --system user.name 'Tiny Backspace Agent'",
+        )
+        .pip_install(*AGENT_IMAGE_PIP_PACKAGES)
+        .env({"AGENT_IMAGE_SPEC": agent_image_spec_hash()})
+    )
+
+
+def check_agent_image_spec(image_id: str, pinned_spec: Optional[str]):
+    """
+    Refuse a prebuilt image built from a different spec than this code pins.
+
+    The spec hash is baked into the image (AGENT_IMAGE_SPEC), and
+    `python sandbox.py build-image` prints it next to the image id for
+    MODAL_AGENT_IMAGE_SPEC, so a stale id is caught at startup.
+    """
+    expected = agent_image_spec_hash()
+    if not pinned_spec:
+        print(f"⚠️  MODAL_AGENT_IMAGE_SPEC is not set; cannot verify {image_id} was built from spec {expected}")
+        return
+    if pinned_spec != expected:
+        raise RuntimeError(
+            f"MODAL_AGENT_IMAGE_ID={image_id} was built from agent image spec {pinned_spec}, but this code pins {expected}. "
+            "Run `python sandbox.py build-image` and update MODAL_AGENT_IMAGE_ID and MODAL_AGENT_IMAGE_SPEC."
+        )
+
+
+def resolve_modal_runtime():
+    """
+    Resolve the Modal app handle and agent image once per process.
+    
+    Uses the prebuilt image in MODAL_AGENT_IMAGE_ID when set (see
+    `python sandbox.py build-image`), after checking its spec hash against
+    the pinned definition; otherwise builds the pinned definition.
+    Raises RuntimeError with a clear message if either cannot be resolved.
+    """
+    global _modal_runtime
+    if _modal_runtime is not None:
+        return _modal_runtime
+    
+    try:
+        app = modal.App.lookup(MODAL_APP_NAME, create_if_missing=True)
+    except Exception as e:
+        raise RuntimeError(f"Could not look up Modal app '{MODAL_APP_NAME}' (is `modal token new` configured?): {e}")
+    
+    image_id = os.getenv("MODAL_AGENT_IMAGE_ID")
+    if image_id:
+        check_agent_image_spec(image_id, os.getenv("MODAL_AGENT_IMAGE_SPEC"))
+    try:
+        if image_id:
+            image = modal.Image.from_id(image_id)
+        else:
+            image = build_agent_image()
+            image.build(app)
+    except Exception as e:
+        source = f"MODAL_AGENT_IMAGE_ID={image_id}" if image_id else f"pinned spec {agent_image_spec_hash()}"
+        raise RuntimeError(
+            f"Could not resolve Modal agent image from {source}: {e}. "
+            "Run `python sandbox.py build-image` and set MODAL_AGENT_IMAGE_ID to the printed id."
+        )
+    
+    print(f"✅ Modal runtime resolved: app={MODAL_APP_NAME}, image={image.object_id} (spec {agent_image_spec_hash()})")
+    _modal_runtime = (app, image)
+    return _modal_runtime
+
+
+# In-sandbox helpers so a whole batch of files moves in a single exec round trip.
+# Both read a JSON document from stdin and print JSON to stdout.
+_WRITE_FILES_SCRIPT = """
+import json, os, sys
+results = {}
+for path, content in json.load(sys.stdin).items():
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        results[path] = None
+    except Exception as e:
+        results[path] = str(e)
+print(json.dumps(results))
+"""
+
+_READ_FILES_SCRIPT = """
+import json, subprocess, sys
+contents = {}
+for path in json.load(sys.stdin):
+    try:
+        with open(path, encoding="utf-8") as f:
+            contents[path] = f.read()
+    except FileNotFoundError:
+        shown = subprocess.run(["git", "show", "HEAD:" + path], capture_output=True)
+        if shown.returncode == 0:
+            contents[path] = shown.stdout.decode("utf-8", errors="replace")
+    except Exception:
+        pass
+print(json.dumps(contents))
+"""
+
+# manifest.py is stdlib-only, so its source runs unchanged inside the sandbox
+_MANIFEST_SCRIPT = inspect.getsource(manifest) + """
+import json, sys
+print(json.dumps(build_manifest(**json.load(sys.stdin))))
+"""
+
+# code_search.py is stdlib-only too; the index is built once and pickled in the
+# sandbox, per workspace since pooled sandboxes are reused
+MODAL_SEARCH_INDEX_DIR = "/tmp/tiny-backspace-code-search"
+_SEARCH_SCRIPT = inspect.getsource(code_search) + """
+import base64, json, sys
+request = json.load(sys.stdin)
+if request["action"] == "build":
+    index = CodeIndex.build(".", request["max_files"])
+    os.makedirs(os.path.dirname(request["index_path"]), exist_ok=True)
+    index.save(request["index_path"])
+    print(json.dumps(index.stats()))
+elif request["action"] == "export":
+    with open(request["index_path"], "rb") as f:
+        print(base64.b64encode(f.read()).decode())
+elif request["action"] == "refresh":
+    index = CodeIndex.load(request["index_path"])
+    index.refresh(request["paths"])
+    index.save(request["index_path"])
+    print(json.dumps(index.stats()))
+elif request["action"] == "import":
+    os.makedirs(os.path.dirname(request["index_path"]), exist_ok=True)
+    with open(request["index_path"], "wb") as f:
+        f.write(base64.b64decode(request["data"]))
+else:
+    index = CodeIndex.load(request["index_path"])
+    print(json.dumps(index.search(request["query"], request["limit"], request["path_prefix"])))
+"""
+
 
 class ModalSandbox:
     """
@@ -15,35 +194,24 @@ class ModalSandbox:
     Provides true ephemeral, isolated execution environments in the cloud.
     """
     
-    def __init__(self):
-        """Initialize Modal app and sandbox configuration"""
-        try:
-            # Create or lookup Modal app
-            self.app = modal.App.lookup("tiny-backspace-agent", create_if_missing=True)
-            self.sandbox = None
-            self.workspace_path = "/workspace/repo"
-            
-            # Define the image with git, GitHub CLI, and common tools
-            self.image = (
-                modal.Image.debian_slim()
-                .apt_install("git", "curl", "wget", "nano", "gnupg", "software-properties-common")
-                # Install GitHub CLI
-                .run_commands(
-                    "curl -fsSL https://cli.github.com/packages/githubcli-archive-keyring.gpg | dd of=/usr/share/keyrings/githubcli-archive-keyring.gpg",
-                    "chmod go+r /usr/share/keyrings/githubcli-archive-keyring.gpg",
-                    "echo \"deb [arch=$(dpkg --print-architecture) signed-by=/usr/share/keyrings/githubcli-archive-keyring.gpg] https://cli.github.com/packages stable main\" | tee /etc/apt/sources.list.d/github-cli.list > /dev/null",
-                    "apt update",
-                    "apt install gh -y"
-                )
-                .pip_install("requests", "python-dotenv")
-                .run_commands("git config --global user.email 'agent@tinybackspace.com'")
-                .run_commands("git config --global user.name 'Tiny Backspace Agent'")
-            )
-            
-            print(f"✅ Modal sandbox initialized with secure cloud containers")
-            
-        except Exception as e:
-            raise Exception(f"Failed to initialize Modal: {str(e)}")
+    def __init__(self, pool=None):
+        """
+        Initialize Modal app and sandbox configuration.
+        
+        Args:
+            pool: Optional ModalSandboxPool to lease warm sandboxes from
+        """
+        self.pool = pool
+        self.sandbox_timeout = int(os.getenv("MODAL_SANDBOX_TIMEOUT", "600"))
+        self.sandbox = None
+        self.workspace_path = "/workspace/repo"
+        # Cleared when a command is abandoned mid-run, so the sandbox is not recycled
+        self.reusable = True
+        # Workspaces with a search index, refreshed as files are written
+        self._indexed_workspaces = set()
+        
+        # App handle and image are resolved once per process, so this is a local operation
+        self.app, self.image = resolve_modal_runtime()
         
     async def __aenter__(self):
         """Async context manager entry - create sandbox"""
@@ -52,11 +220,38 @@ class ModalSandbox:
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Async context manager exit - cleanup sandbox"""
         if self.sandbox:
-            try:
-                self.sandbox.terminate()
-                print("✅ Modal sandbox terminated")
-            except Exception as e:
-                print(f"Error terminating Modal sandbox: {e}")
+            # A failed or cancelled run may leave processes behind, so never recycle it
+            if exc_type is not None:
+                self.reusable = False
+            # Shielded so a client disconnect cannot interrupt releasing the sandbox
+            await asyncio.shield(self._release_sandbox())
+    
+    async def spawn_sandbox(self):
+        """Create a fresh Modal sandbox from this instance's app and image"""
+        with modal.enable_output():
+            return await modal.Sandbox.create.aio(
+                image=self.image,
+                app=self.app,
+                workdir=self.workspace_path,
+                timeout=self.sandbox_timeout,
+                verbose=True
+            )
+    
+    def _mark_not_reusable(self):
+        """Called when a command is abandoned; the sandbox is terminated on release"""
+        self.reusable = False
+    
+    async def _release_sandbox(self):
+        """Return the sandbox to the warm pool, or terminate it when unpooled"""
+        sandbox, self.sandbox = self.sandbox, None
+        if self.pool:
+            await self.pool.release(sandbox, reusable=self.reusable)
+            return
+        try:
+            await sandbox.terminate.aio()
+            print("✅ Modal sandbox terminated")
+        except Exception as e:
+            print(f"Error terminating Modal sandbox: {e}")
     
     async def create_workspace(self, repo_url: str) -> str:
         """
@@ -69,15 +264,11 @@ class ModalSandbox:
             workspace_id: Unique identifier for the sandbox
         """
         try:
-            # Create Modal sandbox with custom image
-            with modal.enable_output():
-                self.sandbox = modal.Sandbox.create(
-                    image=self.image,
-                    app=self.app,
-                    workdir=self.workspace_path,
-                    timeout=300,  # 5 minutes
-                    verbose=True
-                )
+            # Lease a warm sandbox from the pool, or cold-start one
+            if self.pool:
+                self.sandbox = await self.pool.lease()
+            else:
+                self.sandbox = await self.spawn_sandbox()
             
             # Generate workspace ID
             repo_name = repo_url.split('/')[-1].replace('.git', '')
@@ -89,85 +280,77 @@ class ModalSandbox:
         except Exception as e:
             raise Exception(f"Failed to create Modal sandbox: {str(e)}")
     
-    async def clone_repo(self, repo_url: str, workspace_id: str) -> AsyncGenerator[str, None]:
+    async def clone_repo(self, repo_url: str, workspace_id: str, strategy: CloneStrategy = None) -> AsyncGenerator[Event, None]:
         """
         Clone repository into the Modal sandbox.
         
         Args:
             repo_url: GitHub repository URL to clone
             workspace_id: Sandbox identifier
+            strategy: Clone strategy (full, shallow, partial or sparse); auto by default
             
         Yields:
-            Server-Sent Event formatted strings with progress updates
+            Event objects with progress updates
         """
-        yield f"data: {json.dumps({'type': 'sandbox', 'message': f'Creating Modal cloud sandbox: {workspace_id}'})}\n\n"
+        yield Event('sandbox', message=f'Creating Modal cloud sandbox: {workspace_id}')
         
         try:
-            yield f"data: {json.dumps({'type': 'sandbox', 'message': f'Cloning {repo_url} in Modal cloud...'})}\n\n"
+            strategy = await (strategy or CloneStrategy()).resolve(repo_url)
+            yield Event('sandbox', message=f'Cloning {repo_url} in Modal cloud ({strategy.describe()})...', clone_strategy=strategy.mode)
             
             # Clone repository in Modal sandbox
-            clone_process = self.sandbox.exec("git", "clone", repo_url, ".")
+            clone_process = await self.sandbox.exec.aio("git", "clone", *strategy.clone_args(), repo_url, ".")
             
             # Wait for clone to complete
-            exit_code = clone_process.wait()
+            exit_code = await clone_process.wait.aio()
+            
+            # Limit the checkout to the requested paths
+            if exit_code == 0 and strategy.is_sparse:
+                clone_process = await self.sandbox.exec.aio("git", *strategy.sparse_checkout_args())
+                exit_code = await clone_process.wait.aio()
             
             if exit_code == 0:
-                yield f"data: {json.dumps({'type': 'sandbox', 'message': 'Repository cloned successfully in Modal cloud'})}\n\n"
+                yield Event('sandbox', message='Repository cloned successfully in Modal cloud')
             else:
-                stderr_output = clone_process.stderr.read() if clone_process.stderr else "Unknown error"
-                yield f"data: {json.dumps({'type': 'error', 'message': f'Clone failed in Modal: {stderr_output}'})}\n\n"
+                stderr_output = await clone_process.stderr.read.aio() if clone_process.stderr else "Unknown error"
+                yield Event('error', message=f'Clone failed in Modal: {stderr_output}')
                 
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Modal clone error: {str(e)}'})}\n\n"
+            yield Event('error', message=f'Modal clone error: {str(e)}')
     
-    async def execute_command(self, command: str, workspace_id: str) -> AsyncGenerator[str, None]:
+    async def execute_command(self, command: str, workspace_id: str, timeout: float = None) -> AsyncGenerator[Event, None]:
         """
         Execute a shell command inside the Modal sandbox.
         
         Args:
             command: Shell command to execute
             workspace_id: Sandbox identifier
+            timeout: Seconds before the command is abandoned (defaults to COMMAND_TIMEOUT)
             
         Yields:
-            Server-Sent Event formatted strings with command output
+            Event objects with command output
         """
-        yield f"data: {json.dumps({'type': 'command', 'command': command, 'workspace': workspace_id, 'platform': 'modal-cloud'})}\n\n"
+        yield Event('command', command=command, workspace=workspace_id, platform='modal-cloud')
         
         try:
             # Execute command in Modal sandbox
-            process = self.sandbox.exec("bash", "-c", command)
-            
-            # Stream output in real-time
-            stdout_lines = []
-            stderr_lines = []
-            
-            # Read stdout
-            if process.stdout:
-                for line in process.stdout:
-                    stdout_lines.append(line.rstrip())
-            
-            # Read stderr  
-            if process.stderr:
-                stderr_content = process.stderr.read()
-                if stderr_content:
-                    stderr_lines.append(stderr_content.rstrip())
-            
-            # Wait for completion
-            exit_code = process.wait()
-            
-            # Stream outputs
-            if stdout_lines:
-                stdout_output = '\n'.join(stdout_lines)
-                yield f"data: {json.dumps({'type': 'command_output', 'output': stdout_output, 'exit_code': exit_code})}\n\n"
-            
-            if stderr_lines:
-                stderr_output = '\n'.join(stderr_lines)
-                yield f"data: {json.dumps({'type': 'command_error', 'error': stderr_output, 'exit_code': exit_code})}\n\n"
+            timeout = timeout or COMMAND_TIMEOUT
+            process = await self.sandbox.exec.aio("bash", "-c", command, timeout=int(timeout))
+            
+            # Drain stdout and stderr concurrently, forwarding each line as it arrives
+            async for event in _stream_process_output(
+                command,
+                {"stdout": process.stdout, "stderr": process.stderr},
+                process.wait.aio,
+                timeout,
+                self._mark_not_reusable
+            ):
+                yield event
                 
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Modal command error: {str(e)}'})}\n\n"
+            yield Event('error', message=f'Modal command error: {str(e)}')
     
-    async def execute_command_with_env(self, command: str, workspace_id: str, env_vars: dict = None) -> AsyncGenerator[str, None]:
+    async def execute_command_with_env(self, command: str, workspace_id: str, env_vars: dict = None, timeout: float = None) -> AsyncGenerator[Event, None]:
         """
         Execute a shell command with environment variables inside the Modal sandbox.
         
@@ -175,11 +358,12 @@ class ModalSandbox:
             command: Shell command to execute
             workspace_id: Sandbox identifier
             env_vars: Dictionary of environment variables
+            timeout: Seconds before the command is abandoned (defaults to COMMAND_TIMEOUT)
             
         Yields:
-            Server-Sent Event formatted strings with command output
+            Event objects with command output
         """
-        yield f"data: {json.dumps({'type': 'command', 'command': command, 'workspace': workspace_id, 'platform': 'modal-cloud'})}\n\n"
+        yield Event('command', command=command, workspace=workspace_id, platform='modal-cloud')
         
         try:
             # Prepare environment variables
@@ -189,37 +373,21 @@ class ModalSandbox:
                 command = f"{env_string} {command}"
             
             # Execute command in Modal sandbox
-            process = self.sandbox.exec("bash", "-c", command)
-            
-            # Stream output in real-time
-            stdout_lines = []
-            stderr_lines = []
-            
-            # Read stdout
-            if process.stdout:
-                for line in process.stdout:
-                    stdout_lines.append(line.rstrip())
-            
-            # Read stderr  
-            if process.stderr:
-                stderr_content = process.stderr.read()
-                if stderr_content:
-                    stderr_lines.append(stderr_content.rstrip())
-            
-            # Wait for completion
-            exit_code = process.wait()
-            
-            # Stream outputs
-            if stdout_lines:
-                stdout_output = '\n'.join(stdout_lines)
-                yield f"data: {json.dumps({'type': 'command_output', 'output': stdout_output, 'exit_code': exit_code})}\n\n"
-            
-            if stderr_lines:
-                stderr_output = '\n'.join(stderr_lines)
-                yield f"data: {json.dumps({'type': 'command_error', 'error': stderr_output, 'exit_code': exit_code})}\n\n"
+            timeout = timeout or COMMAND_TIMEOUT
+            process = await self.sandbox.exec.aio("bash", "-c", command, timeout=int(timeout))
+            
+            # Drain stdout and stderr concurrently, forwarding each line as it arrives
+            async for event in _stream_process_output(
+                command,
+                {"stdout": process.stdout, "stderr": process.stderr},
+                process.wait.aio,
+                timeout,
+                self._mark_not_reusable
+            ):
+                yield event
                 
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Modal command error: {str(e)}'})}\n\n"
+            yield Event('error', message=f'Modal command error: {str(e)}')
     
     async def read_file(self, file_path: str, workspace_id: str) -> str:
         """
@@ -234,46 +402,146 @@ class ModalSandbox:
         """
         try:
             # Read file using cat command in Modal
-            process = self.sandbox.exec("cat", file_path)
+            process = await self.sandbox.exec.aio("cat", file_path)
             
-            if process.wait() == 0:
-                content = process.stdout.read()
+            if await process.wait.aio() == 0:
+                content = await process.stdout.read.aio()
                 return content
+            
+            # Outside a sparse checkout: read from HEAD, fetching the blob lazily
+            process = await self.sandbox.exec.aio("git", "show", f"HEAD:{file_path}")
+            if await process.wait.aio() == 0:
+                return await process.stdout.read.aio()
             else:
-                error_msg = process.stderr.read() if process.stderr else "File not found"
+                error_msg = await process.stderr.read.aio() if process.stderr else "File not found"
                 return f"Error reading file {file_path}: {error_msg}"
                 
         except Exception as e:
             return f"Error reading file {file_path}: {str(e)}"
     
-    async def write_file(self, file_path: str, content: str, workspace_id: str) -> AsyncGenerator[str, None]:
+    async def write_files(self, files: Dict[str, str], workspace_id: str) -> AsyncGenerator[Event, None]:
         """
-        Write content to a file in the Modal sandbox.
+        Write several files to the Modal sandbox in one exec round trip.
         
         Args:
-            file_path: Path where to write the file
-            content: Content to write to the file
+            files: Mapping of file path to content
             workspace_id: Sandbox identifier
             
         Yields:
-            Server-Sent Event formatted strings with write progress
+            Event objects with one result per file
         """
-        yield f"data: {json.dumps({'type': 'file_write', 'file': file_path, 'workspace': workspace_id, 'platform': 'modal-cloud'})}\n\n"
+        yield Event('file_write', files=list(files), workspace=workspace_id, platform='modal-cloud')
         
         try:
-            # Create directory if needed
-            dir_path = os.path.dirname(file_path)
-            if dir_path:
-                self.sandbox.exec("mkdir", "-p", dir_path).wait()
-            
-            # Write file using Modal's file operations
-            with self.sandbox.open(file_path, "w") as f:
-                f.write(content)
+            results = json.loads(await self._exec_json_script(_WRITE_FILES_SCRIPT, files))
+        except Exception as e:
+            for file_path in files:
+                yield Event('error', file=file_path, message=f'Modal file write error: {str(e)}')
+            return
+        
+        written = [file_path for file_path, error in results.items() if error is None]
+        if written and workspace_id in self._indexed_workspaces:
+            # Keep search_code hits in line with the files just written
+            try:
+                request = {"action": "refresh", "index_path": f"{MODAL_SEARCH_INDEX_DIR}/{workspace_id}.index", "paths": written}
+                await self._exec_json_script(_SEARCH_SCRIPT, request)
+            except Exception as e:
+                print(f"Modal search index refresh error: {e}")
+        
+        for file_path, error in results.items():
+            if error is None:
+                yield Event('file_write_complete', file=file_path, location='modal-cloud')
+            else:
+                yield Event('error', file=file_path, message=f'Modal file write error: {error}')
+    
+    async def read_files(self, file_paths: List[str], workspace_id: str) -> Dict[str, str]:
+        """
+        Read several files from the Modal sandbox in one exec round trip.
+        
+        Args:
+            file_paths: Paths to read (files outside a sparse checkout are read from HEAD)
+            workspace_id: Sandbox identifier
             
-            yield f"data: {json.dumps({'type': 'file_write_complete', 'file': file_path, 'location': 'modal-cloud'})}\n\n"
-                
+        Returns:
+            Mapping of path to contents for every file that could be read
+        """
+        try:
+            return json.loads(await self._exec_json_script(_READ_FILES_SCRIPT, list(file_paths)))
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Modal file write error: {str(e)}'})}\n\n"
+            print(f"Modal batch read error: {e}")
+            return {}
+    
+    async def scan_manifest(self, workspace_id: str, top_n: int = 5, byte_budget: int = 65536, max_files: int = 5000) -> Dict:
+        """
+        Build the repository manifest (see manifest.build_manifest) in one exec round trip.
+        
+        Args:
+            workspace_id: Sandbox identifier
+            top_n: Maximum number of files whose contents are included
+            byte_budget: Maximum total size of included contents
+            max_files: Maximum number of file entries listed
+            
+        Returns:
+            Manifest dict with files, contents and totals
+        """
+        options = {"top_n": top_n, "byte_budget": byte_budget, "max_files": max_files}
+        return json.loads(await self._exec_json_script(_MANIFEST_SCRIPT, options))
+    
+    async def build_search_index(self, workspace_id: str, max_files: int = 50000) -> Dict:
+        """
+        Build the code search index (see code_search.CodeIndex) inside the sandbox.
+        
+        Args:
+            workspace_id: Sandbox identifier
+            max_files: Maximum number of files indexed
+            
+        Returns:
+            Index stats (files, skipped, chunks, terms)
+        """
+        request = {"action": "build", "index_path": f"{MODAL_SEARCH_INDEX_DIR}/{workspace_id}.index", "max_files": max_files}
+        stats = json.loads(await self._exec_json_script(_SEARCH_SCRIPT, request))
+        self._indexed_workspaces.add(workspace_id)
+        return stats
+    
+    async def search_code(self, query: str, workspace_id: str, limit: int = 10, path_prefix: Optional[str] = None) -> List[Dict]:
+        """
+        Search the workspace's code index in one exec round trip.
+        
+        Args:
+            query: Identifiers or keywords to look for
+            workspace_id: Sandbox identifier
+            limit: Maximum number of snippets
+            path_prefix: Only return files under this path
+            
+        Returns:
+            Ranked snippets with path, line range, score and text
+        """
+        request = {"action": "search", "index_path": f"{MODAL_SEARCH_INDEX_DIR}/{workspace_id}.index", "query": query, "limit": limit, "path_prefix": path_prefix}
+        return json.loads(await self._exec_json_script(_SEARCH_SCRIPT, request))
+    
+    async def export_search_index(self, workspace_id: str) -> bytes:
+        """Serialized search index of the workspace (see code_search.CodeIndex.to_bytes)"""
+        request = {"action": "export", "index_path": f"{MODAL_SEARCH_INDEX_DIR}/{workspace_id}.index"}
+        return base64.b64decode(await self._exec_json_script(_SEARCH_SCRIPT, request))
+    
+    async def import_search_index(self, workspace_id: str, data: bytes):
+        """Restore a serialized search index for the workspace instead of building one"""
+        request = {"action": "import", "index_path": f"{MODAL_SEARCH_INDEX_DIR}/{workspace_id}.index", "data": base64.b64encode(data).decode()}
+        await self._exec_json_script(_SEARCH_SCRIPT, request)
+        self._indexed_workspaces.add(workspace_id)
+    
+    async def _exec_json_script(self, script: str, payload) -> str:
+        """Run a Python helper in the sandbox with a JSON payload on stdin and return its stdout"""
+        process = await self.sandbox.exec.aio("python3", "-c", script, timeout=int(COMMAND_TIMEOUT))
+        process.stdin.write(json.dumps(payload).encode())
+        process.stdin.write_eof()
+        await process.stdin.drain.aio()
+        
+        output = await process.stdout.read.aio()
+        if await process.wait.aio() != 0:
+            error = await process.stderr.read.aio()
+            raise RuntimeError(error.strip() or "helper script failed")
+        return output
     
     async def cleanup_workspace(self, workspace_id: str):
         """
@@ -284,91 +552,253 @@ class ModalSandbox:
         """
         try:
             if self.sandbox:
-                self.sandbox.terminate()
-                self.sandbox = None
+                await self._release_sandbox()
                 print(f"✅ Cleaned up Modal sandbox: {workspace_id}")
         except Exception as e:
             print(f"Error cleaning up Modal sandbox: {e}")
 
 
+async def _read_chunks(reader: asyncio.StreamReader, size: int = 4096) -> AsyncIterator[bytes]:
+    """Iterate over a subprocess pipe in chunks (no line-length limit)"""
+    while True:
+        chunk = await reader.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _stream_process_output(
+    command: Optional[str],
+    streams: Dict[str, AsyncIterator],
+    wait_for_exit: Callable[[], Awaitable[int]],
+    timeout: Optional[float] = None,
+    kill: Optional[Callable[[], None]] = None
+) -> AsyncGenerator[Event, None]:
+    """
+    Drain several output streams of one process concurrently.
+    
+    Yields a CommandOutputLine per line, tagged with its stream name and a
+    sequence number, as soon as the line is available, and a final
+    CommandResult with the exit code, duration and collected output. Both
+    pipes are read at the same time, so a chatty stderr can never block a
+    process that is still writing to stdout.
+    
+    If the command runs past `timeout` seconds, or the consumer goes away
+    (cancellation, client disconnect), `kill` is called so the process does
+    not keep running unobserved.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+    
+    async def pump(name: str, source):
+        pending = ""
+        # Incremental, so a multibyte character split across chunks survives
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        try:
+            async for chunk in source:
+                if isinstance(chunk, bytes):
+                    chunk = decoder.decode(chunk)
+                pending += chunk
+                *lines, pending = pending.split("\n")
+                for line in lines:
+                    await queue.put((name, line))
+            pending += decoder.decode(b"", final=True)
+            if pending:
+                await queue.put((name, pending))
+        except Exception as e:
+            await queue.put((name, f"[{name} stream error: {e}]"))
+        finally:
+            await queue.put((name, None))
+    
+    tasks = [asyncio.create_task(pump(name, source)) for name, source in streams.items() if source is not None]
+    line_counts = {name: 0 for name in streams}
+    captured = {name: [] for name in streams}
+    captured_bytes = {name: 0 for name in streams}
+    open_streams = len(tasks)
+    seq = 0
+    started = time.perf_counter()
+    deadline = asyncio.get_running_loop().time() + timeout if timeout else None
+    exited = False
+    
+    def result(exit_code: Optional[int], timed_out: bool = False) -> CommandResult:
+        return CommandResult(
+            command,
+            exit_code,
+            "\n".join(captured.get("stdout", [])),
+            "\n".join(captured.get("stderr", [])),
+            (time.perf_counter() - started) * 1000,
+            seq + 1,
+            line_counts,
+            timed_out
+        )
+    
+    try:
+        try:
+            while open_streams:
+                name, line = await asyncio.wait_for(queue.get(), remaining(deadline))
+                if line is None:
+                    open_streams -= 1
+                    continue
+                seq += 1
+                line_counts[name] += 1
+                if captured_bytes[name] < MAX_CAPTURED_OUTPUT:
+                    captured[name].append(line)
+                    captured_bytes[name] += len(line) + 1
+                yield CommandOutputLine(name, seq, line)
+            
+            exit_code = await asyncio.wait_for(wait_for_exit(), remaining(deadline))
+            exited = True
+        except asyncio.TimeoutError:
+            if kill:
+                kill()
+            exited = True
+            yield Event('error', message=f'Command timed out after {timeout:g}s', timed_out=True)
+            yield result(None, timed_out=True)
+            return
+        
+        yield result(exit_code)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if not exited and kill:
+            kill()
+
+
+def _kill_process_group(process: asyncio.subprocess.Process):
+    """Kill a shell started with start_new_session=True and everything it spawned"""
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
 # Keep LocalSandbox as fallback
 class LocalSandbox:
     """Local sandbox fallback implementation"""
     
-    def __init__(self):
+    def __init__(self, repo_cache: RepoMirrorCache = None):
         self.work_dir = "/tmp/tiny-backspace-sandbox"
         os.makedirs(self.work_dir, exist_ok=True)
+        # Shared bare-mirror cache so hot repos are not re-cloned from the network
+        self.repo_cache = repo_cache
+        self._cached_repo_urls = []
+        # Workspaces are per request, so they are removed on exit unless kept for debugging
+        self.keep_workspaces = os.getenv("LOCAL_SANDBOX_KEEP_WORKSPACES", "").lower() in ("1", "true", "yes")
+        self._workspace_ids = []
+        # In-memory code search index per workspace (see code_search.py)
+        self._search_indexes: Dict[str, code_search.CodeIndex] = {}
         
     async def __aenter__(self):
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        pass
+        if not self.keep_workspaces:
+            for workspace_id in self._workspace_ids:
+                # Shielded so a client disconnect cannot interrupt the cleanup
+                await asyncio.shield(self.cleanup_workspace(workspace_id))
+        self._workspace_ids = []
+        
+        if self.repo_cache:
+            for repo_url in self._cached_repo_urls:
+                self.repo_cache.release(repo_url)
+            self._cached_repo_urls = []
     
     async def create_workspace(self, repo_url: str) -> str:
+        # Unique per request so concurrent sessions on the same repo never share a directory
         repo_name = repo_url.split('/')[-1].replace('.git', '')
-        workspace_id = f"local_{repo_name}"
+        workspace_id = f"local_{repo_name}_{uuid.uuid4().hex[:8]}"
+        self._workspace_ids.append(workspace_id)
         return workspace_id
     
-    async def clone_repo(self, repo_url: str, workspace_id: str) -> AsyncGenerator[str, None]:
+    async def clone_repo(self, repo_url: str, workspace_id: str, strategy: CloneStrategy = None) -> AsyncGenerator[Event, None]:
         workspace_path = f"{self.work_dir}/{workspace_id}"
         
-        yield f"data: {json.dumps({'type': 'sandbox', 'message': f'Preparing local workspace: {workspace_path}'})}\n\n"
+        yield Event('sandbox', message=f'Preparing local workspace: {workspace_path}')
         
         try:
             if os.path.exists(workspace_path):
                 shutil.rmtree(workspace_path)
             
-            yield f"data: {json.dumps({'type': 'sandbox', 'message': f'Cloning {repo_url}...'})}\n\n"
+            if self.repo_cache:
+                # The mirror always holds full history; only sparse paths apply to the checkout
+                requested = strategy or CloneStrategy("full")
+                strategy = requested.for_mirror_copy()
+                note = f', {requested.describe()} does not apply to a mirror copy' if requested.mode not in ("auto", strategy.mode) else ''
+                yield Event('sandbox', message=f'Copying {repo_url} from local mirror cache ({strategy.describe()}{note})...', clone_strategy=strategy.mode)
+                
+                try:
+                    result = await self.repo_cache.checkout(repo_url, workspace_path, strategy.sparse_checkout_args())
+                except Exception as e:
+                    yield Event('error', message=f'Clone failed: {str(e)}')
+                    return
+                
+                self._cached_repo_urls.append(repo_url)
+                source = 'cache hit' if result['cache_hit'] else 'new mirror'
+                yield Event('sandbox', message='Repository cloned successfully', cache_hit=result['cache_hit'], duration_ms=round(result['duration_ms'], 1), source=source, copy_method=result['copy_method'])
+                return
+            
+            strategy = await (strategy or CloneStrategy()).resolve(repo_url)
+            yield Event('sandbox', message=f'Cloning {repo_url} ({strategy.describe()})...', clone_strategy=strategy.mode)
             
             process = await asyncio.create_subprocess_exec(
-                'git', 'clone', repo_url, workspace_path,
+                'git', 'clone', *strategy.clone_args(), repo_url, workspace_path,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE
             )
             
             stdout, stderr = await process.communicate()
             
+            # Limit the checkout to the requested paths
+            if process.returncode == 0 and strategy.is_sparse:
+                process = await asyncio.create_subprocess_exec(
+                    'git', *strategy.sparse_checkout_args(),
+                    cwd=workspace_path,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                stdout, stderr = await process.communicate()
+            
             if process.returncode == 0:
-                yield f"data: {json.dumps({'type': 'sandbox', 'message': 'Repository cloned successfully'})}\n\n"
+                yield Event('sandbox', message='Repository cloned successfully')
             else:
                 error_msg = stderr.decode() if stderr else "Unknown clone error"
-                yield f"data: {json.dumps({'type': 'error', 'message': f'Clone failed: {error_msg}'})}\n\n"
+                yield Event('error', message=f'Clone failed: {error_msg}')
                 
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Clone error: {str(e)}'})}\n\n"
+            yield Event('error', message=f'Clone error: {str(e)}')
     
-    async def execute_command(self, command: str, workspace_id: str) -> AsyncGenerator[str, None]:
+    async def execute_command(self, command: str, workspace_id: str, timeout: float = None) -> AsyncGenerator[Event, None]:
         workspace_path = f"{self.work_dir}/{workspace_id}"
         
-        yield f"data: {json.dumps({'type': 'command', 'command': command, 'workspace': workspace_id})}\n\n"
+        yield Event('command', command=command, workspace=workspace_id)
         
         try:
             process = await asyncio.create_subprocess_shell(
                 command,
                 cwd=workspace_path,
                 stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
             )
             
-            stdout, stderr = await process.communicate()
-            
-            output = stdout.decode() if stdout else ""
-            error = stderr.decode() if stderr else ""
-            
-            if output:
-                yield f"data: {json.dumps({'type': 'command_output', 'output': output})}\n\n"
-            if error:
-                yield f"data: {json.dumps({'type': 'command_error', 'error': error})}\n\n"
+            # Drain stdout and stderr concurrently, forwarding each line as it arrives
+            async for event in _stream_process_output(
+                command,
+                {"stdout": _read_chunks(process.stdout), "stderr": _read_chunks(process.stderr)},
+                process.wait,
+                timeout or COMMAND_TIMEOUT,
+                lambda: _kill_process_group(process)
+            ):
+                yield event
                 
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Command error: {str(e)}'})}\n\n"
+            yield Event('error', message=f'Command error: {str(e)}')
     
-    async def execute_command_with_env(self, command: str, workspace_id: str, env_vars: dict = None) -> AsyncGenerator[str, None]:
+    async def execute_command_with_env(self, command: str, workspace_id: str, env_vars: dict = None, timeout: float = None) -> AsyncGenerator[Event, None]:
         """Execute command with environment variables - same as execute_command for local"""
         workspace_path = f"{self.work_dir}/{workspace_id}"
         
-        yield f"data: {json.dumps({'type': 'command', 'command': command, 'workspace': workspace_id})}\n\n"
+        yield Event('command', command=command, workspace=workspace_id)
         
         try:
             # Add environment variables to the process environment
@@ -381,49 +811,140 @@ class LocalSandbox:
                 cwd=workspace_path,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
-                env=env
+                env=env,
+                start_new_session=True
             )
             
-            stdout, stderr = await process.communicate()
-            
-            output = stdout.decode() if stdout else ""
-            error = stderr.decode() if stderr else ""
-            
-            if output:
-                yield f"data: {json.dumps({'type': 'command_output', 'output': output})}\n\n"
-            if error:
-                yield f"data: {json.dumps({'type': 'command_error', 'error': error})}\n\n"
+            # Drain stdout and stderr concurrently, forwarding each line as it arrives
+            async for event in _stream_process_output(
+                command,
+                {"stdout": _read_chunks(process.stdout), "stderr": _read_chunks(process.stderr)},
+                process.wait,
+                timeout or COMMAND_TIMEOUT,
+                lambda: _kill_process_group(process)
+            ):
+                yield event
                 
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'Command error: {str(e)}'})}\n\n"
+            yield Event('error', message=f'Command error: {str(e)}')
     
     async def read_file(self, file_path: str, workspace_id: str) -> str:
         full_path = f"{self.work_dir}/{workspace_id}/{file_path}"
         try:
             with open(full_path, 'r', encoding='utf-8') as f:
                 return f.read()
+        except FileNotFoundError as e:
+            # Outside a sparse checkout: read from HEAD, fetching the blob lazily
+            process = await asyncio.create_subprocess_exec(
+                'git', 'show', f'HEAD:{file_path}',
+                cwd=f"{self.work_dir}/{workspace_id}",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, _ = await process.communicate()
+            if process.returncode == 0:
+                return stdout.decode('utf-8', errors='replace')
+            return f"Error reading file {file_path}: {str(e)}"
         except Exception as e:
             return f"Error reading file {file_path}: {str(e)}"
     
-    async def write_file(self, file_path: str, content: str, workspace_id: str) -> AsyncGenerator[str, None]:
-        full_path = f"{self.work_dir}/{workspace_id}/{file_path}"
+    async def write_files(self, files: Dict[str, str], workspace_id: str) -> AsyncGenerator[Event, None]:
+        """Write several files in one worker-thread hop"""
+        yield Event('file_write', files=list(files), workspace=workspace_id)
         
-        yield f"data: {json.dumps({'type': 'file_write', 'file': file_path, 'workspace': workspace_id})}\n\n"
+        def write_all() -> Dict[str, Optional[str]]:
+            results = {}
+            for file_path, content in files.items():
+                full_path = f"{self.work_dir}/{workspace_id}/{file_path}"
+                try:
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    with open(full_path, 'w', encoding='utf-8') as f:
+                        f.write(content)
+                    results[file_path] = None
+                except Exception as e:
+                    results[file_path] = str(e)
+            # Keep search_code hits in line with the files just written
+            index = self._search_indexes.get(workspace_id)
+            if index is not None:
+                index.refresh([file_path for file_path, error in results.items() if error is None])
+            return results
         
-        try:
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-            
-            with open(full_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-                
-            yield f"data: {json.dumps({'type': 'file_write_complete', 'file': file_path})}\n\n"
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': f'File write error: {str(e)}'})}\n\n"
+        for file_path, error in (await asyncio.to_thread(write_all)).items():
+            if error is None:
+                yield Event('file_write_complete', file=file_path)
+            else:
+                yield Event('error', file=file_path, message=f'File write error: {error}')
+    
+    async def read_files(self, file_paths: List[str], workspace_id: str) -> Dict[str, str]:
+        """Read several files in one worker-thread hop; unreadable files are omitted"""
+        def read_all() -> Dict[str, str]:
+            contents, missing = {}, []
+            for file_path in file_paths:
+                try:
+                    with open(f"{self.work_dir}/{workspace_id}/{file_path}", 'r', encoding='utf-8') as f:
+                        contents[file_path] = f.read()
+                except FileNotFoundError:
+                    missing.append(file_path)
+                except Exception:
+                    pass
+            return contents, missing
+        
+        contents, missing = await asyncio.to_thread(read_all)
+        # Files outside a sparse checkout are read from HEAD
+        for file_path in missing:
+            content = await self.read_file(file_path, workspace_id)
+            if not content.startswith("Error reading file"):
+                contents[file_path] = content
+        return contents
+    
+    async def scan_manifest(self, workspace_id: str, top_n: int = 5, byte_budget: int = 65536, max_files: int = 5000) -> Dict:
+        """Build the repository manifest (see manifest.build_manifest) in a worker thread"""
+        return await asyncio.to_thread(
+            manifest.build_manifest, f"{self.work_dir}/{workspace_id}",
+            top_n=top_n, byte_budget=byte_budget, max_files=max_files
+        )
+    
+    async def build_search_index(self, workspace_id: str, max_files: int = 50000) -> Dict:
+        """Build the workspace's code search index in a worker thread and keep it in memory"""
+        index = await asyncio.to_thread(code_search.CodeIndex.build, f"{self.work_dir}/{workspace_id}", max_files)
+        self._search_indexes[workspace_id] = index
+        return index.stats()
+    
+    async def search_code(self, query: str, workspace_id: str, limit: int = 10, path_prefix: Optional[str] = None) -> List[Dict]:
+        """Search the workspace's code index (see code_search.CodeIndex.search)"""
+        index = self._search_indexes.get(workspace_id)
+        if index is None:
+            raise RuntimeError(f"No search index for workspace {workspace_id}")
+        return await asyncio.to_thread(index.search, query, limit, path_prefix)
+    
+    async def export_search_index(self, workspace_id: str) -> bytes:
+        """Serialized search index of the workspace (see code_search.CodeIndex.to_bytes)"""
+        return await asyncio.to_thread(self._search_indexes[workspace_id].to_bytes)
+    
+    async def import_search_index(self, workspace_id: str, data: bytes):
+        """Restore a serialized search index for the workspace instead of building one"""
+        index = await asyncio.to_thread(code_search.CodeIndex.from_bytes, data, f"{self.work_dir}/{workspace_id}")
+        self._search_indexes[workspace_id] = index
     
     async def cleanup_workspace(self, workspace_id: str):
+        self._search_indexes.pop(workspace_id, None)
         workspace_path = f"{self.work_dir}/{workspace_id}"
         try:
             if os.path.exists(workspace_path):
-                shutil.rmtree(workspace_path)
+                await asyncio.to_thread(shutil.rmtree, workspace_path)
         except Exception:
-            pass
\ No newline at end of file
+            pass
+
+
+if __name__ == "__main__":
+    import sys
+    
+    if sys.argv[1:] == ["build-image"]:
+        # Build the pinned agent image ahead of time and print its id and spec hash for .env
+        app = modal.App.lookup(MODAL_APP_NAME, create_if_missing=True)
+        image = build_agent_image()
+        image.build(app)
+        print(f"MODAL_AGENT_IMAGE_ID={image.object_id}")
+        print(f"MODAL_AGENT_IMAGE_SPEC={agent_image_spec_hash()}")
+    else:
+        print("Usage: python sandbox.py build-image")
@@ -0,0 +1,221 @@
+import os
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Any, Optional, Tuple
+from sandbox import ModalSandbox
+
+
+class ModalSandboxPool:
+    """
+    Warm pool of pre-provisioned Modal sandboxes.
+
+    Keeps up to `size` idle sandboxes built from the ModalSandbox image so a
+    request can lease one instead of paying Modal's cold start. Released
+    sandboxes are wiped and returned to the pool. A sandbox is retired
+    (terminated, and a background task refills the pool) once it has sat
+    idle longer than the idle TTL, or once less than min_remaining seconds
+    are left before MODAL_SANDBOX_TIMEOUT ends it, so a leased sandbox
+    always outlives the job it is leased for.
+    """
+
+    def __init__(self, size: Optional[int] = None, idle_ttl: Optional[float] = None, min_remaining: Optional[float] = None):
+        self.size = size if size is not None else int(os.getenv("MODAL_POOL_SIZE", "2"))
+        # Longest a sandbox may sit idle in the pool
+        self.idle_ttl = idle_ttl if idle_ttl is not None else float(os.getenv("MODAL_POOL_IDLE_TTL", "180"))
+        # Lifetime a sandbox must have left to be leased: the longest a job is expected to run
+        self.min_remaining = min_remaining if min_remaining is not None else float(os.getenv("MODAL_POOL_MIN_REMAINING", "300"))
+        self.sandbox_timeout = float(os.getenv("MODAL_SANDBOX_TIMEOUT", "600"))
+        self.refill_interval = float(os.getenv("MODAL_POOL_REFILL_INTERVAL", "5"))
+
+        self._template: Optional[ModalSandbox] = None
+        # (sandbox, time it became idle)
+        self._idle: Deque[Tuple[Any, float]] = deque()
+        self._created_at: Dict[str, float] = {}
+        self._leased = 0
+        self._wakeup = asyncio.Event()
+        self._refill_task: Optional[asyncio.Task] = None
+
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "created": 0,
+            "recycled": 0,
+            "terminated": 0,
+            "expired": 0,
+            "create_failures": 0,
+            "refill_errors": 0,
+            "lease_wait_ms_total": 0.0,
+            "lease_wait_ms_max": 0.0,
+        }
+
+    async def start(self):
+        """Resolve the sandbox image and start the background refill task"""
+        if self._refill_task:
+            return
+        self._template = ModalSandbox()
+        self.sandbox_timeout = self._template.sandbox_timeout
+        if self.sandbox_timeout <= self.min_remaining:
+            print(f"⚠️  MODAL_SANDBOX_TIMEOUT ({self.sandbox_timeout:.0f}s) leaves no pooled sandbox {self.min_remaining:.0f}s of lifetime; every lease will cold-start")
+        self._refill_task = asyncio.create_task(self._refill_loop())
+        print(f"✅ Modal sandbox pool started (size={self.size}, idle_ttl={self.idle_ttl:.0f}s, min_remaining={self.min_remaining:.0f}s)")
+
+    async def stop(self):
+        """Stop refilling and terminate every idle sandbox"""
+        if self._refill_task:
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+            self._refill_task = None
+
+        while self._idle:
+            sandbox, _ = self._idle.popleft()
+            await self._terminate(sandbox)
+
+    async def lease(self):
+        """Take an idle sandbox from the pool, or cold-start one on a miss"""
+        start = time.perf_counter()
+        sandbox = None
+
+        while self._idle:
+            candidate, idle_since = self._idle.popleft()
+            if self._is_expired(candidate, idle_since) or not await self._is_alive(candidate):
+                self.metrics["expired"] += 1
+                await self._terminate(candidate)
+                continue
+            sandbox = candidate
+            break
+
+        if sandbox is not None:
+            self.metrics["hits"] += 1
+        else:
+            self.metrics["misses"] += 1
+            sandbox = await self._create()
+
+        self._leased += 1
+        self._wakeup.set()
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        self.metrics["lease_wait_ms_total"] += wait_ms
+        self.metrics["lease_wait_ms_max"] = max(self.metrics["lease_wait_ms_max"], wait_ms)
+        return sandbox
+
+    async def release(self, sandbox, reusable: bool = True):
+        """Reset a leased sandbox and put it back in the pool, or terminate it"""
+        self._leased = max(0, self._leased - 1)
+
+        if (
+            not reusable
+            or self._refill_task is None
+            or len(self._idle) >= self.size
+            or self._is_expired(sandbox, time.time())
+            or not await self._reset(sandbox)
+            # The pool may have filled up during the reset
+            or len(self._idle) >= self.size
+        ):
+            await self._terminate(sandbox)
+        else:
+            self._idle.append((sandbox, time.time()))
+            self.metrics["recycled"] += 1
+
+        self._wakeup.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of pool configuration and counters"""
+        leases = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "leased": self._leased,
+            "idle_ttl_seconds": self.idle_ttl,
+            "min_remaining_seconds": self.min_remaining,
+            "hit_rate": self.metrics["hits"] / leases if leases else 0.0,
+            "lease_wait_ms_avg": self.metrics["lease_wait_ms_total"] / leases if leases else 0.0,
+            **self.metrics,
+        }
+
+    async def _refill_loop(self):
+        """Evict expired sandboxes and top the pool back up to its target size"""
+        while True:
+            try:
+                await self._refill()
+            except Exception as e:
+                # Keep the loop alive; the next wakeup or interval tries again
+                self.metrics["refill_errors"] += 1
+                print(f"Error refilling Modal sandbox pool: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _refill(self):
+        # Take the expired sandboxes out before awaiting anything, so a lease()
+        # running during a terminate never sees (or races on) them
+        expired = [item for item in self._idle if self._is_expired(*item)]
+        for item in expired:
+            self._idle.remove(item)
+        for sandbox, _ in expired:
+            self.metrics["expired"] += 1
+            await self._terminate(sandbox)
+
+        deficit = self.size - len(self._idle)
+        if deficit > 0:
+            results = await asyncio.gather(
+                *[self._create() for _ in range(deficit)],
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    continue
+                # Releases during the gather may have filled the pool already
+                if len(self._idle) >= self.size:
+                    await self._terminate(result)
+                else:
+                    self._idle.append((result, time.time()))
+
+    async def _create(self):
+        template = self._template or ModalSandbox()
+        try:
+            sandbox = await template.spawn_sandbox()
+        except Exception as e:
+            self.metrics["create_failures"] += 1
+            print(f"Error creating pooled Modal sandbox: {e}")
+            raise
+        self._created_at[sandbox.object_id] = time.time()
+        self.metrics["created"] += 1
+        return sandbox
+
+    async def _reset(self, sandbox) -> bool:
+        """Wipe the workspace so the next lease starts from a clean directory"""
+        workspace_path = self._template.workspace_path if self._template else "/workspace/repo"
+        try:
+            process = await sandbox.exec.aio("bash", "-c", f"find {workspace_path} -mindepth 1 -delete")
+            return await process.wait.aio() == 0
+        except Exception as e:
+            print(f"Error resetting pooled Modal sandbox: {e}")
+            return False
+
+    async def _is_alive(self, sandbox) -> bool:
+        try:
+            return await sandbox.poll.aio() is None
+        except Exception:
+            return False
+
+    async def _terminate(self, sandbox):
+        self._created_at.pop(sandbox.object_id, None)
+        self.metrics["terminated"] += 1
+        try:
+            await sandbox.terminate.aio()
+        except Exception as e:
+            print(f"Error terminating pooled Modal sandbox: {e}")
+
+    def _is_expired(self, sandbox, idle_since: float) -> bool:
+        """Idle too long, or too close to MODAL_SANDBOX_TIMEOUT to finish a job"""
+        now = time.time()
+        created_at = self._created_at.get(sandbox.object_id, 0.0)
+        lifetime_left = created_at + self.sandbox_timeout - now
+        return now - idle_since > self.idle_ttl or lifetime_left < self.min_remaining
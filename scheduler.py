@@ -0,0 +1,228 @@
+import os
+import math
+import time
+import asyncio
+import hashlib
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# Jobs one tenant may have running at once (the global limit is JOB_WORKERS)
+TENANT_MAX_RUNNING = int(os.getenv("TENANT_MAX_RUNNING", "2"))
+# Queued jobs allowed per tenant and in total before new ones get a 429
+TENANT_MAX_QUEUED = int(os.getenv("TENANT_MAX_QUEUED", "10"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "100"))
+# Scheduling weights, e.g. "repo:acme/api=2,key:3f9a1c2b4d5e=0.5" (default 1)
+TENANT_WEIGHTS = os.getenv("TENANT_WEIGHTS", "")
+# Assumed job duration until real runs have been measured, in seconds
+INITIAL_JOB_SECONDS = 60.0
+
+
+def tenant_id(api_key: Optional[str], repo_url: str) -> str:
+    """Tenant a request is accounted to: its API key if it sent one, else its repository"""
+    if api_key:
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+    owner_repo = "/".join(repo_url.rstrip('/').removesuffix('.git').split('/')[-2:])
+    return f"repo:{owner_repo}"
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    weights = {}
+    for item in spec.split(","):
+        if "=" in item:
+            tenant, weight = item.rsplit("=", 1)
+            if float(weight) > 0:
+                weights[tenant.strip()] = float(weight)
+    return weights
+
+
+class AdmissionError(Exception):
+    """Raised when a queue is full; retry_after is a hint in seconds"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def tenant_metrics() -> Dict[str, Any]:
+    return {"admitted": 0, "rejected": 0, "dispatched": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+
+class TenantState:
+    """
+    Queue, running count and virtual finish tag for one tenant with work.
+    metrics is the tenant's counter dict, which outlives this state.
+    """
+
+    def __init__(self, tenant: str, weight: float, metrics: Dict[str, Any]):
+        self.tenant = tenant
+        self.weight = weight
+        self.queue: Deque[Tuple[Any, float]] = deque()
+        self.running = 0
+        self.finish_tag = 0.0
+        self.metrics = metrics
+
+
+class FairScheduler:
+    """
+    Admission control and weighted fair queuing across tenants.
+
+    admit() rejects work with an AdmissionError (a 429 at the HTTP layer)
+    once the tenant's or the global queue is full. Workers call next() to
+    take the queued item whose tenant has the smallest virtual start time
+    (start-time fair queuing): every dispatch advances the tenant's tag by
+    1 / weight, so a tenant with a long backlog cannot starve the others,
+    and an idle tenant cannot bank credit. Tenants already at their running
+    limit are skipped until one of their jobs finishes.
+    """
+
+    def __init__(
+        self,
+        tenant_max_running: int = None,
+        tenant_max_queued: int = None,
+        max_queued: int = None,
+        weights: Dict[str, float] = None
+    ):
+        self.tenant_max_running = tenant_max_running if tenant_max_running is not None else TENANT_MAX_RUNNING
+        self.tenant_max_queued = tenant_max_queued if tenant_max_queued is not None else TENANT_MAX_QUEUED
+        self.max_queued = max_queued if max_queued is not None else JOB_QUEUE_MAX
+        self.weights = weights if weights is not None else parse_weights(TENANT_WEIGHTS)
+
+        # Scheduling state exists only while a tenant has queued or running work;
+        # its counters are kept for the life of the process
+        self._tenants: Dict[str, TenantState] = {}
+        self._tenant_metrics: Dict[str, Dict[str, Any]] = {}
+        self._virtual_time = 0.0
+        self._queued = 0
+        self._running = 0
+        self._workers = 1
+        self._job_seconds = INITIAL_JOB_SECONDS
+        self._wakeup = asyncio.Event()
+        self.metrics = {"admitted": 0, "rejected": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "dispatched": 0}
+
+    def set_workers(self, workers: int):
+        """Number of workers calling next(), used for Retry-After estimates"""
+        self._workers = max(1, workers)
+
+    def admit(self, tenant: str, item: Any, force: bool = False):
+        """Queue an item for a tenant, or raise AdmissionError when full (force skips the limits)"""
+        state = self._tenant(tenant)
+        if not force:
+            if len(state.queue) >= self.tenant_max_queued:
+                self._reject(state)
+                slots = max(1, min(self.tenant_max_running, self._workers))
+                raise AdmissionError(f"Too many queued jobs for {tenant}", self._estimate(len(state.queue) / slots))
+            if self._queued >= self.max_queued:
+                self._reject(state)
+                raise AdmissionError("Job queue is full", self._estimate(self._queued / self._workers))
+
+        state.queue.append((item, time.perf_counter()))
+        state.metrics["admitted"] += 1
+        self.metrics["admitted"] += 1
+        self._queued += 1
+        self._notify()
+
+    async def next(self) -> Tuple[str, Any]:
+        """Wait for and claim the next item to run; pair with done()"""
+        while True:
+            wakeup = self._wakeup
+            state = self._pick()
+            if state is not None:
+                break
+            await wakeup.wait()
+
+        item, queued_at = state.queue.popleft()
+        start_tag = max(self._virtual_time, state.finish_tag)
+        state.finish_tag = start_tag + 1 / state.weight
+        self._virtual_time = start_tag
+        state.running += 1
+        self._queued -= 1
+        self._running += 1
+
+        wait_ms = (time.perf_counter() - queued_at) * 1000
+        for metrics in (state.metrics, self.metrics):
+            metrics["dispatched"] += 1
+            metrics["wait_ms_total"] += wait_ms
+            metrics["wait_ms_max"] = max(metrics["wait_ms_max"], wait_ms)
+        return state.tenant, item
+
+    def done(self, tenant: str, duration: float):
+        """Release a tenant's running slot and fold the run time into the estimate"""
+        state = self._tenants[tenant]
+        state.running -= 1
+        self._running -= 1
+        self._job_seconds = 0.8 * self._job_seconds + 0.2 * duration
+        if not state.queue and not state.running:
+            # Nothing left to schedule; its tag is re-based on the next admit
+            # (the tenant's counters stay in _tenant_metrics)
+            del self._tenants[tenant]
+        self._notify()
+
+    def remove(self, tenant: str, item: Any) -> bool:
+        """Withdraw a still queued item; False if it was already dispatched or never queued"""
+        state = self._tenants.get(tenant)
+        if state is None:
+            return False
+        for index, (queued_item, _) in enumerate(state.queue):
+            if queued_item is item:
+                del state.queue[index]
+                self._queued -= 1
+                if not state.queue and not state.running:
+                    del self._tenants[tenant]
+                self._notify()
+                return True
+        return False
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def stats(self) -> Dict[str, Any]:
+        dispatched = self.metrics["dispatched"]
+        return {
+            "queued": self._queued,
+            "running": self._running,
+            "max_queued": self.max_queued,
+            "tenant_max_running": self.tenant_max_running,
+            "tenant_max_queued": self.tenant_max_queued,
+            "job_seconds_estimate": round(self._job_seconds, 1),
+            "wait_ms_avg": self.metrics["wait_ms_total"] / dispatched if dispatched else 0.0,
+            **self.metrics,
+            "tenants": {
+                tenant: {
+                    "weight": self.weights.get(tenant, 1.0),
+                    "queued": len(self._tenants[tenant].queue) if tenant in self._tenants else 0,
+                    "running": self._tenants[tenant].running if tenant in self._tenants else 0,
+                    "wait_ms_avg": metrics["wait_ms_total"] / metrics["dispatched"] if metrics["dispatched"] else 0.0,
+                    **metrics,
+                }
+                for tenant, metrics in self._tenant_metrics.items()
+            },
+        }
+
+    def _tenant(self, tenant: str) -> TenantState:
+        if tenant not in self._tenants:
+            metrics = self._tenant_metrics.setdefault(tenant, tenant_metrics())
+            self._tenants[tenant] = TenantState(tenant, self.weights.get(tenant, 1.0), metrics)
+        return self._tenants[tenant]
+
+    def _pick(self) -> Optional[TenantState]:
+        eligible = [
+            state for state in self._tenants.values()
+            if state.queue and state.running < self.tenant_max_running
+        ]
+        if not eligible:
+            return None
+        return min(eligible, key=lambda state: (max(self._virtual_time, state.finish_tag), state.queue[0][1]))
+
+    def _reject(self, state: TenantState):
+        state.metrics["rejected"] += 1
+        self.metrics["rejected"] += 1
+        if not state.queue and not state.running:
+            del self._tenants[state.tenant]
+
+    def _estimate(self, jobs_ahead: float) -> float:
+        return max(1.0, math.ceil(jobs_ahead * self._job_seconds))
+
+    def _notify(self):
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
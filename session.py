@@ -0,0 +1,58 @@
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+
+def new_session_id() -> str:
+    return f"session_{uuid.uuid4().hex[:12]}"
+
+
+class CodingSession:
+    """
+    Per-request state for a single /code run.
+
+    One CodingAgent (and its ClaudeCodeAnalyst) is shared by every request in
+    the process, so anything that belongs to a single run lives here and is
+    threaded through the pipeline instead of being stored on those objects.
+    """
+
+    def __init__(self, repo_url: str, prompt: str, clone_strategy=None, session_id: str = None, bypass_llm_cache: bool = False, tenant: str = None):
+        self.session_id = session_id or new_session_id()
+        self.repo_url = repo_url
+        self.prompt = prompt
+        self.started_at = time.time()
+        # Who the run is billed to (see scheduler.tenant_id); None outside the job queue
+        self.tenant = tenant
+
+        # How the repository is cloned (a CloneStrategy, resolved before cloning)
+        self.clone_strategy = clone_strategy
+
+        # Skip the LLM response cache for this run (always call the model)
+        self.bypass_llm_cache = bypass_llm_cache
+
+        # Sandbox handle and workspace for this run
+        self.sandbox = None
+        self.workspace_id: Optional[str] = None
+
+        # Repository manifest from the single-pass scan (see manifest.py)
+        self.manifest: Dict[str, Any] = {}
+        # Codebase context packed for the prompt (a context_packer.ContextPack)
+        self.context = None
+
+        # Results produced by Claude's tools
+        self.analysis_result: Dict[str, Any] = {}
+        # True when analysis_result came from the analysis cache (no analysis turn)
+        self.analysis_cached = False
+
+        # Token usage of each Claude turn (see ClaudeCodeAnalyst._stream_turn)
+        self.llm_turns: List[Dict[str, Any]] = []
+        # Why the model step fell back, once the resilience layer gave up
+        self.llm_error: Optional[str] = None
+
+        # Telemetry span for the whole session
+        self.span = None
+
+    def attach_sandbox(self, sandbox, workspace_id: str):
+        """Bind the sandbox and workspace that tool calls should operate on"""
+        self.sandbox = sandbox
+        self.workspace_id = workspace_id
@@ -4,7 +4,9 @@ from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, Spa
 from opentelemetry.sdk.resources import Resource
 import json
 import time
-from typing import Dict, Any, Sequence, List
+import asyncio
+from collections import deque
+from typing import Dict, Any, Sequence
 from datetime import datetime
 
 # Enhanced Console Exporter with LangSmith-style formatting
@@ -116,12 +118,16 @@ class EnhancedCodingAgentTelemetry:
     
     def __init__(self):
         self.tracer = trace.get_tracer("enhanced-coding-agent")
-        self.current_span = None
         self.session_metrics = {}
     
-    def start_coding_session(self, repo_url: str, prompt: str):
-        """Start enhanced coding session with LangSmith-style context"""
-        self.current_span = self.tracer.start_span(
+    def start_coding_session(self, repo_url: str, prompt: str, session_id: str = None):
+        """
+        Start enhanced coding session with LangSmith-style context.
+        
+        The returned span belongs to the caller's session and must be passed
+        back to finish_coding_session; nothing is kept on this shared instance.
+        """
+        session_span = self.tracer.start_span(
             "ai_coding_session",
             attributes={
                 "session.repo_url": repo_url,
@@ -130,18 +136,18 @@ class EnhancedCodingAgentTelemetry:
                 "ai.model": "claude-3.5-sonnet",
                 "ai.framework": "anthropic-tools",
                 "session.start_time": time.time(),
-                "session.id": f"session_{int(time.time())}"
+                "session.id": session_id or f"session_{int(time.time())}"
             }
         )
         
         # Add prompt analysis
-        self.current_span.add_event("session_started", {
+        session_span.add_event("session_started", {
             "prompt_complexity": self._analyze_prompt_complexity(prompt),
             "expected_file_count": self._estimate_file_count(prompt),
             "project_type": self._detect_project_type(prompt)
         })
         
-        return self.current_span
+        return session_span
     
     def trace_claude_tool_execution(self, tool_name: str, input_data: dict, output_data: dict, duration_ms: float):
         """Track Claude's tool usage with detailed metrics"""
@@ -179,21 +185,48 @@ class EnhancedCodingAgentTelemetry:
                 "confidence_level": "high" if confidence > 0.8 else "medium" if confidence > 0.5 else "low"
             })
     
-    def trace_multi_turn_conversation(self, turn_number: int, prompt: str, response: str, tools_used: List[str]):
-        """Track multi-turn Claude conversations"""
-        with self.tracer.start_span("claude_conversation_turn") as span:
+    def trace_multi_turn_conversation(self, session_span, turn_number: int, turn: Dict[str, Any]):
+        """
+        Track one Claude turn (a session.llm_turns entry) as a child of the
+        session span, timed from the turn's recorded start and duration
+        """
+        context = trace.set_span_in_context(session_span) if session_span else None
+        start_time = int(turn["started_at"] * 1e9)
+        end_time = start_time + int(turn["duration_ms"] * 1e6)
+        span = self.tracer.start_span("claude_conversation_turn", context=context, start_time=start_time)
+        try:
             span.set_attributes({
                 "claude.turn_number": turn_number,
-                "claude.prompt_tokens": len(prompt.split()),
-                "claude.response_tokens": len(response.split()),
-                "claude.tools_used_count": len(tools_used),
-                "claude.tools_list": json.dumps(tools_used)
+                "claude.turn": turn["turn"],
+                "claude.model": turn["model"],
+                "claude.replayed": turn["cached"],
+                "claude.attempts": turn["attempts"],
+                "claude.input_tokens": turn["input_tokens"],
+                "claude.output_tokens": turn["output_tokens"],
+                "claude.cache_read_input_tokens": turn["cache_read_input_tokens"],
+                "claude.cache_creation_input_tokens": turn["cache_creation_input_tokens"],
+                "claude.stop_reason": turn["stop_reason"] or "none",
+                "claude.cost_usd": turn["cost_usd"],
+                "claude.ttft_ms": turn["ttft_ms"] if turn["ttft_ms"] is not None else -1,
+                "claude.model_ms": turn["model_ms"],
+                "claude.duration_ms": turn["duration_ms"],
+                "claude.tools_used_count": len(turn["tools"]),
+                "claude.tools_list": json.dumps(turn["tools"])
             })
             
             span.add_event("conversation_turn", {
                 "turn": turn_number,
-                "tools_called": tools_used,
-                "response_preview": response[:200] + "..." if len(response) > 200 else response
+                "tools_called": turn["tools"],
+                "error": turn.get("error", "")
+            }, timestamp=end_time)
+        finally:
+            span.end(end_time=end_time)
+    
+    def trace_llm_usage(self, session_span, summary: Dict[str, Any]):
+        """Attach a session's model usage totals (see llm_usage.summarize_turns) to its span"""
+        if session_span:
+            session_span.set_attributes({
+                f"llm.{key}": value for key, value in summary.items() if value is not None
             })
     
     def trace_performance_metrics(self, operation: str, metrics: dict):
@@ -309,14 +342,14 @@ class EnhancedCodingAgentTelemetry:
         else:
             return 'general'
     
-    def finish_coding_session(self, success: bool, pr_url: str = None):
+    def finish_coding_session(self, session_span, success: bool, pr_url: str = None):
         """Complete session with comprehensive metrics"""
-        if self.current_span:
+        if session_span:
             end_time = time.time()
-            start_time = self.current_span.attributes.get('session.start_time', end_time)
+            start_time = session_span.attributes.get('session.start_time', end_time)
             total_duration = (end_time - start_time) * 1000  # Convert to ms
             
-            self.current_span.set_attributes({
+            session_span.set_attributes({
                 "session.success": success,
                 "session.total_duration_ms": total_duration,
                 "session.pr_created": bool(pr_url),
@@ -324,19 +357,73 @@ class EnhancedCodingAgentTelemetry:
             })
             
             if pr_url:
-                self.current_span.set_attribute("session.pr_url", pr_url)
+                session_span.set_attribute("session.pr_url", pr_url)
             
             # Add final session summary
-            self.current_span.add_event("session_completed", {
+            session_span.add_event("session_completed", {
                 "outcome": "success" if success else "failure",
                 "total_time_seconds": total_duration / 1000,
                 "pr_generated": bool(pr_url)
             })
             
-            self.current_span.end()
+            session_span.end()
+
+class EventLoopLagMonitor:
+    """
+    Measures event loop responsiveness by timing how late a periodic sleep
+    wakes up. Any blocking call on the loop (e.g. a synchronous SDK request)
+    shows up as lag, and every session streaming at that moment stalls with it.
+    """
+    
+    def __init__(self, interval: float = 0.1, stall_threshold_ms: float = 100.0):
+        self.interval = interval
+        self.stall_threshold_ms = stall_threshold_ms
+        self.samples = deque(maxlen=1000)
+        self.max_lag_ms = 0.0
+        self.stalls = 0
+        self._task = None
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (loop.time() - start - self.interval) * 1000)
+            self.samples.append(lag_ms)
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            if lag_ms > self.stall_threshold_ms:
+                self.stalls += 1
+                print(f"⚠️  Event loop blocked for {lag_ms:.0f}ms")
+    
+    def stats(self) -> Dict[str, Any]:
+        """Recent lag distribution plus lifetime max and stall count"""
+        ordered = sorted(self.samples)
+        return {
+            "samples": len(ordered),
+            "lag_ms_avg": sum(ordered) / len(ordered) if ordered else 0.0,
+            "lag_ms_p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] if ordered else 0.0,
+            "lag_ms_max": self.max_lag_ms,
+            "stalls_over_threshold": self.stalls,
+            "stall_threshold_ms": self.stall_threshold_ms,
+        }
 
 # Global enhanced telemetry instance
 enhanced_telemetry = EnhancedCodingAgentTelemetry()
 
 # Backward compatibility - create alias for old telemetry
-telemetry = enhanced_telemetry
\ No newline at end of file
+telemetry = enhanced_telemetry
+# Process-wide event loop lag monitor (started by the app on startup)
+loop_monitor = EventLoopLagMonitor()
@@ -0,0 +1,17 @@
+import pytest
+
+from sandbox import agent_image_spec_hash, check_agent_image_spec
+
+
+def test_matching_spec_is_accepted():
+    check_agent_image_spec("im-current", agent_image_spec_hash())
+
+
+def test_stale_spec_fails():
+    with pytest.raises(RuntimeError, match="build-image"):
+        check_agent_image_spec("im-old", "000000000000")
+
+
+def test_missing_spec_only_warns(capsys):
+    check_agent_image_spec("im-unknown", None)
+    assert "cannot verify" in capsys.readouterr().out
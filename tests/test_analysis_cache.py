@@ -0,0 +1,61 @@
+import asyncio
+
+from analysis_cache import AnalysisCache, AnalysisEntry
+
+
+def entry(head_sha, files=1):
+    manifest = {"files": [{"path": f"f{i}.py"} for i in range(files)], "contents": {}}
+    return AnalysisEntry("https://github.com/o/r", head_sha, manifest, {"summary": "ok"}, b"index", {"files": files}, {"scan": 12.0})
+
+
+def test_entries_survive_a_restart_through_sqlite(tmp_path):
+    path = str(tmp_path / "analysis.db")
+
+    async def store():
+        await AnalysisCache(mode="sqlite", path=path).put("https://github.com/o/r", "abc", entry("abc"))
+
+    async def load():
+        cache = AnalysisCache(mode="sqlite", path=path)
+        # URL spelling does not split the cache
+        return cache, await cache.get("https://github.com/O/r.git", "abc"), await cache.get("https://github.com/o/r", "abc", "sparse")
+
+    asyncio.run(store())
+    cache, hit, other_variant = asyncio.run(load())
+
+    assert (hit.analysis, hit.search_index, hit.cost_ms) == ({"summary": "ok"}, b"index", {"scan": 12.0})
+    assert other_variant is None
+    assert (cache.metrics["hits"], cache.metrics["misses"]) == (1, 1)
+
+
+def test_memory_is_bounded_by_entry_count():
+    async def main():
+        cache = AnalysisCache(mode="memory", memory_entries=2)
+        for head_sha in ("a", "b", "c"):
+            await cache.put("https://github.com/o/r", head_sha, entry(head_sha))
+        return cache, [await cache.get("https://github.com/o/r", head_sha) is not None for head_sha in ("a", "b", "c")]
+
+    cache, found = asyncio.run(main())
+    assert found == [False, True, True]
+    assert cache.stats()["memory_entries"] == 2
+
+
+def test_disk_evicts_least_recently_used_past_max_bytes(tmp_path):
+    async def main():
+        cache = AnalysisCache(mode="sqlite", path=str(tmp_path / "analysis.db"), memory_entries=0, max_bytes=1)
+        await cache.put("https://github.com/o/r", "a", entry("a"))
+        await cache.put("https://github.com/o/r", "b", entry("b"))
+        return cache, await cache.get("https://github.com/o/r", "a"), await cache.get("https://github.com/o/r", "b")
+
+    cache, old, new = asyncio.run(main())
+    # The entry just stored is always kept, even alone over the limit
+    assert old is None and new is not None
+    assert cache.metrics["evictions"] == 1
+
+
+def test_off_never_stores():
+    async def main():
+        cache = AnalysisCache(mode="off")
+        await cache.put("https://github.com/o/r", "a", entry("a"))
+        return await cache.get("https://github.com/o/r", "a")
+
+    assert asyncio.run(main()) is None
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+import clone_strategy
+from clone_strategy import CloneStrategy
+
+
+def test_auto_size_lookup_is_cached_per_repo(monkeypatch):
+    calls = []
+
+    async def fake_fetch(repo_url):
+        calls.append(repo_url)
+        return 10
+
+    monkeypatch.setattr(clone_strategy, "fetch_github_repo_size_kb", fake_fetch)
+    monkeypatch.setattr(clone_strategy, "_size_cache", {})
+
+    async def main():
+        first = await CloneStrategy("auto").resolve("https://github.com/example/repo")
+        second = await CloneStrategy("auto").resolve("https://github.com/example/repo.git")
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first.mode == second.mode == "full"
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("depth", [0, -3])
+def test_depth_must_be_positive(depth):
+    with pytest.raises(ValueError):
+        CloneStrategy("shallow", depth)
+
+
+def test_auto_keeps_sparse_paths(monkeypatch):
+    monkeypatch.setattr(clone_strategy, "fetch_github_repo_size_kb", None)
+    resolved = asyncio.run(CloneStrategy("auto", sparse_paths=["src/"]).resolve("https://github.com/example/repo"))
+    assert resolved.mode == "sparse"
+    assert resolved.sparse_paths == ["src"]
+
+
+def test_sparse_paths_are_rejected_for_non_sparse_modes():
+    with pytest.raises(ValueError):
+        CloneStrategy("shallow", sparse_paths=["src"])
+
+
+@pytest.mark.parametrize("mode, expected", [("shallow", "full"), ("treeless", "full"), ("auto", "full"), ("sparse", "sparse")])
+def test_mirror_copy_keeps_only_sparse_paths(mode, expected):
+    strategy = CloneStrategy(mode, sparse_paths=["docs"] if mode == "sparse" else None)
+    assert strategy.for_mirror_copy().mode == expected
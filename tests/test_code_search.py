@@ -0,0 +1,32 @@
+from code_search import CodeIndex
+
+
+def write(root, path, text):
+    (root / path).write_text(text)
+
+
+def test_search_ranks_the_chunk_that_names_the_query(tmp_path):
+    write(tmp_path, "billing.py", "def compute_invoice_total(items):\n    return sum(items)\n")
+    write(tmp_path, "users.py", "def load_user(user_id):\n    return user_id\n")
+    index = CodeIndex.build(str(tmp_path))
+
+    hit, = index.search("invoice total")
+    assert (hit["path"], hit["start_line"]) == ("billing.py", 1)
+    assert "compute_invoice_total" in hit["snippet"]
+    assert index.search("invoice", path_prefix="users") == []
+
+
+def test_refreshed_files_report_line_numbers_of_the_written_text(tmp_path):
+    write(tmp_path, "app.py", "def handle_request():\n    pass\n")
+    index = CodeIndex.build(str(tmp_path))
+    pristine = index.to_bytes()
+
+    write(tmp_path, "app.py", "\n" * 200 + "def handle_request():\n    pass\n")
+    index.refresh(["app.py"])
+
+    hit, = index.search("handle_request")
+    line = next(line for line in hit["snippet"].splitlines() if "handle_request" in line)
+    assert line.startswith("  201|")
+    # An export taken before the write still describes the original checkout
+    write(tmp_path, "app.py", "def handle_request():\n    pass\n")
+    assert CodeIndex.from_bytes(pristine, str(tmp_path)).search("handle_request")[0]["start_line"] == 1
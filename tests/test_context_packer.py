@@ -0,0 +1,75 @@
+import asyncio
+import subprocess
+
+from context_packer import MIN_EXCERPT_TOKENS, estimate_tokens, pack_context
+from manifest import build_manifest
+
+
+def manifest_of(files):
+    return {
+        "files": [{"path": path, "size": len(content), "binary": False, "sha": None} for path, content in files.items()],
+        "contents": {},
+    }
+
+
+def pack(files, prompt, **kwargs):
+    reads = []
+
+    async def read_files(paths):
+        reads.append(list(paths))
+        return {path: files[path] for path in paths}
+
+    return asyncio.run(pack_context(manifest_of(files), prompt, read_files, **kwargs)), reads
+
+
+def test_relevant_files_come_first_and_are_read_in_one_call():
+    files = {
+        "src/billing/invoice.py": "def total(invoice): ...\n",
+        "src/users/profile.py": "def name(user): ...\n",
+        "README.md": "# Shop\n",
+        "package-lock.json": "{}\n",
+    }
+    context, reads = pack(files, "Fix rounding in invoice totals", budget=2000)
+    assert context.paths[0] == "src/billing/invoice.py"
+    assert len(reads) == 1
+    assert context.paths[-1] == "package-lock.json"
+
+
+def test_budget_is_respected_with_an_excerpt_for_the_file_that_does_not_fit():
+    line = "x = 1  # filler line\n"
+    files = {
+        "payments.py": line * 40,
+        "payments_client.py": line * 400,
+        "payments_notes.md": line * 400,
+    }
+    budget = 1500
+    context, _ = pack(files, "payments", budget=budget, list_paths=0)
+
+    assert context.tokens <= budget
+    decisions = {item["path"]: item for item in context.included}
+    assert decisions["payments.py"]["excerpt"] is False
+    excerpted = [item for item in context.included if item["excerpt"]]
+    assert len(excerpted) == 1
+    assert context.contents[excerpted[0]["path"]].endswith("... (truncated) ...")
+    # Once less than MIN_EXCERPT_TOKENS is left, the rest is excluded for budget
+    assert budget - context.tokens < MIN_EXCERPT_TOKENS
+    assert [item["reason"] for item in context.excluded] == ["budget"]
+
+
+def test_everything_fits_under_a_large_budget():
+    files = {"a.py": "print('a')\n", "b.py": "print('b')\n"}
+    context, _ = pack(files, "anything", budget=10_000)
+    assert set(context.contents) == set(files)
+    assert context.tokens >= sum(estimate_tokens(content) for content in files.values())
+
+
+def test_manifest_cap_keeps_the_most_important_files(tmp_path):
+    for index in range(5):
+        (tmp_path / f"asset{index}.bin").write_bytes(b"\0")
+    (tmp_path / "zz_service.py").write_text("pass\n")
+    subprocess.run(["git", "init", "-q"], cwd=tmp_path, check=True)
+    subprocess.run(["git", "add", "."], cwd=tmp_path, check=True)
+
+    manifest = build_manifest(str(tmp_path), max_files=3)
+    assert manifest["truncated"]
+    assert "zz_service.py" in [entry["path"] for entry in manifest["files"]]
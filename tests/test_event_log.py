@@ -0,0 +1,114 @@
+import asyncio
+import json
+import os
+import re
+import time
+
+from event_log import SessionEventLog
+from events import Event
+
+
+def frame_ids(chunks):
+    return [int(event_id) for event_id in re.findall(rb"^id: (\d+)$", b"".join(chunks), re.M)]
+
+
+def frame_types(chunks):
+    return [json.loads(data)["type"] for data in re.findall(rb"^data: (.*)$", b"".join(chunks), re.M)]
+
+
+async def collect(log, after_id=0):
+    return [chunk async for chunk in log.subscribe(after_id, coalesce_ms=0)]
+
+
+def test_replays_and_resumes_from_last_id():
+    async def main():
+        log = SessionEventLog("s", spill_dir="")
+        for i in range(5):
+            log.append(Event('status', message=str(i)))
+        log.close()
+        return await collect(log), await collect(log, after_id=3)
+
+    everything, resumed = asyncio.run(main())
+    assert frame_ids(everything) == [1, 2, 3, 4, 5]
+    assert frame_ids(resumed) == [4, 5]
+
+
+def test_follows_live_appends_until_closed():
+    async def main():
+        log = SessionEventLog("s", spill_dir="")
+        subscriber = asyncio.create_task(collect(log))
+        for i in range(3):
+            await asyncio.sleep(0)
+            log.append(Event('status', message=str(i)))
+        log.close()
+        return await subscriber
+
+    assert frame_ids(asyncio.run(main())) == [1, 2, 3]
+
+
+def test_evicted_events_without_spill_are_reported_as_a_gap():
+    async def main():
+        log = SessionEventLog("s", max_bytes=200, spill_dir="")
+        for i in range(10):
+            log.append(Event('status', message=str(i)))
+        log.close()
+        return log, await collect(log)
+
+    log, chunks = asyncio.run(main())
+    types = frame_types(chunks)
+    assert types[0] == "stream_gap"
+    assert frame_ids(chunks) == list(range(log._first_id, 11))
+
+
+def test_evicted_events_are_replayed_from_the_spill_file(tmp_path):
+    async def main():
+        log = SessionEventLog("s", max_bytes=200, spill_dir=str(tmp_path))
+        for i in range(10):
+            log.append(Event('status', message=str(i)))
+        # Before and after the spill file is written
+        unflushed = await collect_now(log)
+        await asyncio.sleep(0.05)
+        log.close()
+        flushed = await collect(log)
+        log.discard()
+        await asyncio.sleep(0.05)
+        return unflushed, flushed
+
+    unflushed, flushed = asyncio.run(main())
+    assert frame_ids([unflushed]) == list(range(1, 11))
+    assert frame_ids(flushed) == list(range(1, 11))
+    assert not os.listdir(tmp_path)
+
+
+async def collect_now(log):
+    chunk, _ = await log._frames_after(0)
+    return chunk
+
+
+def test_events_spilled_during_a_replay_are_not_skipped(tmp_path):
+    async def main():
+        log = SessionEventLog("s", max_bytes=200, spill_dir=str(tmp_path))
+        for i in range(10):
+            log.append(Event('status', message=str(i)))
+        await asyncio.sleep(0.05)
+
+        # Slow disk reads, so the producer evicts more frames mid-read
+        read = log._read_spill_file
+
+        def slow_read(offset, end):
+            time.sleep(0.02)
+            return read(offset, end)
+
+        log._read_spill_file = slow_read
+
+        async def produce():
+            for i in range(50):
+                log.append(Event('status', message=str(i)))
+                await asyncio.sleep(0.001)
+            log.close()
+
+        chunks, _ = await asyncio.gather(collect(log), produce())
+        return chunks, log.last_id
+
+    chunks, last_id = asyncio.run(main())
+    assert frame_ids(chunks) == list(range(1, last_id + 1))
@@ -0,0 +1,98 @@
+import asyncio
+
+from clone_strategy import CloneStrategy
+from events import Event
+from jobs import JobQueue, MemoryJobStore
+
+
+class FakeAgent:
+    async def process_coding_request(self, *args):
+        yield Event('completion', message='done', telemetry={'pr_url': None})
+
+
+class FlakyStore(MemoryJobStore):
+    """Accepts submissions, then fails every save a worker makes"""
+
+    def __init__(self):
+        super().__init__()
+        self.failing = False
+
+    async def save(self, job):
+        if self.failing:
+            raise OSError("disk full")
+        await super().save(job)
+
+
+def test_store_errors_do_not_kill_workers():
+    async def main():
+        store = FlakyStore()
+        queue = JobQueue(FakeAgent(), workers=1, store=store, retention=60)
+        await queue.start()
+        jobs = [await queue.submit("https://github.com/example/repo", "task", CloneStrategy("full"), "tenant") for _ in range(3)]
+        store.failing = True
+        for _ in range(100):
+            if all(job.status == "succeeded" for job in jobs):
+                break
+            await asyncio.sleep(0.01)
+        stats = queue.stats()
+        await queue.stop()
+        return jobs, stats
+
+    jobs, stats = asyncio.run(main())
+    # The single worker survived every failed save and ran all three jobs
+    assert [job.status for job in jobs] == ["succeeded"] * 3
+    assert stats["store_errors"] == 6
+
+
+class SlowAgent:
+    def __init__(self):
+        self.cleaned_up = 0
+
+    async def process_coding_request(self, *args):
+        try:
+            yield Event('status', message='working')
+            await asyncio.sleep(60)
+            yield Event('completion', message='done', telemetry={'pr_url': None})
+        finally:
+            self.cleaned_up += 1
+
+
+def test_submit_returns_the_job_when_the_store_fails():
+    async def main():
+        store = FlakyStore()
+        store.failing = True
+        queue = JobQueue(FakeAgent(), workers=1, store=store, retention=60)
+        await queue.start()
+        job = await queue.submit("https://github.com/example/repo", "task", CloneStrategy("full"), "tenant")
+        for _ in range(100):
+            if job.status == "succeeded":
+                break
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return job
+
+    assert asyncio.run(main()).status == "succeeded"
+
+
+def test_cancel_running_and_queued_jobs():
+    async def main():
+        agent = SlowAgent()
+        queue = JobQueue(agent, workers=1, retention=60)
+        await queue.start()
+        running = await queue.submit("https://github.com/example/repo", "task", CloneStrategy("full"), "tenant")
+        queued = await queue.submit("https://github.com/example/repo", "task", CloneStrategy("full"), "tenant")
+        while running.status != "running":
+            await asyncio.sleep(0.01)
+
+        await queue.cancel(queued.job_id)
+        await queue.cancel(running.job_id)
+        stats = queue.stats()
+        await queue.stop()
+        return agent, running, queued, stats
+
+    agent, running, queued, stats = asyncio.run(main())
+    assert (running.status, queued.status) == ("cancelled", "cancelled")
+    assert agent.cleaned_up == 1
+    assert running.log.done and queued.log.done
+    assert stats["cancelled"] == 2
+    assert stats["scheduler"]["queued"] == 0
@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+from llm_cache import ResponseCache
+
+
+def message(text: str):
+    return SimpleNamespace(
+        content=[SimpleNamespace(type="text", text=text)],
+        stop_reason="end_turn",
+        usage=SimpleNamespace(input_tokens=1, output_tokens=1),
+    )
+
+
+def test_concurrent_puts_of_one_key(tmp_path):
+    cache = ResponseCache(mode="disk", directory=str(tmp_path))
+
+    async def main():
+        await asyncio.gather(*(cache.put("ab" * 32, message(str(i)), 1.0) for i in range(8)))
+        cache._memory.clear()
+        return await cache.get("ab" * 32)
+
+    record = asyncio.run(main())
+    assert record is not None
+    assert cache.metrics["errors"] == 0
+    assert cache.metrics["stores"] == 8
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_write_failure_does_not_raise(tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    # The cache directory is a file, so every write fails
+    cache = ResponseCache(mode="memory", directory=str(blocker))
+    cache.mode = "disk"
+
+    asyncio.run(cache.put("cd" * 32, message("x"), 1.0))
+    assert cache.metrics["errors"] == 1
+
+
+def test_disk_eviction(tmp_path):
+    cache = ResponseCache(mode="disk", directory=str(tmp_path), max_bytes=400)
+
+    async def main():
+        for i in range(5):
+            await cache.put(f"{i:02d}" * 32, message("x" * 100), 1.0)
+
+    asyncio.run(main())
+    assert cache.stats()["disk_bytes"] <= 400
+    assert cache.metrics["evictions"] > 0
+    assert len(list(tmp_path.rglob("*.json"))) == len(cache._disk)
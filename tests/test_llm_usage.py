@@ -0,0 +1,117 @@
+import asyncio
+from types import SimpleNamespace
+
+import anthropic
+import httpx
+
+from claude_client import ClaudeCodeAnalyst
+from llm_usage import UsageLedger, summarize_turns
+from resilience import ResilientCaller
+
+
+def usage(input_tokens, output_tokens):
+    return SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens, cache_read_input_tokens=None, cache_creation_input_tokens=0)
+
+
+def overloaded() -> anthropic.APIStatusError:
+    response = httpx.Response(200, request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+    body = {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}
+    return anthropic.APIStatusError(str(body), response=response, body=body)
+
+
+class FakeStream:
+    """A streamed text reply billed `billed`; with fail, it errors after the first delta"""
+
+    def __init__(self, billed, fail):
+        self.current_message_snapshot = SimpleNamespace(usage=billed, content=[SimpleNamespace(type="text", text="done")], stop_reason="end_turn")
+        self._fail = fail
+
+    def __aiter__(self):
+        return self._events()
+
+    async def _events(self):
+        yield SimpleNamespace(type="message_start")
+        yield SimpleNamespace(type="content_block_delta", index=0)
+        if self._fail:
+            raise overloaded()
+        yield SimpleNamespace(type="content_block_stop", index=0)
+
+    async def get_final_message(self):
+        return self.current_message_snapshot
+
+
+class FakeManager:
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def __aenter__(self):
+        return self.stream
+
+    async def __aexit__(self, *args):
+        pass
+
+
+def analyst(streams):
+    instance = ClaudeCodeAnalyst.__new__(ClaudeCodeAnalyst)
+    instance.model = "test-model"
+    instance.max_tokens = 100
+    instance.response_cache = SimpleNamespace(enabled=False)
+    instance.resilience = ResilientCaller(max_retries=2, hedge_after_ms=0)
+    instance.client = SimpleNamespace(messages=SimpleNamespace(stream=lambda **request: FakeManager(streams.pop(0))))
+    return instance
+
+
+def test_retried_attempts_are_billed_to_the_turn(monkeypatch):
+    monkeypatch.setattr("resilience.ANTHROPIC_BACKOFF_BASE", 0.001)
+    client = analyst([FakeStream(usage(1000, 40), fail=True), FakeStream(usage(1000, 60), fail=False)])
+    session = SimpleNamespace(llm_turns=[])
+
+    asyncio.run(client._stream_turn(session, "round_1", messages=[{"role": "user", "content": "hi"}]))
+
+    turn, = session.llm_turns
+    assert turn["attempts"] == 2
+    assert (turn["input_tokens"], turn["output_tokens"]) == (2000, 100)
+    assert turn["cost_usd"] > 0
+
+
+def test_a_turn_that_fails_mid_stream_is_still_billed(monkeypatch):
+    monkeypatch.setattr("resilience.ANTHROPIC_BACKOFF_BASE", 0.001)
+    client = analyst([FakeStream(usage(500, 10), fail=True) for _ in range(3)])
+    session = SimpleNamespace(llm_turns=[])
+
+    try:
+        asyncio.run(client._stream_turn(session, "round_1", messages=[{"role": "user", "content": "hi"}]))
+    except anthropic.APIStatusError:
+        pass
+
+    turn, = session.llm_turns
+    assert turn["error"]
+    assert (turn["attempts"], turn["input_tokens"]) == (3, 1500)
+
+
+def test_a_hedge_closed_after_its_turn_is_added_to_it():
+    client = analyst([])
+    session = SimpleNamespace(llm_turns=[])
+    attempts = SimpleNamespace(usages=[usage(100, 10)], turn=None)
+    client._record_turn(session, "round_1", 0.0, attempts=attempts)
+
+    late = SimpleNamespace(manager=FakeManager(None), stream=FakeStream(usage(100, 0), fail=False), attempts=attempts, closed=False)
+    asyncio.run(client._close_stream(late))
+    asyncio.run(client._close_stream(late))
+
+    turn, = session.llm_turns
+    assert (turn["attempts"], turn["input_tokens"], turn["output_tokens"]) == (2, 200, 10)
+
+
+def test_ledger_totals_include_every_attempt():
+    turns = [
+        {"turn": "round_1", "cached": False, "attempts": 2, "input_tokens": 10, "output_tokens": 1, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0, "cost_usd": 0.5, "ttft_ms": 5.0, "model_ms": 10.0, "duration_ms": 12.0},
+        {"turn": "round_2", "cached": True, "attempts": 0, "input_tokens": 0, "output_tokens": 0, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0, "cost_usd": 0.0, "ttft_ms": None, "model_ms": 0.0, "duration_ms": 1.0},
+    ]
+    ledger = UsageLedger()
+    ledger.record("tenant", "session", turns)
+    ledger.record("tenant", "session-2", turns)
+
+    assert summarize_turns(turns)["attempts"] == 2
+    assert ledger.stats()["tenants"]["tenant"]["attempts"] == 4
+    assert ledger.stats()["totals"]["cost_usd"] == 1.0
@@ -0,0 +1,148 @@
+"""
+ModalSandbox must only use the Modal SDK's .aio interfaces: a slow sandbox
+(clone, command output, file writes) may not stall other sessions sharing
+the event loop. The fake below blocks the thread on every synchronous call,
+so any blocking use shows up as a gap in a concurrent ticker.
+"""
+import asyncio
+import json
+import time
+
+import pytest
+
+import sandbox as sandbox_module
+from clone_strategy import CloneStrategy
+
+SLOW = 0.05
+TICK = 0.01
+
+
+class FakeMethod:
+    """A Modal SDK method: calling it blocks the thread, .aio awaits"""
+
+    def __init__(self, fn):
+        self._fn = fn
+
+    def __call__(self, *args, **kwargs):
+        time.sleep(SLOW)
+        return asyncio.run(self._fn(*args, **kwargs))
+
+    async def aio(self, *args, **kwargs):
+        return await self._fn(*args, **kwargs)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.read = FakeMethod(self._read)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(SLOW)
+            yield chunk
+
+    async def _read(self):
+        await asyncio.sleep(SLOW)
+        return "".join(self._chunks)
+
+
+class FakeStdin:
+    def __init__(self):
+        self.data = b""
+        self.drain = FakeMethod(self._drain)
+
+    def write(self, data: bytes):
+        self.data += data
+
+    def write_eof(self):
+        pass
+
+    async def _drain(self):
+        await asyncio.sleep(SLOW)
+
+
+class FakeProcess:
+    def __init__(self, stdout, exit_code=0):
+        self.stdout = FakeStream(stdout)
+        self.stderr = FakeStream([])
+        self.stdin = FakeStdin()
+        self.wait = FakeMethod(self._wait)
+        self._exit_code = exit_code
+
+    async def _wait(self):
+        await asyncio.sleep(SLOW)
+        return self._exit_code
+
+
+class FakeSandbox:
+    object_id = "sb-fake-0000"
+
+    def __init__(self):
+        self.exec = FakeMethod(self._exec)
+        self.terminate = FakeMethod(self._slow)
+
+    async def _exec(self, *args, **kwargs):
+        await asyncio.sleep(SLOW)
+        if args[0] == "python3" and args[2] == sandbox_module._WRITE_FILES_SCRIPT:
+            return FakeProcess([json.dumps({"src/app.py": None})])
+        if args[0] == "python3":
+            return FakeProcess([json.dumps({"README.md": "hello"})])
+        return FakeProcess([f"line {i}\n" for i in range(5)])
+
+    async def _slow(self):
+        await asyncio.sleep(SLOW)
+
+
+@pytest.fixture
+def modal_sandbox(monkeypatch):
+    monkeypatch.setattr(sandbox_module, "resolve_modal_runtime", lambda: (None, None))
+    instance = sandbox_module.ModalSandbox()
+    instance.sandbox = FakeSandbox()
+    return instance
+
+
+async def ticker(gaps, stop):
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(TICK)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+
+async def slow_session(modal_sandbox):
+    events = []
+    async for event in modal_sandbox.clone_repo("https://github.com/example/repo", "ws", CloneStrategy("full")):
+        events.append(event)
+    async for event in modal_sandbox.execute_command("make build", "ws"):
+        events.append(event)
+    async for event in modal_sandbox.write_files({"src/app.py": "print('hi')\n"}, "ws"):
+        events.append(event)
+    contents = await modal_sandbox.read_files(["README.md"], "ws")
+    return events, contents
+
+
+def test_other_sessions_keep_streaming_during_slow_sandbox_work(modal_sandbox):
+    async def main():
+        gaps = []
+        stop = asyncio.Event()
+        ticks = asyncio.create_task(ticker(gaps, stop))
+        started = time.perf_counter()
+        events, contents = await slow_session(modal_sandbox)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await ticks
+        return gaps, events, contents, elapsed
+
+    gaps, events, contents, elapsed = asyncio.run(main())
+
+    assert not [event for event in events if event.type == "error"]
+    assert contents == {"README.md": "hello"}
+    # The slow work took many ticks' worth of time...
+    assert elapsed > 10 * SLOW
+    # ...and the ticker kept its cadence throughout: no gap anywhere near a blocking call
+    assert max(gaps) < TICK + SLOW * 0.8
+    assert len(gaps) >= elapsed / (TICK * 3)
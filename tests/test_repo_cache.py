@@ -0,0 +1,90 @@
+import asyncio
+import os
+import subprocess
+
+from repo_cache import RepoMirrorCache, copy_tree_cow
+
+
+def git(*args, cwd):
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=cwd, check=True, capture_output=True)
+
+
+def upstream(tmp_path):
+    """A local repository with one commit, cloned like a remote"""
+    origin = tmp_path / "origin"
+    origin.mkdir()
+    git("init", "--quiet", cwd=origin)
+    (origin / "app.py").write_text("print('v1')\n")
+    git("add", "app.py", cwd=origin)
+    git("commit", "--quiet", "-m", "v1", cwd=origin)
+    return origin
+
+
+def test_second_checkout_reuses_the_mirror(tmp_path):
+    origin = upstream(tmp_path)
+    cache = RepoMirrorCache(root=str(tmp_path / "mirrors"), fetch_ttl=3600)
+
+    async def main():
+        first = await cache.checkout(str(origin), str(tmp_path / "ws1"))
+        second = await cache.checkout(str(origin), str(tmp_path / "ws2"))
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert (first["cache_hit"], second["cache_hit"]) == (False, True)
+    assert (cache.metrics["misses"], cache.metrics["hits"], cache.metrics["fetches"]) == (1, 1, 0)
+    assert (tmp_path / "ws2" / "app.py").read_text() == "print('v1')\n"
+
+
+def test_a_stale_mirror_fetches_new_commits(tmp_path):
+    origin = upstream(tmp_path)
+    cache = RepoMirrorCache(root=str(tmp_path / "mirrors"), fetch_ttl=0)
+    asyncio.run(cache.checkout(str(origin), str(tmp_path / "ws1")))
+
+    (origin / "app.py").write_text("print('v2')\n")
+    git("commit", "--quiet", "-am", "v2", cwd=origin)
+    asyncio.run(cache.checkout(str(origin), str(tmp_path / "ws2")))
+
+    assert cache.metrics["fetches"] == 1
+    assert (tmp_path / "ws2" / "app.py").read_text() == "print('v2')\n"
+
+
+def test_eviction_skips_pinned_mirrors(tmp_path):
+    origin = upstream(tmp_path)
+    cache = RepoMirrorCache(root=str(tmp_path / "mirrors"), max_bytes=0, fetch_ttl=3600)
+    asyncio.run(cache.checkout(str(origin), str(tmp_path / "ws1")))
+    assert os.path.isdir(cache.mirror_path(str(origin)))
+
+    cache.release(str(origin))
+    asyncio.run(cache.evict())
+    assert not os.path.isdir(cache.mirror_path(str(origin)))
+    assert cache.metrics["evictions"] == 1
+
+
+def test_workspaces_are_independent_copies(tmp_path):
+    origin = upstream(tmp_path)
+    cache = RepoMirrorCache(root=str(tmp_path / "mirrors"), fetch_ttl=3600)
+
+    async def main():
+        first = await cache.checkout(str(origin), str(tmp_path / "ws1"))
+        (tmp_path / "ws1" / "app.py").write_text("edited\n")
+        await cache.checkout(str(origin), str(tmp_path / "ws2"))
+        return first
+
+    first = asyncio.run(main())
+    assert (tmp_path / "ws2" / "app.py").read_text() == "print('v1')\n"
+    # Whichever method this filesystem allows, it is counted and remembered
+    assert cache.cow_supported is (first["copy_method"] == "cow")
+    assert cache.metrics["cow_copies"] + cache.metrics["full_copies"] == 2
+
+
+def test_copy_skips_the_clone_when_cow_is_known_unsupported(tmp_path):
+    src = tmp_path / "src"
+    (src / "pkg").mkdir(parents=True)
+    (src / "pkg" / "mod.py").write_text("x = 1\n")
+    os.symlink("pkg/mod.py", src / "link.py")
+
+    method = asyncio.run(copy_tree_cow(str(src), str(tmp_path / "dest"), cow_supported=False))
+
+    assert method == "copy"
+    assert (tmp_path / "dest" / "pkg" / "mod.py").read_text() == "x = 1\n"
+    assert os.readlink(tmp_path / "dest" / "link.py") == "pkg/mod.py"
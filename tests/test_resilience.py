@@ -0,0 +1,121 @@
+import asyncio
+
+import anthropic
+import httpx
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCaller, SideEffectsStartedError, is_retryable
+
+
+def status_error(status_code: int, error_type: str) -> anthropic.APIStatusError:
+    response = httpx.Response(status_code, request=httpx.Request("POST", "https://api.anthropic.com/v1/messages"))
+    body = {"type": "error", "error": {"type": error_type, "message": error_type}}
+    return anthropic.APIStatusError(str(body), response=response, body=body)
+
+
+def test_mid_stream_overload_is_retryable():
+    # An SSE error event is raised with the stream's HTTP status, 200
+    assert is_retryable(status_error(200, "overloaded_error"))
+    assert is_retryable(status_error(200, "rate_limit_error"))
+    assert not is_retryable(status_error(200, "invalid_request_error"))
+
+
+def test_status_codes():
+    assert is_retryable(status_error(529, "overloaded_error"))
+    assert is_retryable(status_error(503, "api_error"))
+    assert not is_retryable(status_error(400, "invalid_request_error"))
+
+
+def caller(**kwargs) -> ResilientCaller:
+    return ResilientCaller(hedge_after_ms=0, **kwargs)
+
+
+async def passthrough(opened):
+    return opened
+
+
+async def discard(opened):
+    pass
+
+
+def test_retries_until_success(monkeypatch):
+    monkeypatch.setattr("resilience.ANTHROPIC_BACKOFF_BASE", 0.001)
+    attempts = []
+
+    async def open():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise status_error(200, "overloaded_error")
+        return "ok"
+
+    resilient = caller(max_retries=4)
+    assert asyncio.run(resilient.call(open, passthrough, discard, 10)) == "ok"
+    assert len(attempts) == 3
+    assert resilient.metrics["retries"] == 2
+
+
+def test_not_retried_after_side_effects():
+    attempts = []
+
+    async def open():
+        attempts.append(1)
+        return "opened"
+
+    async def consume(opened):
+        raise SideEffectsStartedError(status_error(200, "overloaded_error"), ["hello.py"])
+
+    resilient = caller(max_retries=4)
+    with pytest.raises(SideEffectsStartedError) as raised:
+        asyncio.run(resilient.call(open, consume, discard, 10))
+    assert raised.value.partial == ["hello.py"]
+    assert len(attempts) == 1
+
+
+def test_cancelled_half_open_trial_reopens_circuit():
+    breaker = CircuitBreaker(threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    resilient = caller(breaker=breaker, max_retries=0)
+
+    async def hang():
+        await asyncio.sleep(60)
+
+    async def main():
+        trial = asyncio.create_task(resilient.call(hang, passthrough, discard, 10))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+        # The trial counted as failed; once the reset time passes another call gets through
+        async def ok():
+            return "ok"
+        return await resilient.call(ok, passthrough, discard, 10)
+
+    assert asyncio.run(main()) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_open_circuit_fails_fast():
+    breaker = CircuitBreaker(threshold=1, reset_seconds=60)
+    breaker.record_failure()
+
+    async def open():
+        raise AssertionError("must not be called")
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(caller(breaker=breaker).call(open, passthrough, discard, 10))
+
+
+def test_bad_request_on_half_open_trial_does_not_close_circuit():
+    breaker = CircuitBreaker(threshold=1, reset_seconds=0)
+    breaker.record_failure()
+
+    async def bad_request():
+        raise status_error(400, "invalid_request_error")
+
+    with pytest.raises(anthropic.APIStatusError):
+        asyncio.run(caller(breaker=breaker, max_retries=0).call(bad_request, passthrough, discard, 10))
+    # Still probing: the trial slot is free again, but nothing proved the API healthy
+    assert breaker.state == "half_open"
+    breaker.check()
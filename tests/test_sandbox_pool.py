@@ -0,0 +1,86 @@
+import asyncio
+import itertools
+import time
+from types import SimpleNamespace
+
+from sandbox_pool import ModalSandboxPool
+
+_ids = itertools.count()
+
+
+class FakeSandbox:
+    def __init__(self):
+        self.object_id = f"sb-{next(_ids)}"
+        self.terminated = False
+        self.exec = SimpleNamespace(aio=self._exec)
+        self.poll = SimpleNamespace(aio=self._poll)
+        self.terminate = SimpleNamespace(aio=self._terminate)
+
+    async def _exec(self, *args):
+        return SimpleNamespace(wait=SimpleNamespace(aio=self._ok))
+
+    async def _ok(self):
+        return 0
+
+    async def _poll(self):
+        return None
+
+    async def _terminate(self):
+        self.terminated = True
+
+
+def make_pool(size=2, spawn_delay=0.0, **kwargs):
+    pool = ModalSandboxPool(size=size, **kwargs)
+    pool.sandbox_timeout = 600
+
+    async def spawn_sandbox():
+        await asyncio.sleep(spawn_delay)
+        return FakeSandbox()
+
+    pool._template = SimpleNamespace(spawn_sandbox=spawn_sandbox, workspace_path="/workspace/repo")
+    # release() only recycles while the pool is running
+    pool._refill_task = object()
+    return pool
+
+
+def test_sandbox_near_its_timeout_is_not_leased():
+    async def main():
+        pool = make_pool(idle_ttl=1000, min_remaining=300)
+        old = await pool._create()
+        pool._created_at[old.object_id] = time.time() - 400  # 200s left
+        pool._idle.append((old, time.time()))
+        leased = await pool.lease()
+        return pool, old, leased
+
+    pool, old, leased = asyncio.run(main())
+    assert leased is not old and old.terminated
+    assert pool.metrics["misses"] == 1
+
+
+def test_idle_ttl_counts_from_release_not_creation():
+    async def main():
+        pool = make_pool(idle_ttl=60, min_remaining=100)
+        sandbox = await pool.lease()
+        pool._created_at[sandbox.object_id] = time.time() - 120  # older than the idle TTL
+        await pool.release(sandbox)
+        return pool, sandbox, await pool.lease()
+
+    pool, sandbox, again = asyncio.run(main())
+    assert again is sandbox
+    assert pool.metrics["hits"] == 1
+
+
+def test_refill_does_not_overshoot_when_a_release_lands_mid_refill():
+    async def main():
+        pool = make_pool(size=2, spawn_delay=0.05, idle_ttl=1000, min_remaining=0)
+        leased = [await pool.lease() for _ in range(2)]
+        refill = asyncio.create_task(pool._refill())
+        await asyncio.sleep(0.01)
+        for sandbox in leased:
+            await pool.release(sandbox)
+        await refill
+        return pool
+
+    pool = asyncio.run(main())
+    assert len(pool._idle) == 2
+    assert pool.metrics["terminated"] == 2
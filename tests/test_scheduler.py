@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from scheduler import AdmissionError, FairScheduler
+
+
+def test_tenant_metrics_survive_draining():
+    async def main():
+        scheduler = FairScheduler(tenant_max_running=1, tenant_max_queued=1, max_queued=10, weights={})
+        scheduler.admit("a", "job-1")
+        with pytest.raises(AdmissionError):
+            scheduler.admit("a", "job-2")
+        tenant, _ = await scheduler.next()
+        scheduler.done(tenant, 1.0)
+        # A rejection while idle used to drop the tenant (and its counters) too
+        scheduler.admit("b", "job-3")
+        tenant, _ = await scheduler.next()
+        scheduler.done(tenant, 1.0)
+        return scheduler.stats()["tenants"]
+
+    tenants = asyncio.run(main())
+    assert tenants["a"]["admitted"] == 1
+    assert tenants["a"]["rejected"] == 1
+    assert tenants["a"]["dispatched"] == 1
+    assert tenants["a"]["queued"] == 0
+    assert tenants["b"]["dispatched"] == 1
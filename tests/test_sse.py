@@ -0,0 +1,35 @@
+import asyncio
+import zlib
+
+from events import Event
+import sse
+from sse import SSEEncoder, encode_frame
+
+
+def test_frames_carry_increasing_ids():
+    encoder = SSEEncoder()
+    frames = [encoder.encode(Event('info', message=f'step {i}')) for i in range(3)]
+
+    assert [frame.split(b"\n")[0] for frame in frames] == [b"id: 1", b"id: 2", b"id: 3"]
+    assert all(frame.endswith(b"\n\n") for frame in frames)
+    assert encoder.last_id == 3
+    assert encoder.metrics == {"events": 3, "bytes": sum(len(frame) for frame in frames)}
+
+
+def test_a_frame_without_an_id_is_data_only():
+    assert encode_frame({"type": "ping"}) == b'data: {"type":"ping"}\n\n'
+
+
+def test_gzip_stream_flushes_every_frame():
+    frames = [encode_frame({"n": i}, i) for i in range(3)]
+
+    async def source():
+        for frame in frames:
+            yield frame
+
+    async def main():
+        decompressor = zlib.decompressobj(31)
+        # Each chunk decodes on its own, so the client sees events as they happen
+        return [decompressor.decompress(chunk) async for chunk in sse._gzip_stream(source())]
+
+    assert asyncio.run(main())[:3] == frames
@@ -0,0 +1,28 @@
+import asyncio
+
+from events import CommandResult
+from sandbox import _stream_process_output
+
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+async def exit_zero():
+    return 0
+
+
+def test_multibyte_characters_split_across_chunks():
+    data = "héllo → wörld\nsecond ✓ line".encode()
+    # Split inside the two-byte é and the three-byte arrow
+    parts = (data[:2], data[2:9], data[9:])
+
+    async def main():
+        return [event async for event in _stream_process_output("cmd", {"stdout": chunks(*parts)}, exit_zero)]
+
+    events = asyncio.run(main())
+    result = events[-1]
+    assert isinstance(result, CommandResult)
+    assert result.stdout == "héllo → wörld\nsecond ✓ line"
+    assert "�" not in result.stdout
@@ -0,0 +1,72 @@
+import asyncio
+from types import SimpleNamespace
+
+from claude_client import ToolBatch
+
+
+def call(name, file_path=None, content=None):
+    tool_input = {"file_path": file_path} if file_path else {"query": "x"}
+    if content is not None:
+        tool_input["content"] = content
+    return SimpleNamespace(id=f"{name}-{file_path}-{content}", name=name, input=tool_input)
+
+
+class FakeWorkspace:
+    """Files plus a log of the sandbox round trips made"""
+
+    def __init__(self):
+        self.files = {}
+        self.round_trips = []
+
+    async def run(self, tool_call):
+        self.round_trips.append(tool_call.name)
+        await asyncio.sleep(0.01)
+        if tool_call.name == "read_file":
+            return self.files.get(tool_call.input["file_path"], ""), False, None
+        return "ok", False, None
+
+    async def write(self, tool_calls):
+        self.round_trips.append(f"write x{len(tool_calls)}")
+        await asyncio.sleep(0.01)
+        for tool_call in tool_calls:
+            self.files[tool_call.input["file_path"]] = tool_call.input["content"]
+        return [("written", False, tool_call.input) for tool_call in tool_calls]
+
+
+def run_batch(tool_calls, with_write=True):
+    async def main():
+        workspace = FakeWorkspace()
+        batch = ToolBatch(workspace.run, workspace.write if with_write else None)
+        for tool_call in tool_calls:
+            batch.submit(tool_call)
+            await asyncio.sleep(0)
+        return workspace, await batch.results()
+
+    return asyncio.run(main())
+
+
+def test_writes_of_one_message_share_one_sandbox_call():
+    workspace, results = run_batch([call("create_file", f"f{i}.py", str(i)) for i in range(5)] + [call("search_code")])
+    assert sorted(workspace.round_trips) == ["search_code", "write x5"]
+    assert [outcome[0] for _, outcome in results] == ["written"] * 5 + ["ok"]
+
+
+def test_same_path_calls_run_in_issue_order():
+    workspace, results = run_batch([
+        call("read_file", "a.py"),
+        call("create_file", "a.py", "one"),
+        call("read_file", "a.py"),
+        call("modify_file", "a.py", "two"),
+        call("create_file", "b.py", "b"),
+    ])
+    reads = [outcome[0] for tool_call, outcome in results if tool_call.name == "read_file"]
+    # The first read predates the writes; the second sees the first write only
+    assert reads == ["", "one"]
+    assert workspace.files == {"a.py": "two", "b.py": "b"}
+    # b.py joins the first flush, the second a.py write needs its own
+    assert [trip for trip in workspace.round_trips if trip.startswith("write")] == ["write x2", "write x1"]
+
+
+def test_without_a_write_hook_every_call_runs_alone():
+    workspace, _ = run_batch([call("create_file", "a.py", "1"), call("create_file", "b.py", "2")], with_write=False)
+    assert workspace.round_trips == ["create_file", "create_file"]